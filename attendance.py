@@ -0,0 +1,55 @@
+"""
+Посещаемость студентов
+attendance хранит по каждой паре (студент, дисциплина), сколько всего оценок и сколько
+из них не "н" (-1); таблицу ведут триггеры на grades (миграция 10). Посещаемость группы
+по дисциплине и студента по всем дисциплинам читается одним запросом
+"""
+
+# Полный пересчет по оценкам (условная агрегация)
+RECOUNT = """
+SELECT student_id, discipline_id, SUM(CASE WHEN grade != -1 THEN 1 ELSE 0 END), COUNT(*)
+FROM grades
+WHERE student_id IS NOT NULL AND discipline_id IS NOT NULL
+GROUP BY student_id, discipline_id
+"""
+
+def percentage(attended: int, total: int) -> float:
+    return (attended / total * 100) if total > 0 else 0
+
+def discipline_attendance(cursor, discipline_id: int) -> dict:
+    """{student_id: (посещено, всего)} по дисциплине"""
+    cursor.execute("SELECT student_id, attended, total FROM attendance WHERE discipline_id = ?", (discipline_id,))
+    return {student_id: (attended, total) for student_id, attended, total in cursor.fetchall()}
+
+def student_attendance(cursor, student_id: int):
+    """Посещаемость студента по дисциплинам: [(discipline_id, название, посещено, всего)]"""
+    cursor.execute("""
+    SELECT a.discipline_id, d.name, a.attended, a.total
+    FROM attendance a
+    JOIN disciplines d ON d.discipline_id = a.discipline_id
+    WHERE a.student_id = ?
+    ORDER BY d.name
+    """, (student_id,))
+    return cursor.fetchall()
+
+def find_mismatches(cursor):
+    """Расхождения счетчиков с пересчетом: [(student_id, discipline_id, посещено, всего, по оценкам: посещено, всего)]"""
+    cursor.execute(f"""
+    WITH recount (student_id, discipline_id, attended, total) AS ({RECOUNT})
+    SELECT r.student_id, r.discipline_id, COALESCE(a.attended, 0), COALESCE(a.total, 0), r.attended, r.total
+    FROM recount r
+    LEFT JOIN attendance a USING (student_id, discipline_id)
+    WHERE a.attended IS NOT r.attended OR a.total IS NOT r.total
+    UNION ALL
+    SELECT a.student_id, a.discipline_id, a.attended, a.total, 0, 0
+    FROM attendance a
+    WHERE NOT EXISTS (
+        SELECT 1 FROM recount r WHERE r.student_id = a.student_id AND r.discipline_id = a.discipline_id
+    )
+    """)
+    return cursor.fetchall()
+
+def rebuild(cursor):
+    """Заполняет счетчики заново по оценкам"""
+    cursor.execute("DELETE FROM attendance")
+    cursor.execute(f"INSERT INTO attendance (student_id, discipline_id, attended, total) {RECOUNT}")
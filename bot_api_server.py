@@ -2,11 +2,20 @@
 Простой API сервер для доступа к SQLite БД бота
 Запускайте этот файл на сервере с ботом (Linux)
 """
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
 import sqlite3
 import os
 import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from db import apply_storage_profile, retry_on_busy
+from attendance import discipline_attendance, percentage, student_attendance
+from practice_stats import RESOURCE as PRACTICE_STATS_RESOURCE, practice_counts
 
 app = Flask(__name__)
 CORS(app)  # Разрешаем запросы с других доменов
@@ -17,17 +26,226 @@ logger = logging.getLogger(__name__)
 # Путь к БД бота
 DB_PATH = 'students.db'  # Или укажите полный путь: '/path/to/students.db'
 
+# Максимум соединений на процесс (worker gunicorn)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+# Сколько секунд ждать свободное соединение
+DB_POOL_TIMEOUT = 10
+# Соединение, простоявшее дольше (сек), проверяется перед выдачей
+DB_POOL_CHECK_INTERVAL = 30
+
+# Сколько ответов хранить в кэше ответов (на процесс)
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1000))
+
+class PoolTimeoutError(RuntimeError):
+    """Нет свободного соединения в пуле"""
+
+class ConnectionPool:
+    """Ограниченный пул соединений SQLite.
+
+    Соединения создаются по требованию и переиспользуются; последнее
+    возвращенное выдается первым, поэтому поток обычно получает свое же
+    соединение. PRAGMA применяются один раз при создании соединения.
+    """
+
+    def __init__(self, path, size, timeout, check_interval):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._stats = {'created': 0, 'reused': 0, 'discarded': 0, 'in_use': 0, 'timeouts': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self._stats[key] += delta
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        apply_storage_profile(conn)
+        self._count('created')
+        return conn
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._count('discarded')
+
+    def acquire(self):
+        """Берет соединение из пула или создает новое, если есть свободный слот"""
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count('timeouts')
+            raise PoolTimeoutError("Нет свободного соединения с БД")
+        try:
+            while True:
+                try:
+                    conn, released_at = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._connect()
+                    break
+                if time.monotonic() - released_at > self.check_interval and not self._is_alive(conn):
+                    logger.warning("Соединение из пула не отвечает, создается новое")
+                    self._discard(conn)
+                    continue
+                self._count('reused')
+                break
+        except Exception:
+            self._slots.release()
+            raise
+        self._count('in_use')
+        return conn
+
+    def release(self, conn):
+        """Возвращает соединение в пул, незавершенная транзакция откатывается"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        except sqlite3.Error as e:
+            logger.error(f"Соединение удалено из пула: {e}")
+            self._discard(conn)
+        finally:
+            self._count('in_use', -1)
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(size=self.size, idle=self._idle.qsize())
+        return stats
+
+pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_CHECK_INTERVAL)
+
 def get_db_connection():
-    """Получение подключения к SQLite БД"""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Соединение из пула на время запроса; возвращается в пул по окончании запроса"""
+    if 'db_conn' not in g:
+        g.db_conn = pool.acquire()
+    return g.db_conn
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        pool.release(conn)
+
+@app.errorhandler(PoolTimeoutError)
+def pool_timeout(e):
+    logger.error(f"Пул соединений исчерпан: {e}")
+    return jsonify({'error': 'Database is busy'}), 503
+
+class ResponseCache:
+    """Тела ответов по ключу (путь запроса) вместе с версией данных, по которой они построены"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()  # путь -> (etag, тело)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0}
+
+    def count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get(self, path, etag):
+        with self._lock:
+            item = self._items.get(path)
+            if item is None or item[0] != etag:
+                self._stats['misses'] += 1
+                return None
+            self._items.move_to_end(path)
+            self._stats['hits'] += 1
+            return item[1]
+
+    def put(self, path, etag, body):
+        with self._lock:
+            self._items[path] = (etag, body)
+            self._items.move_to_end(path)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(size=self.size, items=len(self._items))
+        return stats
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+
+def get_versions(cursor, resources):
+    """Версии ресурсов [(resource, key)] из change_versions; None - таблицы нет (схема до миграции 7)"""
+    condition = " OR ".join(["(resource = ? AND key = ?)"] * len(resources))
+    try:
+        cursor.execute(f"SELECT resource, key, version FROM change_versions WHERE {condition}",
+                      [value for resource in resources for value in resource])
+    except sqlite3.OperationalError:
+        return None
+    versions = {(resource, key): version for resource, key, version in cursor.fetchall()}
+    return [versions.get(resource, 0) for resource in resources]
+
+def versioned(dependencies):
+    """Условные ответы для GET: ETag по версиям данных, 304 и кэш тел ответов.
+
+    dependencies(**аргументы маршрута) -> [(resource, key)] из change_versions:
+    имя таблицы с key = 0 - любое изменение таблицы, 'таблица.столбец' - изменения
+    строк с этим значением столбца.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**kwargs):
+            conn = get_db_connection()
+            # Версии и данные читаются в одной транзакции - из одного снимка БД
+            conn.execute("BEGIN")
+            try:
+                versions = get_versions(conn.cursor(), dependencies(**kwargs))
+                if versions is None:
+                    return view(**kwargs)
+                etag = "-".join(map(str, versions))
+                if request.if_none_match.contains(etag):
+                    response_cache.count('not_modified')
+                    response = Response(status=304)
+                else:
+                    body = response_cache.get(request.full_path, etag)
+                    if body is None:
+                        response = view(**kwargs)
+                        if response.status_code != 200:
+                            return response
+                        response_cache.put(request.full_path, etag, response.get_data())
+                    else:
+                        response = Response(body, mimetype='application/json')
+                response.set_etag(etag)
+                return response
+            finally:
+                conn.rollback()
+        return wrapper
+    return decorator
 
 @app.route('/api/health', methods=['GET'])
 def health():
     """Проверка работоспособности API"""
     return jsonify({'status': 'ok', 'db_exists': os.path.exists(DB_PATH)})
 
+@app.route('/api/pool/stats', methods=['GET'])
+def get_pool_stats():
+    """Статистика пула соединений текущего процесса"""
+    return jsonify(pool.stats())
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Статистика кэша ответов текущего процесса"""
+    return jsonify(response_cache.stats())
+
 @app.route('/api/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
     """Получение информации о пользователе"""
@@ -36,13 +254,13 @@ def get_user(user_id):
     
     cursor.execute("SELECT user_id, role, full_name FROM users WHERE user_id = ?", (user_id,))
     user = cursor.fetchone()
-    conn.close()
     
     if user:
         return jsonify(dict(user))
     return jsonify({'error': 'User not found'}), 404
 
 @app.route('/api/student/<int:student_id>/grades', methods=['GET'])
+@versioned(lambda student_id: [('grades.student_id', student_id), ('disciplines', 0), ('users', 0), ('ktp', 0)])
 def get_student_grades(student_id):
     """Получение оценок студента"""
     conn = get_db_connection()
@@ -61,7 +279,6 @@ def get_student_grades(student_id):
     """, (student_id,))
     
     grades = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     
     # Преобразуем -1 в "н"
     for grade in grades:
@@ -70,6 +287,18 @@ def get_student_grades(student_id):
     
     return jsonify(grades)
 
+@app.route('/api/student/<int:student_id>/attendance', methods=['GET'])
+@versioned(lambda student_id: [('grades.student_id', student_id), ('disciplines', 0)])
+def get_student_attendance(student_id):
+    """Посещаемость студента по дисциплинам"""
+    conn = get_db_connection()
+    rows = student_attendance(conn.cursor(), student_id)
+    return jsonify([
+        {'discipline_id': discipline_id, 'discipline': name, 'attended': attended, 'total': total,
+         'percentage': round(percentage(attended, total), 2)}
+        for discipline_id, name, attended, total in rows
+    ])
+
 @app.route('/api/student/<int:student_id>/teachers', methods=['GET'])
 def get_student_teachers(student_id):
     """Получение преподавателей студента"""
@@ -85,7 +314,6 @@ def get_student_teachers(student_id):
     """, (student_id,))
     
     teachers = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return jsonify(teachers)
 
 @app.route('/api/teacher/<int:teacher_id>/disciplines', methods=['GET'])
@@ -97,10 +325,10 @@ def get_teacher_disciplines(teacher_id):
     cursor.execute("SELECT discipline_id, name, group_name FROM disciplines WHERE teacher_id = ? ORDER BY name",
                   (teacher_id,))
     disciplines = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return jsonify(disciplines)
 
 @app.route('/api/teacher/<int:teacher_id>/students', methods=['GET'])
+@versioned(lambda teacher_id: [('student_teacher.teacher_id', teacher_id), ('students', 0), ('users', 0)])
 def get_teacher_students(teacher_id):
     """Получение студентов преподавателя"""
     group_name = request.args.get('group')
@@ -123,10 +351,10 @@ def get_teacher_students(teacher_id):
     query += " ORDER BY u.full_name"
     cursor.execute(query, params)
     students = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return jsonify(students)
 
 @app.route('/api/teacher/<int:teacher_id>/ktp', methods=['GET'])
+@versioned(lambda teacher_id: [('ktp.teacher_id', teacher_id)])
 def get_teacher_ktp(teacher_id):
     """Получение КТП преподавателя"""
     discipline_id = request.args.get('discipline_id')
@@ -147,9 +375,28 @@ def get_teacher_ktp(teacher_id):
     query += " ORDER BY k.description"
     cursor.execute(query, params)
     ktps = [dict(row) for row in cursor.fetchall()]
-    conn.close()
     return jsonify(ktps)
 
+@app.route('/api/discipline/<int:discipline_id>/attendance', methods=['GET'])
+@versioned(lambda discipline_id: [('grades', 0)])
+def get_discipline_attendance(discipline_id):
+    """Посещаемость студентов по дисциплине"""
+    conn = get_db_connection()
+    counts = discipline_attendance(conn.cursor(), discipline_id)
+    return jsonify([
+        {'student_id': student_id, 'attended': attended, 'total': total,
+         'percentage': round(percentage(attended, total), 2)}
+        for student_id, (attended, total) in sorted(counts.items())
+    ])
+
+@app.route('/api/discipline/<int:discipline_id>/practice_stats', methods=['GET'])
+@versioned(lambda discipline_id: [(PRACTICE_STATS_RESOURCE, discipline_id)])
+def get_discipline_practice_stats(discipline_id):
+    """Сколько студентов сдали каждую практику дисциплины"""
+    conn = get_db_connection()
+    counts = practice_counts(conn.cursor(), discipline_id)
+    return jsonify([{'practice_number': number, 'students': students} for number, students in sorted(counts.items())])
+
 @app.route('/api/teacher/grade/set', methods=['POST'])
 def set_grade():
     """Выставление оценки"""
@@ -167,9 +414,16 @@ def set_grade():
     else:
         grade = int(grade)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+    is_update = save_grade(get_db_connection(), student_id, teacher_id, discipline_id, ktp_id, grade, date)
+    return jsonify({'success': True, 'is_update': is_update})
+
+@retry_on_busy
+def save_grade(conn, student_id, teacher_id, discipline_id, ktp_id, grade, date):
+    """Сохраняет оценку в одной транзакции; при ошибке транзакция откатывается"""
+    with conn:
+        return _save_grade(conn.cursor(), student_id, teacher_id, discipline_id, ktp_id, grade, date)
+
+def _save_grade(cursor, student_id, teacher_id, discipline_id, ktp_id, grade, date):
     cursor.execute("SELECT grade_id FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
                   (student_id, discipline_id, ktp_id))
     existing = cursor.fetchone()
@@ -188,23 +442,11 @@ def set_grade():
             VALUES (?, ?, ?, ?, ?, ?)
         """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
     
-    if grade != -1:
-        cursor.execute("SELECT tokens_per_attendance FROM teachers WHERE teacher_id = ?", (teacher_id,))
-        result = cursor.fetchone()
-        if result:
-            tokens_per_attendance = result[0]
-            cursor.execute("""
-                UPDATE student_teacher 
-                SET tokens = tokens + ? 
-                WHERE student_id = ? AND teacher_id = ?
-            """, (tokens_per_attendance, student_id, teacher_id))
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'success': True, 'is_update': is_update})
+    # Жетоны начисляет бот: правила token_rules обрабатывают журнал событий оценок
+    return is_update
 
 @app.route('/api/admin/stats', methods=['GET'])
+@versioned(lambda: [('students', 0), ('teachers', 0), ('disciplines', 0), ('grades', 0), ('users', 0)])
 def get_admin_stats():
     """Статистика для администратора"""
     conn = get_db_connection()
@@ -225,7 +467,6 @@ def get_admin_stats():
     cursor.execute("SELECT role, COUNT(*) as count FROM users GROUP BY role")
     role_distribution = {row['role']: row['count'] for row in cursor.fetchall()}
     
-    conn.close()
     
     return jsonify({
         'students_count': students_count,
@@ -1,3 +1,5 @@
+import io
+import json
 import os
 import sqlite3
 import pandas as pd
@@ -13,25 +15,31 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
-    FSInputFile
+    FSInputFile,
+    BufferedInputFile
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 import logging
 import uuid
+import tempfile
+from functools import partial
 import openpyxl
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
-
-async def notify_student(student_id: int, discipline_name: str, grade: int, date: str, ktp_description: str, teacher_name: str, homework: str = None, is_update: bool = False):
-    grade_str = "н" if grade == -1 else str(grade)
-    action = "изменена" if is_update else "выставлена"
-    message = f"Вам {action} оценка по дисциплине '{discipline_name}' за {date} (КТП: {ktp_description}): {grade_str} (Преподаватель: {teacher_name})"
-    if homework:
-        message += f"\nДомашнее задание: {homework}"
-    try:
-        await bot.send_message(chat_id=student_id, text=message)
-    except Exception as e:
-        logger.error(f"Ошибка отправки уведомления студенту {student_id}: {e}")
+from db import db_task, run_db, close_db, get_connection
+from migrations import migrate
+from excel_export import build_xlsx, grades_xlsx, gradebook_xlsx
+from reports import report_workers, ReportQueueFull, ReportLimitExceeded
+from excel_import import iter_rows, missing_columns
+from broadcast import Broadcaster
+from outbox import Outbox, enqueue
+from delivery_status import PLACEHOLDER, mark_unreachable, reachable, reset_recipient, reset_unreachable
+from send_governor import SendGovernor, bulk_sends
+from roles import RoleMiddleware, role_cache
+from reference_cache import KTP, TEACHER, reference_cache
+from practice_progress import PracticeProgressReconciler
+from practice_stats import get_practice_stats
+from attendance import discipline_attendance, percentage, student_attendance
+from token_engine import TokenRulesRunner, mark_first_finisher, process_pending, rekey_student
+from token_rules import FIRST_FINISHER_TOKENS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -40,216 +48,52 @@ BOT_TOKEN = "8442631201:AAGkUM0m7DE1wk4G1Vt0tDjIS-RbL4bZaQo"
 ADMIN_ID = 1122288946
 
 bot = Bot(token=BOT_TOKEN)
+# Все запросы к Telegram проходят через общий планировщик отправок
+send_governor = SendGovernor()
+bot.session.middleware(send_governor)
 dp = Dispatcher()
-
-conn = sqlite3.connect("students.db", check_same_thread=False)
-cursor = conn.cursor()
-
-def init_db():
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS first_practice_completions (
-        discipline_id INTEGER,
-        student_id INTEGER,
-        tokens INTEGER,
-        awarded_date TEXT,
-        PRIMARY KEY (discipline_id),
-        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id),
-        FOREIGN KEY (student_id) REFERENCES students(student_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS reserved_tokens (
-        student_id INTEGER,
-        teacher_id INTEGER,
-        discipline_id INTEGER,
-        tokens INTEGER DEFAULT 0,
-        notification_message TEXT NOT NULL,
-        PRIMARY KEY (student_id, teacher_id, discipline_id),
-        FOREIGN KEY (student_id) REFERENCES students(student_id),
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
-        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        full_name TEXT,
-        role TEXT CHECK(role IN ('student', 'teacher', 'admin')),
-        group_name TEXT,
-        token TEXT UNIQUE
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS teachers (
-        teacher_id INTEGER PRIMARY KEY,
-        full_name TEXT,
-        token TEXT UNIQUE,
-        tokens_per_attendance INTEGER DEFAULT 1,
-        FOREIGN KEY (teacher_id) REFERENCES users(user_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS students (
-        student_id INTEGER PRIMARY KEY,
-        full_name TEXT,
-        group_name TEXT,
-        FOREIGN KEY (student_id) REFERENCES users(user_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS student_teacher (
-        student_id INTEGER,
-        teacher_id INTEGER,
-        tokens INTEGER DEFAULT 0,
-        PRIMARY KEY (student_id, teacher_id),
-        FOREIGN KEY (student_id) REFERENCES students(student_id),
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS admin_teacher (
-        admin_id INTEGER,
-        teacher_id INTEGER,
-        PRIMARY KEY (admin_id, teacher_id),
-        FOREIGN KEY (admin_id) REFERENCES users(user_id),
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS admin_student (
-        admin_id INTEGER,
-        student_id INTEGER,
-        PRIMARY KEY (admin_id, student_id),
-        FOREIGN KEY (admin_id) REFERENCES users(user_id),
-        FOREIGN KEY (student_id) REFERENCES students(student_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS disciplines (
-        discipline_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        teacher_id INTEGER,
-        name TEXT,
-        group_name TEXT,
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS ktp (
-        ktp_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        teacher_id INTEGER,
-        discipline_id INTEGER,
-        group_name TEXT,
-        type TEXT CHECK(type IN ('lecture', 'practice')),
-        description TEXT,
-        practice_number INTEGER,
-        homework TEXT,
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
-        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS grades (
-        grade_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id INTEGER,
-        teacher_id INTEGER,
-        discipline_id INTEGER,
-        ktp_id INTEGER,
-        grade INTEGER CHECK(grade IN (0, 1, 2, 3, 4, 5, -1)),
-        date TEXT,
-        FOREIGN KEY (student_id) REFERENCES students(student_id),
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
-        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id),
-        FOREIGN KEY (ktp_id) REFERENCES ktp(ktp_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS student_groups (
-        group_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        teacher_id INTEGER,
-        group_name TEXT,
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS group_students (
-        group_id INTEGER,
-        student_id INTEGER,
-        PRIMARY KEY (group_id, student_id),
-        FOREIGN KEY (group_id) REFERENCES student_groups(group_id),
-        FOREIGN KEY (student_id) REFERENCES students(student_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS rewards (
-        reward_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        teacher_id INTEGER,
-        discipline_id INTEGER,
-        name TEXT,
-        description TEXT,
-        price INTEGER,
-        is_enabled INTEGER DEFAULT 1,
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
-        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id)
-    )
-    """)
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS purchased_rewards (
-        purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        student_id INTEGER,
-        reward_id INTEGER,
-        teacher_id INTEGER,
-        purchase_date TEXT,
-        FOREIGN KEY (student_id) REFERENCES students(student_id),
-        FOREIGN KEY (reward_id) REFERENCES rewards(reward_id),
-        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
-    )
-    """)
-    
+# Роль автора апдейта (role) определяется один раз, до фильтров, из кэша
+dp.message.outer_middleware(RoleMiddleware())
+dp.callback_query.outer_middleware(RoleMiddleware())
+broadcaster = Broadcaster(bot)
+notification_outbox = Outbox(bot)
+practice_reconciler = PracticeProgressReconciler()
+# Жетоны за оценки, выставленные через API
+token_rules_runner = TokenRulesRunner(on_processed=notification_outbox.wake)
+
+# Ответы, когда отчет (ведомость, выгрузка оценок) не удается сформировать сразу
+REPORT_WAIT_MESSAGE = "Ваш отчет готовится, это может занять немного времени."
+REPORT_QUEUE_FULL_MESSAGE = "Сейчас формируется слишком много отчетов. Попробуйте через пару минут."
+REPORT_LIMIT_MESSAGE = "Дождитесь готовности предыдущих отчетов."
+
+# Загруженные файлы: до UPLOAD_SPOOL_SIZE хранятся в памяти, больше - во временном файле
+# с уникальным именем; файлы больше UPLOAD_MAX_SIZE не принимаются
+UPLOAD_MAX_SIZE = int(os.environ.get('UPLOAD_MAX_SIZE', 10 * 1024 * 1024))
+UPLOAD_SPOOL_SIZE = int(os.environ.get('UPLOAD_SPOOL_SIZE', 1024 * 1024))
+UPLOAD_TOO_LARGE_MESSAGE = f"Файл слишком большой (максимум {UPLOAD_MAX_SIZE // (1024 * 1024)} МБ)."
+
+class UploadTooLarge(Exception):
+    pass
+
+# Скачивает файл из Telegram в буфер; буфер закрывает вызывающий
+async def download_upload(file_id: str, file_size: int = None):
+    if file_size and file_size > UPLOAD_MAX_SIZE:
+        raise UploadTooLarge()
+    buffer = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, suffix=".xlsx")
     try:
-        cursor.execute("ALTER TABLE disciplines ADD COLUMN required_practices INTEGER")
-        logger.info("Столбец 'required_practices' успешно добавлен в таблицу disciplines.")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            logger.info("Столбец 'required_practices' уже существует в таблице disciplines.")
-        else:
-            raise
-
-    # Миграция: добавление столбца homework
-    try:
-        cursor.execute("ALTER TABLE ktp ADD COLUMN homework TEXT")
-        logger.info("Столбец 'homework' успешно добавлен в таблицу ktp.")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            logger.info("Столбец 'homework' уже существует в таблице ktp.")
-        else:
-            logger.error(f"Ошибка при добавлении столбца 'homework': {e}")
-            raise
-
-    # Миграция: добавление столбца type
-    try:
-        cursor.execute("ALTER TABLE ktp ADD COLUMN type TEXT CHECK(type IN ('lecture', 'practice'))")
-        logger.info("Столбец 'type' успешно добавлен в таблицу ktp.")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            logger.info("Столбец 'type' уже существует в таблице ktp.")
-        else:
-            logger.error(f"Ошибка при добавлении столбца 'type': {e}")
-            raise
-
-    # Миграция: добавление столбца practice_number
-    try:
-        cursor.execute("ALTER TABLE ktp ADD COLUMN practice_number INTEGER")
-        logger.info("Столбец 'practice_number' успешно добавлен в таблицу ktp.")
-    except sqlite3.OperationalError as e:
-        if "duplicate column name" in str(e):
-            logger.info("Столбец 'practice_number' уже существует в таблице ktp.")
-        else:
-            logger.error(f"Ошибка при добавлении столбца 'practice_number': {e}")
-            raise
-    
-    conn.commit()
-    init_db()
+        await bot.download(file_id, destination=buffer)
+        if buffer.seek(0, io.SEEK_END) > UPLOAD_MAX_SIZE:
+            raise UploadTooLarge()
+        buffer.seek(0)
+    except BaseException:
+        buffer.close()
+        raise
+    return buffer
+
+# Приводит схему БД к последней версии; при актуальной схеме DDL не выполняется
+def init_db():
+    version = migrate(get_connection())
+    logger.info(f"Версия схемы БД: {version}")
 
 class Form(StatesGroup):
     waiting_for_full_name = State()
@@ -298,164 +142,124 @@ class AdminForm(StatesGroup):
     waiting_for_recipient = State()
     waiting_for_news_message = State()
 
-# Функция проверки завершения всех практик
-def check_all_practices_completed(student_id: int, discipline_id: int, teacher_id: int) -> bool:
-    cursor.execute("SELECT required_practices FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    required_practices = cursor.fetchone()[0]
-    
-    if not required_practices or required_practices < 1:
-        return False
-
+# Проверка сдачи практик по дисциплине одним проходом: студенты группы, сдавшие все
+# практики, и среди них первый, кто сдал последнюю практику в день ее проведения, -
+# он получает жетоны (один раз на дисциплину). Обычно победителя уже нашло правило
+# first_finisher (token_rules) при выставлении оценки; проверка нужна для оценок,
+# выставленных до появления правил. Награда и уведомления (через outbox) записываются
+# одной транзакцией. Возвращает (сколько сдали все практики, ФИО победителя или None)
+@db_task
+def award_practice_completions(cursor, discipline_id: int, teacher_id: int, group_name: str):
+    # Сначала правила обрабатывают еще не учтенные оценки (из API)
+    process_pending(cursor)
+    discipline = reference_cache.discipline(cursor, discipline_id)
+    teacher = reference_cache.teacher(cursor, teacher_id)
+    if not discipline or not discipline.required_practices or discipline.required_practices < 1:
+        return 0, None
+
+    # Для каждого сдавшего все практики: дата последней сданной практики и дата проведения
+    # этой практики (первая оценка за нее по дисциплине)
     cursor.execute("""
-    SELECT COUNT(DISTINCT k.practice_number)
-    FROM grades g
-    JOIN ktp k ON g.ktp_id = k.ktp_id
-    WHERE g.student_id = ? AND g.discipline_id = ? AND k.type = 'practice' 
-    AND g.grade >= 1 AND g.grade != -1
-    """, (student_id, discipline_id))
-    
-    completed_practices = cursor.fetchone()[0]
-    return completed_practices >= required_practices
-
-async def award_practice_completion(student_id: int, discipline_id: int, teacher_id: int):
-    # Получаем название дисциплины
-    cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline_name_result = cursor.fetchone()
-    if not discipline_name_result:
-        logger.error(f"Дисциплина с ID {discipline_id} не найдена")
-        return
-    discipline_name = discipline_name_result[0]
-
-    # Получаем ФИО преподавателя
-    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (teacher_id,))
-    teacher_name_result = cursor.fetchone()
-    if not teacher_name_result:
-        logger.error(f"Преподаватель с ID {teacher_id} не найден")
-        return
-    teacher_name = teacher_name_result[0]
-
-    # Получаем ФИО студента
-    cursor.execute("SELECT full_name FROM users WHERE user_id = ? AND role = 'student'", (student_id,))
-    student_name_result = cursor.fetchone()
-    if not student_name_result:
-        logger.error(f"Студент с ID {student_id} не зарегистрирован")
-        student_name = f"Студент ID {student_id}"  # Запасное имя для уведомления
-    else:
-        student_name = student_name_result[0]
+    WITH completed AS (
+        SELECT s.student_id, u.full_name
+        FROM group_students gs
+        JOIN student_groups sg ON gs.group_id = sg.group_id
+        JOIN students s ON gs.student_id = s.student_id
+        JOIN users u ON s.student_id = u.user_id
+        JOIN practice_progress p ON p.student_id = s.student_id AND p.discipline_id = ?
+        WHERE sg.group_name = ? AND sg.teacher_id = ? AND p.completed >= ?
+    ),
+    last_passed AS (
+        SELECT g.student_id, g.date, k.practice_number,
+               ROW_NUMBER() OVER (
+                   PARTITION BY g.student_id
+                   ORDER BY substr(g.date, 7, 4) || substr(g.date, 4, 2) || substr(g.date, 1, 2) DESC, g.grade_id DESC
+               ) AS n
+        FROM grades g
+        JOIN ktp k ON g.ktp_id = k.ktp_id
+        WHERE g.discipline_id = ? AND k.type = 'practice' AND g.grade >= 1
+        AND g.student_id IN (SELECT student_id FROM completed)
+    ),
+    practice_dates AS (
+        SELECT k.practice_number, g.date, ROW_NUMBER() OVER (PARTITION BY k.practice_number ORDER BY g.grade_id) AS n
+        FROM grades g
+        JOIN ktp k ON g.ktp_id = k.ktp_id
+        WHERE g.discipline_id = ? AND k.discipline_id = ? AND k.type = 'practice'
+    )
+    SELECT c.student_id, c.full_name, l.date, d.date,
+           NOT EXISTS (
+               SELECT 1 FROM unreachable_recipients x WHERE x.user_id = c.student_id AND x.reason = ?
+           ) AS registered
+    FROM completed c
+    LEFT JOIN last_passed l ON l.student_id = c.student_id AND l.n = 1
+    LEFT JOIN practice_dates d ON d.practice_number = l.practice_number AND d.n = 1
+    ORDER BY c.full_name
+    """, (discipline_id, group_name, teacher_id, discipline.required_practices,
+          discipline_id, discipline_id, discipline_id, PLACEHOLDER))
+    completed = cursor.fetchall()
 
-    # Проверяем, не был ли уже кто-то отмечен как первый сдавший
     cursor.execute("SELECT student_id FROM first_practice_completions WHERE discipline_id = ?", (discipline_id,))
     first_completion = cursor.fetchone()
-
     if first_completion:
         logger.info(f"Первый сдавший для дисциплины {discipline_id} уже есть: {first_completion[0]}")
-        return  # Если кто-то уже сдал первым, выходим
-
-    # Получаем дату последней сданной практики и соответствующую дату КТП
-    cursor.execute("""
-        SELECT g.date, k.practice_number
-        FROM grades g
-        JOIN ktp k ON g.ktp_id = k.ktp_id
-        WHERE g.student_id = ? AND g.discipline_id = ? AND k.type = 'practice'
-        AND g.grade >= 1 AND g.grade != -1
-        ORDER BY g.date DESC
-        LIMIT 1
-    """, (student_id, discipline_id))
-    last_grade = cursor.fetchone()
-
-    if not last_grade:
-        logger.info(f"У студента {student_id} нет сданных практик для дисциплины {discipline_id}")
-        return
-
-    grade_date, practice_number = last_grade
-
-    # Получаем дату практики из КТП
-    cursor.execute("""
-        SELECT date
-        FROM grades
-        WHERE discipline_id = ? AND ktp_id IN (
-            SELECT ktp_id FROM ktp WHERE discipline_id = ? AND practice_number = ? AND type = 'practice'
-        )
-        LIMIT 1
-    """, (discipline_id, discipline_id, practice_number))
-    practice_date_result = cursor.fetchone()
-
-    if not practice_date_result:
-        logger.error(f"Дата практики для дисциплины {discipline_id} и номера {practice_number} не найдена")
-        return
-
-    practice_date = practice_date_result[0]
-
-    # Проверяем, совпадает ли дата сдачи с датой практики
-    try:
-        grade_date_obj = datetime.strptime(grade_date, "%d-%m-%Y")
-        practice_date_obj = datetime.strptime(practice_date, "%d-%m-%Y")
-        if grade_date_obj.date() != practice_date_obj.date():
-            logger.info(f"Студент {student_id} сдал практику не в день практики: {grade_date} != {practice_date}")
-            return
-    except ValueError as e:
-        logger.error(f"Ошибка формата даты: {e}")
-        return
-
-    # Проверяем, все ли практики сданы
-    if not check_all_practices_completed(student_id, discipline_id, teacher_id):
-        logger.info(f"Студент {student_id} не сдал все практики для дисциплины {discipline_id}")
-        return
-
-    # Если все проверки пройдены, начисляем жетоны
-    tokens = 15
-    message = f"Поздравляем! Вы сдали все практики по дисциплине '{discipline_name}' первыми и вовремя. Вам начислено {tokens} жетончиков."
+        return len(completed), None
+    if not teacher or teacher.full_name is None:
+        logger.error(f"Преподаватель с ID {teacher_id} не найден")
+        return len(completed), None
 
-    # Регистрируем студента как первого сдавшего
+    # Сдавшие последнюю практику в день ее проведения; первым считается сдавший раньше
+    on_time = []
+    for position, (student_id, full_name, grade_date, practice_date, registered) in enumerate(completed):
+        if grade_date is None or practice_date is None:
+            continue
+        try:
+            grade_day = datetime.strptime(grade_date, "%d-%m-%Y").date()
+            practice_day = datetime.strptime(practice_date, "%d-%m-%Y").date()
+        except ValueError as e:
+            logger.error(f"Ошибка формата даты: {e}")
+            continue
+        if grade_day == practice_day:
+            on_time.append((grade_day, position, student_id, full_name, registered))
+    if not on_time:
+        return len(completed), None
+    _, _, student_id, student_name, registered = min(on_time)
+
+    tokens = FIRST_FINISHER_TOKENS
+    message = f"Поздравляем! Вы сдали все практики по дисциплине '{discipline.name}' первыми и вовремя. Вам начислено {tokens} жетончиков."
     cursor.execute("""
         INSERT OR IGNORE INTO first_practice_completions (discipline_id, student_id, tokens, awarded_date)
         VALUES (?, ?, ?, ?)
     """, (discipline_id, student_id, tokens, datetime.now().strftime("%d-%m-%Y")))
+    mark_first_finisher(cursor, discipline_id)
 
-    # Проверяем, зарегистрирован ли студент
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ? AND role = 'student'", (student_id,))
-    if cursor.fetchone():
+    if registered:
         cursor.execute("""
             UPDATE student_teacher 
             SET tokens = tokens + ? 
             WHERE student_id = ? AND teacher_id = ?
         """, (tokens, student_id, teacher_id))
-        try:
-            await bot.send_message(student_id, message)
-            await bot.send_message(teacher_id, f"Студент {student_name} сдал все практики по '{discipline_name}' первым и вовремя, получил {tokens} жетончиков.")
-        except Exception as e:
-            logger.error(f"Ошибка отправки уведомления студенту {student_id} или преподавателю {teacher_id}: {e}")
+        enqueue(cursor, student_id, message, kind="practice")
+        enqueue(cursor, teacher_id,
+                f"Студент {student_name} сдал все практики по '{discipline.name}' первым и вовремя, получил {tokens} жетончиков.",
+                kind="practice")
     else:
+        # Жетоны и уведомление студент получит при регистрации
         cursor.execute("""
             INSERT OR REPLACE INTO reserved_tokens (student_id, teacher_id, discipline_id, tokens, notification_message)
             VALUES (?, ?, ?, ?, ?)
         """, (student_id, teacher_id, discipline_id, tokens, message))
-    
-    conn.commit()
+    return len(completed), student_name
 
 def generate_token():
     return str(uuid.uuid4())[:8]
 
-def is_admin(user_id: int) -> bool:
-    cursor.execute("SELECT role FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    return result and result[0] == "admin"
-
-def is_teacher(user_id: int) -> bool:
-    cursor.execute("SELECT role FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    return result and result[0] == "teacher"
-
-def is_student(user_id: int) -> bool:
-    cursor.execute("SELECT role FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    return result and result[0] == "student"
-
-def get_user_info(user_id: int):
+@db_task
+def get_user_info(cursor, user_id: int):
     cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
     return cursor.fetchone()
 
-def get_student_teachers(student_id: int):
+@db_task
+def get_student_teachers(cursor, student_id: int):
     cursor.execute("""
     SELECT t.teacher_id, u.full_name, st.tokens 
     FROM student_teacher st
@@ -465,7 +269,8 @@ def get_student_teachers(student_id: int):
     """, (student_id,))
     return cursor.fetchall()
 
-def get_admin_teachers(admin_id: int):
+@db_task
+def get_admin_teachers(cursor, admin_id: int):
     cursor.execute("""
     SELECT t.teacher_id, u.full_name 
     FROM admin_teacher at
@@ -475,7 +280,8 @@ def get_admin_teachers(admin_id: int):
     """, (admin_id,))
     return cursor.fetchall()
 
-def get_admin_students(admin_id: int):
+@db_task
+def get_admin_students(cursor, admin_id: int):
     cursor.execute("""
     SELECT s.student_id, u.full_name, s.group_name 
     FROM students s
@@ -486,7 +292,8 @@ def get_admin_students(admin_id: int):
     """, (admin_id,))
     return cursor.fetchall()
 
-def get_teacher_students(teacher_id: int, group_name: str = None):
+@db_task
+def get_teacher_students(cursor, teacher_id: int, group_name: str = None):
     query = """
     SELECT DISTINCT s.student_id, u.full_name, s.group_name 
     FROM students s
@@ -502,15 +309,18 @@ def get_teacher_students(teacher_id: int, group_name: str = None):
     cursor.execute(query, params)
     return cursor.fetchall()
 
-def get_teacher_disciplines(teacher_id: int):
+@db_task
+def get_teacher_disciplines(cursor, teacher_id: int):
     cursor.execute("SELECT discipline_id, name, group_name FROM disciplines WHERE teacher_id = ? ORDER BY name", (teacher_id,))
     return cursor.fetchall()
 
-def get_teacher_groups(teacher_id: int):
+@db_task
+def get_teacher_groups(cursor, teacher_id: int):
     cursor.execute("SELECT DISTINCT group_name FROM student_groups WHERE teacher_id = ? ORDER BY group_name", (teacher_id,))
     return [row[0] for row in cursor.fetchall()]
 
-def get_student_grades(student_id: int):
+@db_task
+def get_student_grades(cursor, student_id: int):
     cursor.execute("""
     SELECT g.grade, g.date, d.name, u.full_name, COALESCE(k.description, 'Нет описания КТП') as description, COALESCE(k.homework, 'Нет домашнего задания') as homework
     FROM grades g
@@ -524,7 +334,8 @@ def get_student_grades(student_id: int):
     logger.info(f"All grades for student {student_id}: {grades}")
     return grades
 
-def get_student_info(student_id: int):
+@db_task
+def get_student_info(cursor, student_id: int):
     cursor.execute("""
     SELECT s.student_id, u.full_name, s.group_name 
     FROM students s
@@ -533,7 +344,8 @@ def get_student_info(student_id: int):
     """, (student_id,))
     return cursor.fetchone()
 
-def get_teacher_info(teacher_id: int):
+@db_task
+def get_teacher_info(cursor, teacher_id: int):
     cursor.execute("""
     SELECT t.teacher_id, u.full_name 
     FROM teachers t
@@ -542,19 +354,23 @@ def get_teacher_info(teacher_id: int):
     """, (teacher_id,))
     return cursor.fetchone()
 
-def is_student_linked(student_id: int, teacher_id: int):
+@db_task
+def is_student_linked(cursor, student_id: int, teacher_id: int):
     cursor.execute("SELECT 1 FROM student_teacher WHERE student_id = ? AND teacher_id = ?", (student_id, teacher_id))
     return cursor.fetchone() is not None
 
-def is_teacher_linked(admin_id: int, teacher_id: int):
+@db_task
+def is_teacher_linked(cursor, admin_id: int, teacher_id: int):
     cursor.execute("SELECT 1 FROM admin_teacher WHERE admin_id = ? AND teacher_id = ?", (admin_id, teacher_id))
     return cursor.fetchone() is not None
 
-def is_student_linked_to_admin(admin_id: int, student_id: int):
+@db_task
+def is_student_linked_to_admin(cursor, admin_id: int, student_id: int):
     cursor.execute("SELECT 1 FROM admin_student WHERE admin_id = ? AND student_id = ?", (admin_id, student_id))
     return cursor.fetchone() is not None
 
-def get_group_students(group_name: str, teacher_id: int):
+@db_task
+def get_group_students(cursor, group_name: str, teacher_id: int):
     cursor.execute("""
     SELECT s.student_id, u.full_name 
     FROM group_students gs
@@ -566,7 +382,8 @@ def get_group_students(group_name: str, teacher_id: int):
     """, (group_name, teacher_id))
     return cursor.fetchall()
 
-def get_teacher_rewards(teacher_id: int):
+@db_task
+def get_teacher_rewards(cursor, teacher_id: int):
     cursor.execute("""
     SELECT r.reward_id, r.name, r.description, r.price, r.is_enabled, d.name
     FROM rewards r
@@ -576,7 +393,8 @@ def get_teacher_rewards(teacher_id: int):
     """, (teacher_id,))
     return cursor.fetchall()
 
-def get_student_rewards(student_id: int):
+@db_task
+def get_student_rewards(cursor, student_id: int):
     cursor.execute("""
     SELECT r.reward_id, r.name, r.description, r.price, u.full_name, d.name, r.teacher_id
     FROM rewards r
@@ -588,7 +406,8 @@ def get_student_rewards(student_id: int):
     """, (student_id,))
     return cursor.fetchall()
 
-def get_ktp_by_discipline_and_type(teacher_id: int, discipline_id: int, ktp_type: str):
+@db_task
+def get_ktp_by_discipline_and_type(cursor, teacher_id: int, discipline_id: int, ktp_type: str):
     query = """
     SELECT k.ktp_id, k.group_name, k.type, k.description, k.practice_number
     FROM ktp k
@@ -599,59 +418,549 @@ def get_ktp_by_discipline_and_type(teacher_id: int, discipline_id: int, ktp_type
     cursor.execute(query, params)
     return cursor.fetchall()
 
-def get_student_token_balance(student_id: int, teacher_id: int):
+@db_task
+def get_student_token_balance(cursor, student_id: int, teacher_id: int):
     cursor.execute("SELECT tokens FROM student_teacher WHERE student_id = ? AND teacher_id = ?", (student_id, teacher_id))
     result = cursor.fetchone()
     return result[0] if result else 0
 
-def get_student_attendance_percentage(student_id: int, discipline_id: int):
+# Посещаемость студента по всем дисциплинам: [(discipline_id, название, посещено, всего)]
+@db_task
+def get_student_attendance(cursor, student_id: int):
+    return student_attendance(cursor, student_id)
+
+@db_task
+def register_admin(cursor, user_id: int):
+    cursor.execute("INSERT OR IGNORE INTO users (user_id, role) VALUES (?, 'admin')", (user_id,))
+    reset_unreachable(cursor, user_id)
+
+# Регистрирует студента и начисляет зарезервированные жетоны; возвращает (student_id, зарезервированные начисления)
+@db_task
+def register_student(cursor, user_id: int, username: str, full_name: str, group_name: str):
+    cursor.execute("SELECT student_id FROM students WHERE full_name = ? AND group_name = ?", (full_name, group_name))
+    student = cursor.fetchone()
+    
+    if student:
+        old_student_id = student[0]
+        cursor.execute("UPDATE students SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        cursor.execute("UPDATE users SET user_id = ?, full_name = ?, group_name = ?, role = 'student' WHERE user_id = ?",
+                      (user_id, full_name, group_name, old_student_id))
+        cursor.execute("UPDATE student_teacher SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        cursor.execute("UPDATE admin_student SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        cursor.execute("UPDATE group_students SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        cursor.execute("UPDATE grades SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        rekey_student(cursor, old_student_id, user_id)
+        cursor.execute("UPDATE purchased_rewards SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        cursor.execute("UPDATE reserved_tokens SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
+        reset_unreachable(cursor, old_student_id)
+        student_id = user_id
+    else:
+        cursor.execute("SELECT student_id FROM students WHERE full_name = ?", (full_name,))
+        existing_student = cursor.fetchone()
+        if existing_student:
+            student_id = existing_student[0]
+            cursor.execute("UPDATE students SET group_name = ? WHERE student_id = ?", (group_name, student_id))
+            cursor.execute("UPDATE users SET user_id = ?, full_name = ?, group_name = ?, role = 'student' WHERE user_id = ?",
+                          (user_id, full_name, group_name, student_id))
+        else:
+            cursor.execute("INSERT INTO users (user_id, username, full_name, role, group_name) VALUES (?, ?, ?, 'student', ?)", 
+                          (user_id, username, full_name, group_name))
+            cursor.execute("INSERT INTO students (student_id, full_name, group_name) VALUES (?, ?, ?)", 
+                          (user_id, full_name, group_name))
+            student_id = user_id
+    
+    cursor.execute("INSERT OR IGNORE INTO admin_student (admin_id, student_id) VALUES (?, ?)", 
+                  (ADMIN_ID, student_id))
+    reset_unreachable(cursor, user_id)
+    
     cursor.execute("""
-    SELECT COUNT(*) 
-    FROM grades 
-    WHERE student_id = ? AND discipline_id = ? AND grade != -1
-    """, (student_id, discipline_id))
-    attended = cursor.fetchone()[0]
+    SELECT DISTINCT t.teacher_id
+    FROM student_groups sg
+    JOIN teachers t ON sg.teacher_id = t.teacher_id
+    WHERE sg.group_name = ?
+    """, (group_name,))
+    teachers = cursor.fetchall()
     
+    for (teacher_id,) in teachers:
+        if not is_student_linked.__wrapped__(cursor, student_id, teacher_id):
+            cursor.execute("INSERT OR IGNORE INTO student_teacher (student_id, teacher_id, tokens) VALUES (?, ?, 0)", 
+                          (student_id, teacher_id))
+        
+        cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", 
+                      (teacher_id, group_name))
+        group = cursor.fetchone()
+        if group:
+            group_id = group[0]
+            cursor.execute("INSERT OR IGNORE INTO group_students (group_id, student_id) VALUES (?, ?)", 
+                          (group_id, student_id))
+    
+    # Начисление зарезервированных жетонов
     cursor.execute("""
-    SELECT COUNT(*) 
-    FROM grades 
-    WHERE student_id = ? AND discipline_id = ?
-    """, (student_id, discipline_id))
-    total = cursor.fetchone()[0]
-    
-    return (attended / total * 100) if total > 0 else 0
-
-def create_grades_excel(student_id: int):
-    grades = get_student_grades(student_id)
-    df = pd.DataFrame(grades, columns=["Оценка", "Дата", "Дисциплина", "Преподаватель", "Описание КТП", "Домашнее задание"])
-    df["Оценка"] = df["Оценка"].replace(-1, "н")
-    
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Оценки"
-    
-    headers = ["Оценка", "Дата", "Дисциплина", "Преподаватель", "Описание КТП", "Домашнее задание"]
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_num, value=header)
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal='center')
-    
-    for row_num, row_data in enumerate(grades, 2):
-        for col_num, value in enumerate(row_data, 1):
-            cell = ws.cell(row=row_num, column=col_num, value="н" if value == -1 else value)
-            cell.alignment = Alignment(horizontal='center')
-    
-    for col_num in range(1, len(headers) + 1):
-        col_letter = get_column_letter(col_num)
-        max_length = max(
-            len(str(ws.cell(row=row, column=col_num).value or "")) for row in range(1, ws.max_row + 1)
-        )
-        adjusted_width = max_length + 2
-        ws.column_dimensions[col_letter].width = adjusted_width
+    SELECT teacher_id, discipline_id, tokens, notification_message
+    FROM reserved_tokens
+    WHERE student_id = ?
+    """, (student_id,))
+    reserved = cursor.fetchall()
+    
+    for teacher_id, discipline_id, tokens, notification_message in reserved:
+        cursor.execute("""
+        UPDATE student_teacher 
+        SET tokens = tokens + ? 
+        WHERE student_id = ? AND teacher_id = ?
+        """, (tokens, student_id, teacher_id))
     
+    cursor.execute("DELETE FROM reserved_tokens WHERE student_id = ?", (student_id,))
+    return student_id, reserved
+
+# Привязывает пользователя к преподавателю по токену; возвращает ФИО или None
+@db_task
+def register_teacher(cursor, user_id: int, username: str, token: str):
+    cursor.execute("SELECT teacher_id, full_name FROM teachers WHERE token = ?", (token,))
+    teacher = cursor.fetchone()
+    if not teacher:
+        return None
+    
+    teacher_id, full_name = teacher
+    cursor.execute("INSERT OR REPLACE INTO users (user_id, username, full_name, role) VALUES (?, ?, ?, 'teacher')", 
+                  (user_id, username, full_name))
+    cursor.execute("UPDATE teachers SET teacher_id = ? WHERE token = ?", (user_id, token))
+    cursor.execute("INSERT OR IGNORE INTO admin_teacher (admin_id, teacher_id) VALUES (?, ?)", 
+                  (ADMIN_ID, user_id))
+    reset_unreachable(cursor, user_id)
+    return full_name
+
+# Токены, которых еще нет у преподавателей; count штук без повторов
+def generate_unique_tokens(cursor, count: int):
+    tokens = set()
+    while len(tokens) < count:
+        candidates = {generate_token() for _ in range(count - len(tokens))} - tokens
+        cursor.execute("SELECT token FROM teachers WHERE token IN (SELECT value FROM json_each(?))",
+                      (json.dumps(list(candidates)),))
+        tokens |= candidates - {token for token, in cursor.fetchall()}
+    return list(tokens)
+
+# Добавляет преподавателей, которых еще нет в БД, одним пакетом; возвращает число добавленных
+@db_task
+def import_teachers(cursor, admin_id: int, names: list):
+    names = list(dict.fromkeys(names))  # без повторов, в порядке файла
+    cursor.execute("SELECT full_name FROM teachers WHERE full_name IN (SELECT value FROM json_each(?))",
+                  (json.dumps(names),))
+    existing = {full_name for full_name, in cursor.fetchall()}
+    new_names = [full_name for full_name in names if full_name not in existing]
+    if not new_names:
+        return 0
+    
+    tokens = generate_unique_tokens(cursor, len(new_names))
+    cursor.executemany("INSERT INTO teachers (full_name, token, tokens_per_attendance) VALUES (?, ?, 1)",
+                       zip(new_names, tokens))
+    cursor.execute("""
+    INSERT OR IGNORE INTO admin_teacher (admin_id, teacher_id)
+    SELECT ?, teacher_id FROM teachers WHERE token IN (SELECT value FROM json_each(?))
+    """, (admin_id, json.dumps(tokens)))
+    return len(new_names)
+
+# Импорт списка студентов из Excel: файл читается построчно во временную таблицу,
+# вставки и связи делаются несколькими запросами на весь список.
+# Возвращает (новых студентов, уже были в базе, пропущено пустых строк)
+@db_task
+def import_students(cursor, teacher_id: int, group_name: str, source):
+    skipped = 0
+    
+    def rows():
+        nonlocal skipped
+        for full_name, student_group in iter_rows(source, ["ФИО студента", "Группа"]):
+            if not full_name:
+                skipped += 1
+                continue
+            yield full_name, student_group or group_name
+    
+    # Временная таблица видна только соединению этого потока
+    cursor.execute("""
+    CREATE TEMP TABLE IF NOT EXISTS import_students (
+        full_name TEXT NOT NULL,
+        group_name TEXT NOT NULL,
+        student_id INTEGER,
+        is_new INTEGER DEFAULT 0,
+        PRIMARY KEY (full_name, group_name)
+    )
+    """)
+    cursor.execute("DELETE FROM import_students")
+    cursor.executemany("INSERT OR IGNORE INTO import_students (full_name, group_name) VALUES (?, ?)", rows())
+    
+    find_students = """
+    UPDATE import_students SET student_id = (
+        SELECT MIN(s.student_id) FROM students s
+        WHERE s.full_name = import_students.full_name AND s.group_name = import_students.group_name
+    )
+    WHERE student_id IS NULL
+    """
+    cursor.execute(find_students)
+    # Новые студенты получают id в порядке строк файла
+    cursor.execute("""
+    INSERT INTO students (full_name, group_name)
+    SELECT full_name, group_name FROM import_students WHERE student_id IS NULL ORDER BY rowid
+    """)
+    added = cursor.rowcount
+    cursor.execute("UPDATE import_students SET is_new = 1 WHERE student_id IS NULL")
+    cursor.execute(find_students)
+    
+    cursor.execute("""
+    INSERT OR IGNORE INTO users (user_id, full_name, role, group_name)
+    SELECT student_id, full_name, 'student', group_name FROM import_students WHERE is_new = 1
+    """)
+    cursor.execute("""
+    INSERT OR IGNORE INTO admin_student (admin_id, student_id)
+    SELECT ?, student_id FROM import_students WHERE is_new = 1
+    """, (ADMIN_ID,))
+    # id новых студентов - не id Telegram, писать им нельзя до регистрации
+    cursor.execute("SELECT student_id FROM import_students WHERE is_new = 1")
+    mark_unreachable(cursor, [(student_id, PLACEHOLDER, None) for student_id, in cursor.fetchall()])
+    
+    cursor.execute("INSERT OR IGNORE INTO student_groups (teacher_id, group_name) VALUES (?, ?)", (teacher_id, group_name))
+    cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", (teacher_id, group_name))
+    group_id = cursor.fetchone()[0]
+    cursor.execute("""
+    INSERT OR IGNORE INTO group_students (group_id, student_id)
+    SELECT ?, student_id FROM import_students
+    """, (group_id,))
+    cursor.execute("""
+    INSERT OR IGNORE INTO student_teacher (student_id, teacher_id, tokens)
+    SELECT student_id, ?, 0 FROM import_students
+    """, (teacher_id,))
+    
+    cursor.execute("SELECT COUNT(*) FROM import_students")
+    existing = cursor.fetchone()[0] - added
+    cursor.execute("DELETE FROM import_students")
+    return added, existing, skipped
+
+@db_task
+def add_student_to_group(cursor, teacher_id: int, full_name: str, group_name: str):
+    cursor.execute("SELECT student_id FROM students WHERE full_name = ? AND group_name = ?", (full_name, group_name))
+    existing_student = cursor.fetchone()
+    
+    if existing_student:
+        student_id = existing_student[0]
+    else:
+        cursor.execute("INSERT INTO students (full_name, group_name) VALUES (?, ?)", (full_name, group_name))
+        student_id = cursor.lastrowid
+        cursor.execute("INSERT OR IGNORE INTO users (user_id, full_name, role, group_name) VALUES (?, ?, 'student', ?)", 
+                      (student_id, full_name, group_name))
+        cursor.execute("INSERT OR IGNORE INTO admin_student (admin_id, student_id) VALUES (?, ?)", 
+                      (ADMIN_ID, student_id))
+        mark_unreachable(cursor, [(student_id, PLACEHOLDER, None)])
+    
+    cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", 
+                  (teacher_id, group_name))
+    group = cursor.fetchone()
+    
+    if group:
+        group_id = group[0]
+        cursor.execute("INSERT OR IGNORE INTO group_students (group_id, student_id) VALUES (?, ?)", (group_id, student_id))
+    
+    if not is_student_linked.__wrapped__(cursor, student_id, teacher_id):
+        cursor.execute("INSERT OR IGNORE INTO student_teacher (student_id, teacher_id, tokens) VALUES (?, ?, 0)", 
+                      (student_id, teacher_id))
+    
+
+@db_task
+def get_discipline(cursor, discipline_id: int, teacher_id: int = None):
+    discipline = reference_cache.discipline(cursor, discipline_id)
+    if not discipline or (teacher_id is not None and discipline.teacher_id != teacher_id):
+        return None
+    return discipline.name, discipline.group_name
+
+@db_task
+def add_discipline(cursor, teacher_id: int, name: str, group_name: str, required_practices: int):
+    cursor.execute("""
+    INSERT INTO disciplines (teacher_id, name, group_name, required_practices)
+    VALUES (?, ?, ?, ?)
+    """, (teacher_id, name, group_name, required_practices))
+
+@db_task
+def remove_discipline(cursor, discipline_id: int):
+    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
+    discipline = cursor.fetchone()
+    
+    if discipline:
+        cursor.execute("DELETE FROM grades WHERE discipline_id = ?", (discipline_id,))
+        cursor.execute("DELETE FROM rewards WHERE discipline_id = ?", (discipline_id,))
+        cursor.execute("DELETE FROM ktp WHERE discipline_id = ?", (discipline_id,))
+        cursor.execute("DELETE FROM disciplines WHERE discipline_id = ?", (discipline_id,))
+    return discipline
+
+@db_task
+def get_required_practices(cursor, discipline_id: int):
+    return reference_cache.discipline(cursor, discipline_id).required_practices
+
+@db_task
+def remove_group(cursor, teacher_id: int, group_name: str) -> bool:
+    cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", 
+                  (teacher_id, group_name))
+    group = cursor.fetchone()
+    
+    if not group:
+        return False
+    
+    group_id = group[0]
+    cursor.execute("DELETE FROM group_students WHERE group_id = ?", (group_id,))
+    cursor.execute("DELETE FROM student_groups WHERE group_id = ?", (group_id,))
+    cursor.execute("DELETE FROM disciplines WHERE teacher_id = ? AND group_name = ?", 
+                  (teacher_id, group_name))
+    cursor.execute("DELETE FROM ktp WHERE teacher_id = ? AND group_name = ?", 
+                  (teacher_id, group_name))
+    cursor.execute("DELETE FROM rewards WHERE teacher_id = ? AND discipline_id IN (SELECT discipline_id FROM disciplines WHERE group_name = ?)", 
+                  (teacher_id, group_name))
+    return True
+
+# Создает КТП для всех групп дисциплины
+@db_task
+def add_ktp(cursor, teacher_id: int, discipline_id: int, ktp_type: str, description: str, practice_number: int, homework: str):
+    cursor.execute("SELECT group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
+    groups = [row[0] for row in cursor.fetchall()]
+    
+    for group_name in groups:
+        cursor.execute("""
+        INSERT INTO ktp (teacher_id, discipline_id, group_name, type, description, practice_number, homework)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (teacher_id, discipline_id, group_name, ktp_type, description, practice_number, homework))
+    
+
+# Удаляет КТП вместе с оценками; возвращает (дисциплина, группа, тип, номер практики) или None
+@db_task
+def remove_ktp(cursor, ktp_id: int):
+    cursor.execute("SELECT discipline_id, group_name, type, description, practice_number FROM ktp WHERE ktp_id = ?", (ktp_id,))
+    ktp = cursor.fetchone()
+    
+    if not ktp:
+        return None
+    
+    discipline_id, group_name, ktp_type, description, practice_number = ktp
+    cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
+    discipline_name = cursor.fetchone()[0]
+    
+    cursor.execute("DELETE FROM grades WHERE ktp_id = ?", (ktp_id,))
+    cursor.execute("DELETE FROM ktp WHERE ktp_id = ?", (ktp_id,))
+    return discipline_name, group_name, ktp_type, practice_number
+
+@db_task
+def get_tokens_per_attendance(cursor, teacher_id: int):
+    return reference_cache.teacher(cursor, teacher_id).tokens_per_attendance
+
+@db_task
+def set_tokens_per_attendance(cursor, teacher_id: int, tokens: int):
+    cursor.execute("UPDATE teachers SET tokens_per_attendance = ? WHERE teacher_id = ?", (tokens, teacher_id))
+
+# Ставит уведомление об оценке в outbox в транзакции оценки; вызывается внутри задач БД.
+# Отправка - после фиксации, см. notification_outbox. Справочные данные - из кэша
+def notify_student(cursor, student_id: int, discipline_id: int, ktp_id: int, teacher_id: int, grade: int, date: str, is_update: bool = False):
+    discipline_name = reference_cache.discipline(cursor, discipline_id).name
+    ktp = reference_cache.ktp(cursor, ktp_id)
+    teacher_name = reference_cache.teacher(cursor, teacher_id).full_name
+    
+    grade_str = "н" if grade == -1 else str(grade)
+    action = "изменена" if is_update else "выставлена"
+    message = f"Вам {action} оценка по дисциплине '{discipline_name}' за {date} (КТП: {ktp.description}): {grade_str} (Преподаватель: {teacher_name})"
+    if ktp.homework:
+        message += f"\nДомашнее задание: {ktp.homework}"
+    enqueue(cursor, student_id, message, kind="grade", digest=True)
+
+# Жетоны за оценки начисляют правила token_rules: process_pending обрабатывает
+# события оценки (их пишут триггеры) в той же транзакции
+
+# Быстрое выставление: всегда новая оценка
+@db_task
+def add_grade(cursor, student_id: int, teacher_id: int, discipline_id: int, ktp_id: int, grade: int, date: str):
+    cursor.execute("""
+    INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
+    VALUES (?, ?, ?, ?, ?, ?)
+    """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
+    
+    notify_student(cursor, student_id, discipline_id, ktp_id, teacher_id, grade, date)
+    process_pending(cursor)
+
+# Одиночное выставление: новая оценка или замена существующей; возвращает is_update
+@db_task
+def save_grade(cursor, student_id: int, teacher_id: int, discipline_id: int, ktp_id: int, grade: int, date: str):
+    cursor.execute("SELECT grade_id FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
+                  (student_id, discipline_id, ktp_id))
+    existing_grade = cursor.fetchone()
+    
+    is_update = bool(existing_grade)
+    if not existing_grade:
+        cursor.execute("""
+        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
+    else:
+        cursor.execute("""
+        UPDATE grades 
+        SET grade = ?, date = ? 
+        WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?
+        """, (grade, date, student_id, discipline_id, ktp_id))
+    
+    notify_student(cursor, student_id, discipline_id, ktp_id, teacher_id, grade, date, is_update)
+    process_pending(cursor)
+    return is_update
+
+# Редактирование оценки; возвращает is_update
+@db_task
+def edit_grade(cursor, student_id: int, teacher_id: int, discipline_id: int, ktp_id: int, grade: int, date: str):
+    cursor.execute("SELECT grade_id FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
+                  (student_id, discipline_id, ktp_id))
+    existing_grade = cursor.fetchone()
+    
+    is_update = bool(existing_grade)
+    
+    if is_update:
+        cursor.execute("""
+        UPDATE grades 
+        SET grade = ?, date = ? 
+        WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?
+        """, (grade, date, student_id, discipline_id, ktp_id))
+    else:
+        cursor.execute("""
+        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
+    
+    notify_student(cursor, student_id, discipline_id, ktp_id, teacher_id, grade, date, is_update)
+    process_pending(cursor)
+    return is_update
+
+# КТП с оценками за дату: (ktp_id, discipline_id, group_name, description, название дисциплины)
+@db_task
+def get_graded_ktps(cursor, teacher_id: int, date: str, discipline_id: int):
+    cursor.execute("""
+    SELECT DISTINCT k.ktp_id, k.discipline_id, k.group_name, k.description, d.name
+    FROM ktp k
+    JOIN grades g ON k.ktp_id = g.ktp_id
+    JOIN disciplines d ON k.discipline_id = d.discipline_id
+    WHERE k.teacher_id = ? AND g.date = ? AND k.discipline_id = ?
+    """, (teacher_id, date, discipline_id))
+    return cursor.fetchall()
+
+# Оценки по КТП: {student_id: grade}
+@db_task
+def get_ktp_grades(cursor, discipline_id: int, ktp_id: int):
+    cursor.execute("SELECT student_id, grade FROM grades WHERE discipline_id = ? AND ktp_id = ? ORDER BY grade_id",
+                  (discipline_id, ktp_id))
+    grades = {}
+    for student_id, grade in cursor.fetchall():
+        grades.setdefault(student_id, grade)
+    return grades
+
+@db_task
+def add_reward(cursor, teacher_id: int, discipline_id: int, name: str, description: str, price: int):
+    cursor.execute("""
+    INSERT INTO rewards (teacher_id, discipline_id, name, description, price, is_enabled)
+    VALUES (?, ?, ?, ?, ?, 1)
+    """, (teacher_id, discipline_id, name, description, price))
+
+@db_task
+def get_reward(cursor, reward_id: int):
+    cursor.execute("SELECT name, price, discipline_id, is_enabled FROM rewards WHERE reward_id = ?", (reward_id,))
+    return cursor.fetchone()
+
+@db_task
+def set_reward_price(cursor, reward_id: int, price: int):
+    cursor.execute("UPDATE rewards SET price = ? WHERE reward_id = ?", (price, reward_id))
+
+@db_task
+def set_reward_enabled(cursor, reward_id: int, is_enabled: int):
+    cursor.execute("UPDATE rewards SET is_enabled = ? WHERE reward_id = ?", (is_enabled, reward_id))
+
+@db_task
+def remove_reward(cursor, reward_id: int):
+    cursor.execute("DELETE FROM purchased_rewards WHERE reward_id = ?", (reward_id,))
+    cursor.execute("DELETE FROM rewards WHERE reward_id = ?", (reward_id,))
+
+@db_task
+def get_reward_for_purchase(cursor, reward_id: int):
+    cursor.execute("""
+    SELECT r.price, r.name, r.teacher_id, d.name
+    FROM rewards r
+    JOIN disciplines d ON r.discipline_id = d.discipline_id
+    WHERE r.reward_id = ?
+    """, (reward_id,))
+    return cursor.fetchone()
+
+# Списывает жетоны и записывает покупку; возвращает (ФИО преподавателя, ФИО студента)
+@db_task
+def purchase_reward(cursor, student_id: int, reward_id: int, teacher_id: int, price: int):
+    cursor.execute("""
+    UPDATE student_teacher 
+    SET tokens = tokens - ? 
+    WHERE student_id = ? AND teacher_id = ?
+    """, (price, student_id, teacher_id))
+    
+    cursor.execute("""
+    INSERT INTO purchased_rewards (student_id, reward_id, teacher_id, purchase_date)
+    VALUES (?, ?, ?, ?)
+    """, (student_id, reward_id, teacher_id, datetime.now().strftime("%d-%m-%Y")))
+    
+    
+    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (teacher_id,))
+    teacher_name = cursor.fetchone()[0]
+    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (student_id,))
+    student_name = cursor.fetchone()[0]
+    return teacher_name, student_name
+
+# Практики студента по дисциплинам: (название, необходимо, сдано)
+@db_task
+def get_student_practices(cursor, student_id: int):
+    # Дисциплины, связанные со студентом через группу, со счетчиком сданных практик
+    cursor.execute("""
+    SELECT d.name, d.required_practices, COALESCE(p.completed, 0)
+    FROM disciplines d
+    JOIN student_teacher st ON d.teacher_id = st.teacher_id
+    LEFT JOIN practice_progress p ON p.student_id = st.student_id AND p.discipline_id = d.discipline_id
+    WHERE st.student_id = ? AND d.group_name = (SELECT group_name FROM students WHERE student_id = ?)
+    """, (student_id, student_id))
+    return cursor.fetchall()
+
+# Токены всех преподавателей, недостающие генерируются: [(ФИО, токен)]
+@db_task
+def ensure_teacher_tokens(cursor):
+    cursor.execute("SELECT teacher_id, full_name FROM teachers")
+    teachers = cursor.fetchall()
+    
+    tokens = []
+    for teacher_id, full_name in teachers:
+        cursor.execute("SELECT token FROM teachers WHERE teacher_id = ?", (teacher_id,))
+        token = cursor.fetchone()[0]
+        if not token:
+            token = generate_token()
+            cursor.execute("UPDATE teachers SET token = ? WHERE teacher_id = ?", (token, teacher_id))
+        tokens.append((full_name, token))
+    
+    return tokens
+
+@db_task
+def ensure_teacher_token(cursor, teacher_id: int):
+    cursor.execute("SELECT token FROM teachers WHERE teacher_id = ?", (teacher_id,))
+    token = cursor.fetchone()
+    if token:
+        return token[0]
+    new_token = generate_token()
+    cursor.execute("UPDATE teachers SET token = ? WHERE teacher_id = ?", (new_token, teacher_id))
+    return new_token
+
+@db_task
+def get_news_recipients(cursor, recipient: str):
+    cursor.execute(f"SELECT user_id FROM users WHERE (role = ? OR ? = 'all') AND {reachable('user_id')}", 
+                  ('student' if recipient == 'students' else 'teacher' if recipient == 'teachers' else '', recipient))
+    return cursor.fetchall()
+
+@db_task
+def get_group_student_ids(cursor, group_name: str):
+    cursor.execute(f"SELECT student_id FROM students WHERE group_name = ? AND {reachable('student_id')}", (group_name,))
+    return cursor.fetchall()
+
+async def create_grades_excel(student_id: int):
+    grades = await get_student_grades(student_id)
+    data = await report_workers.build(grades_xlsx, grades)
     filename = f"grades_{student_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    wb.save(filename)
-    return filename
+    return filename, data
 
 def create_teachers_template():
     try:
@@ -728,108 +1037,47 @@ def create_students_template():
             os.remove(filename)
         raise ValueError(f"Не удалось создать шаблон студентов: {str(e)}")
 
-def create_gradebook(teacher_id: int, discipline_id: int):
+@db_task
+def get_gradebook_data(cursor, teacher_id: int, discipline_id: int):
     cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
     discipline_name, group_name = cursor.fetchone()
     
-    students = get_group_students(group_name, teacher_id)
+    students = get_group_students.__wrapped__(cursor, group_name, teacher_id)
     
-    # Получаем уникальные комбинации date и ktp_id, где есть оценки
+    # Все оценки дисциплины одним запросом, ведомость строится в процессе отчетов
     cursor.execute("""
-    SELECT DISTINCT g.date, g.ktp_id, k.type, k.practice_number
+    SELECT g.student_id, g.teacher_id, g.date, g.ktp_id, g.grade, k.type, k.practice_number, k.ktp_id IS NOT NULL
     FROM grades g
-    JOIN ktp k ON g.ktp_id = k.ktp_id
-    WHERE g.discipline_id = ? AND g.teacher_id = ? AND g.grade IS NOT NULL AND g.grade != -1
-    ORDER BY g.date, g.ktp_id
-    """, (discipline_id, teacher_id))
-    date_ktp_pairs = cursor.fetchall()
-    
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Ведомость"
-    
-    ws['A1'] = f"Ведомость по дисциплине: {discipline_name}"
-    ws['A1'].font = Font(bold=True)
-    ws['A1'].alignment = Alignment(horizontal='center')
-    ws['A2'] = f"Группа: {group_name}"
-    ws['A2'].font = Font(bold=True)
-    ws['A2'].alignment = Alignment(horizontal='center')
-    
-    # Формируем заголовки: номер, ФИО, даты с номерами КТП, средний балл, посещаемость
-    headers = ["№", "ФИО студента"]
-    ktp_counters = {"lecture": {}, "practice": {}}  # Счетчики для лекций и практик по датам
-    for date, ktp_id, ktp_type, practice_number in date_ktp_pairs:
-        if ktp_type == "lecture":
-            if date not in ktp_counters["lecture"]:
-                ktp_counters["lecture"][date] = 1
-            else:
-                ktp_counters["lecture"][date] += 1
-            header = f"{date} Лекция #{ktp_counters['lecture'][date]}"
-        else:  # practice
-            header = f"{date} Практика #{practice_number or 'N/A'}"
-        headers.append(header)
-    headers += ["Средний балл", "Посещаемость (%)"]
-    
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=4, column=col_num, value=header)
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal='center')
-    
-    student_averages = {}
-    for row_num, (student_id, full_name) in enumerate(students, 5):
-        ws.cell(row=row_num, column=1, value=row_num-4).alignment = Alignment(horizontal='center')
-        ws.cell(row=row_num, column=2, value=full_name).alignment = Alignment(horizontal='center')
-        
-        col_index = 3
-        grades = []
-        for date, ktp_id, ktp_type, practice_number in date_ktp_pairs:
-            cursor.execute("""
-            SELECT grade 
-            FROM grades 
-            WHERE student_id = ? AND discipline_id = ? AND date = ? AND ktp_id = ?
-            """, (student_id, discipline_id, date, ktp_id))
-            grade = cursor.fetchone()
-            grade_value = str(grade[0]) if grade and grade[0] != -1 else ""
-            ws.cell(row=row_num, column=col_index, value=grade_value).alignment = Alignment(horizontal='center')
-            if grade and grade[0] != -1:
-                grades.append(grade[0])
-            col_index += 1
-        
-        avg = sum(grades) / len(grades) if grades else 0
-        student_averages[student_id] = round(avg, 2)
-        ws.cell(row=row_num, column=col_index, value=student_averages[student_id]).alignment = Alignment(horizontal='center')
-        attendance = round(get_student_attendance_percentage(student_id, discipline_id), 2)
-        ws.cell(row=row_num, column=col_index + 1, value=attendance).alignment = Alignment(horizontal='center')
-    
-    for col_num in range(1, len(headers) + 1):
-        col_letter = get_column_letter(col_num)
-        max_length = max(
-            len(str(ws.cell(row=row, column=col_num).value or "")) for row in range(1, ws.max_row + 1)
-        )
-        adjusted_width = max_length + 2
-        ws.column_dimensions[col_letter].width = adjusted_width
-    
+    LEFT JOIN ktp k ON g.ktp_id = k.ktp_id
+    WHERE g.discipline_id = ?
+    ORDER BY g.grade_id
+    """, (discipline_id,))
+    grades = cursor.fetchall()
+    return discipline_name, group_name, students, grades, discipline_attendance(cursor, discipline_id)
+
+async def create_gradebook(teacher_id: int, discipline_id: int):
+    discipline_name, group_name, students, grades, attendance = await get_gradebook_data(teacher_id, discipline_id)
+    data = await report_workers.build(gradebook_xlsx, teacher_id, discipline_name, group_name, students, grades,
+                                      attendance)
     filename = f"gradebook_{discipline_name}_{group_name}_{datetime.now().strftime('%Y%m%d')}.xlsx"
-    wb.save(filename)
-    return filename
+    return filename, data
 
 @dp.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, role: str):
     user_id = message.from_user.id
-    if user_id == ADMIN_ID:
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, role) VALUES (?, 'admin')", (user_id,))
-        conn.commit()
-    
-    user_info = get_user_info(user_id)
-    
-    if user_info:
-        role = user_info[3]
-        if role == "admin":
-            await show_admin_menu(message)
-        elif role == "teacher":
-            await show_teacher_menu(message)
-        elif role == "student":
-            await show_student_menu(message)
+    if user_id == ADMIN_ID and role is None:
+        await register_admin(user_id)
+        role_cache.invalidate(user_id)
+        role = "admin"
+    # Пишет боту - значит, снова доступен для уведомлений
+    await reset_recipient(user_id)
+    
+    if role == "admin":
+        await show_admin_menu(message)
+    elif role == "teacher":
+        await show_teacher_menu(message)
+    elif role == "student":
+        await show_student_menu(message)
     else:
         keyboard = ReplyKeyboardMarkup(
             keyboard=[
@@ -862,83 +1110,17 @@ async def process_student_group(message: Message, state: FSMContext):
     full_name = data.get("full_name")
     group_name = message.text.strip()
     
-    cursor.execute("SELECT student_id FROM students WHERE full_name = ? AND group_name = ?", (full_name, group_name))
-    student = cursor.fetchone()
-    
-    if student:
-        old_student_id = student[0]
-        cursor.execute("UPDATE students SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        cursor.execute("UPDATE users SET user_id = ?, full_name = ?, group_name = ?, role = 'student' WHERE user_id = ?",
-                      (user_id, full_name, group_name, old_student_id))
-        cursor.execute("UPDATE student_teacher SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        cursor.execute("UPDATE admin_student SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        cursor.execute("UPDATE group_students SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        cursor.execute("UPDATE grades SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        cursor.execute("UPDATE purchased_rewards SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        cursor.execute("UPDATE reserved_tokens SET student_id = ? WHERE student_id = ?", (user_id, old_student_id))
-        student_id = user_id
-    else:
-        cursor.execute("SELECT student_id FROM students WHERE full_name = ?", (full_name,))
-        existing_student = cursor.fetchone()
-        if existing_student:
-            student_id = existing_student[0]
-            cursor.execute("UPDATE students SET group_name = ? WHERE student_id = ?", (group_name, student_id))
-            cursor.execute("UPDATE users SET user_id = ?, full_name = ?, group_name = ?, role = 'student' WHERE user_id = ?",
-                          (user_id, full_name, group_name, student_id))
-        else:
-            cursor.execute("INSERT INTO users (user_id, username, full_name, role, group_name) VALUES (?, ?, ?, 'student', ?)", 
-                          (user_id, message.from_user.username, full_name, group_name))
-            cursor.execute("INSERT INTO students (student_id, full_name, group_name) VALUES (?, ?, ?)", 
-                          (user_id, full_name, group_name))
-            student_id = user_id
-    
-    cursor.execute("INSERT OR IGNORE INTO admin_student (admin_id, student_id) VALUES (?, ?)", 
-                  (ADMIN_ID, student_id))
-    
-    cursor.execute("""
-    SELECT DISTINCT t.teacher_id
-    FROM student_groups sg
-    JOIN teachers t ON sg.teacher_id = t.teacher_id
-    WHERE sg.group_name = ?
-    """, (group_name,))
-    teachers = cursor.fetchall()
-    
-    for (teacher_id,) in teachers:
-        if not is_student_linked(student_id, teacher_id):
-            cursor.execute("INSERT OR IGNORE INTO student_teacher (student_id, teacher_id, tokens) VALUES (?, ?, 0)", 
-                          (student_id, teacher_id))
-        
-        cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", 
-                      (teacher_id, group_name))
-        group = cursor.fetchone()
-        if group:
-            group_id = group[0]
-            cursor.execute("INSERT OR IGNORE INTO group_students (group_id, student_id) VALUES (?, ?)", 
-                          (group_id, student_id))
-    
-    # Начисление зарезервированных жетонов
-    cursor.execute("""
-    SELECT teacher_id, discipline_id, tokens, notification_message
-    FROM reserved_tokens
-    WHERE student_id = ?
-    """, (student_id,))
-    reserved = cursor.fetchall()
+    student_id, reserved = await register_student(user_id, message.from_user.username, full_name, group_name)
+    role_cache.invalidate(user_id)
     
     for teacher_id, discipline_id, tokens, notification_message in reserved:
-        cursor.execute("""
-        UPDATE student_teacher 
-        SET tokens = tokens + ? 
-        WHERE student_id = ? AND teacher_id = ?
-        """, (tokens, student_id, teacher_id))
         try:
             await bot.send_message(student_id, notification_message)
-            await bot.send_message(teacher_id, f"Студент (ID: {student_id}) зарегистрировался и получил зарезервированные {tokens} жетончиков.")
+            with bulk_sends():
+                await bot.send_message(teacher_id, f"Студент (ID: {student_id}) зарегистрировался и получил зарезервированные {tokens} жетончиков.")
         except Exception as e:
             logger.error(f"Ошибка отправки уведомления о зарезервированных жетонах: {e}")
     
-    cursor.execute("DELETE FROM reserved_tokens WHERE student_id = ?", (student_id,))
-    conn.commit()
-    
     await state.clear()
     await message.answer("Регистрация завершена. Вы связаны с преподавателями вашей группы.", 
                        reply_markup=ReplyKeyboardRemove())
@@ -946,12 +1128,12 @@ async def process_student_group(message: Message, state: FSMContext):
 
 # Новая функция для ручной проверки и начисления жетонов
 @dp.message(F.text == "Проверить сдачу практик")
-async def check_practices_completion(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def check_practices_completion(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателям.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -969,9 +1151,7 @@ async def check_practices_completion(message: Message, state: FSMContext):
 async def process_check_practices_discipline(callback: types.CallbackQuery, state: FSMContext):
     discipline_id = int(callback.data.split("_")[3])
     teacher_id = callback.from_user.id
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ? AND teacher_id = ?", 
-                  (discipline_id, teacher_id))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id, teacher_id)
     
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
@@ -980,7 +1160,7 @@ async def process_check_practices_discipline(callback: types.CallbackQuery, stat
         return
     
     discipline_name, group_name = discipline
-    students = get_group_students(group_name, teacher_id)
+    students = await get_group_students(group_name, teacher_id)
     
     if not students:
         await callback.message.answer("В этой группе нет студентов.")
@@ -988,14 +1168,12 @@ async def process_check_practices_discipline(callback: types.CallbackQuery, stat
         await callback.answer()
         return
     
-    for student_id, _ in students:
-        if check_all_practices_completed(student_id, discipline_id, teacher_id):
-            cursor.execute("SELECT tokens FROM reserved_tokens WHERE student_id = ? AND teacher_id = ? AND discipline_id = ?",
-                          (student_id, teacher_id, discipline_id))
-            if not cursor.fetchone():
-                await award_practice_completion(student_id, discipline_id, teacher_id)
+    completed, _ = await award_practice_completions(discipline_id, teacher_id, group_name)
+    # Уведомления о награде уже в outbox, отправятся в фоне
+    notification_outbox.wake()
     
-    await callback.message.answer(f"Проверка сдачи практик по дисциплине '{discipline_name}' завершена. Уведомления и жетончики начислены.")
+    await callback.message.answer(f"Проверка сдачи практик по дисциплине '{discipline_name}' завершена. Уведомления и жетончики начислены.\n"
+                                  f"Сдали все практики: {completed} из {len(students)}.")
     await callback.answer()
 
 @dp.message(F.text.regexp(r'^[0-9a-f]{8}$'))
@@ -1003,17 +1181,11 @@ async def process_teacher_token(message: Message, state: FSMContext):
     user_id = message.from_user.id
     token = message.text
     
-    cursor.execute("SELECT teacher_id, full_name FROM teachers WHERE token = ?", (token,))
-    teacher = cursor.fetchone()
+    full_name = await register_teacher(user_id, message.from_user.username, token)
     
-    if teacher:
-        teacher_id, full_name = teacher
-        cursor.execute("INSERT OR REPLACE INTO users (user_id, username, full_name, role) VALUES (?, ?, ?, 'teacher')", 
-                      (user_id, message.from_user.username, full_name))
-        cursor.execute("UPDATE teachers SET teacher_id = ? WHERE token = ?", (user_id, token))
-        cursor.execute("INSERT OR IGNORE INTO admin_teacher (admin_id, teacher_id) VALUES (?, ?)", 
-                      (ADMIN_ID, user_id))
-        conn.commit()
+    if full_name:
+        role_cache.invalidate(user_id)
+        reference_cache.invalidate(TEACHER, user_id)
         await message.answer(f"Добро пожаловать, {full_name}! Вы зарегистрированы как преподаватель.", 
                           reply_markup=ReplyKeyboardRemove())
         await show_teacher_menu(message)
@@ -1055,22 +1227,19 @@ async def show_student_menu(message: Message):
         keyboard=[
             [KeyboardButton(text="Мои оценки"), KeyboardButton(text="Мои преподаватели")],
             [KeyboardButton(text="Экспорт оценок"), KeyboardButton(text="Магазин наград")],
-            [KeyboardButton(text="Мои жетончики")], [KeyboardButton(text="Мои практики")]
+            [KeyboardButton(text="Мои жетончики")], [KeyboardButton(text="Мои практики")],
+            [KeyboardButton(text="Моя посещаемость")]
         ],
         resize_keyboard=True
     )
     await message.answer("Меню студента:", reply_markup=keyboard)
 
 @dp.message(Command("help"))
-async def cmd_help(message: Message):
-    user_id = message.from_user.id
-    user_info = get_user_info(user_id)
-    
-    if not user_info:
+async def cmd_help(message: Message, role: str):
+    if not role:
         await message.answer("Доступные команды:\n/start - начать работу\n/help - помощь")
         return
     
-    role = user_info[3]
     if role == "admin":
         help_text = """
         Команды администратора:
@@ -1114,43 +1283,29 @@ async def cmd_help(message: Message):
         """
     await message.answer(help_text)
 
-@dp.message(F.document, lambda message: is_admin(message.from_user.id))
+async def admin_filter(message: Message, role: str) -> bool:
+    return role == "admin"
+
+@dp.message(F.document, admin_filter)
 async def handle_admin_document(message: Message):
     try:
-        file_id = message.document.file_id
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        await bot.download_file(file_path, "uploaded_teachers.xlsx")
-        
-        df = pd.read_excel("uploaded_teachers.xlsx")
-        if "ФИО преподавателя" not in df.columns:
-            await message.answer("Ожидается колонка 'ФИО преподавателя'.")
-            return
-        
-        added = 0
-        for _, row in df.iterrows():
-            full_name = str(row["ФИО преподавателя"]).strip()
-            if not full_name or pd.isna(full_name):
-                continue
-            cursor.execute("SELECT 1 FROM teachers WHERE full_name = ?", (full_name,))
-            if not cursor.fetchone():
-                token = generate_token()
-                cursor.execute("INSERT INTO teachers (full_name, token, tokens_per_attendance) VALUES (?, ?, 1)", (full_name, token))
-                teacher_id = cursor.lastrowid
-                cursor.execute("INSERT OR IGNORE INTO admin_teacher (admin_id, teacher_id) VALUES (?, ?)", 
-                             (message.from_user.id, teacher_id))
-                added += 1
+        with await download_upload(message.document.file_id, message.document.file_size) as source:
+            if missing_columns(source, ["ФИО преподавателя"]):
+                await message.answer("Ожидается колонка 'ФИО преподавателя'.")
+                return
+            names = [full_name for full_name, in iter_rows(source, ["ФИО преподавателя"]) if full_name]
         
-        conn.commit()
+        added = await import_teachers(message.from_user.id, names)
         await message.answer(f"Добавлено {added} преподавателей.")
-        os.remove("uploaded_teachers.xlsx")
+    except UploadTooLarge:
+        await message.answer(UPLOAD_TOO_LARGE_MESSAGE)
     except Exception as e:
         logger.error(f"Error processing admin document: {e}")
         await message.answer("Ошибка при обработке файла.")
 
 @dp.message(F.text == "Добавить группу студентов")
-async def add_student_group_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def add_student_group_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателям.")
         return
     await state.set_state(TeacherForm.waiting_for_student_list)
@@ -1159,72 +1314,48 @@ async def add_student_group_start(message: Message, state: FSMContext):
 @dp.message(TeacherForm.waiting_for_student_list, F.document)
 async def handle_teacher_document(message: Message, state: FSMContext):
     try:
-        file_id = message.document.file_id
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        await bot.download_file(file_path, "uploaded_students.xlsx")
-        
-        df = pd.read_excel("uploaded_students.xlsx")
-        if "ФИО студента" not in df.columns or "Группа" not in df.columns:
+        document = message.document
+        with await download_upload(document.file_id, document.file_size) as source:
+            missing = missing_columns(source, ["ФИО студента", "Группа"])
+        if missing:
             await message.answer("Ожидаются колонки 'ФИО студента' и 'Группа'.")
-            os.remove("uploaded_students.xlsx")
             return
         
-        await state.update_data(student_df=df.to_dict('records'))
+        # В состоянии храним только file_id, список читается при импорте
+        await state.update_data(student_file_id=document.file_id, student_file_size=document.file_size)
         await state.set_state(TeacherForm.waiting_for_group_name)
         await message.answer("Введите название группы для этих студентов:")
-        os.remove("uploaded_students.xlsx")
+    except UploadTooLarge:
+        await message.answer(UPLOAD_TOO_LARGE_MESSAGE)
     except Exception as e:
         logger.error(f"Error processing teacher document: {e}")
         await message.answer("Ошибка при обработке файла.")
-        if os.path.exists("uploaded_students.xlsx"):
-            os.remove("uploaded_students.xlsx")
 
 @dp.message(TeacherForm.waiting_for_group_name)
 async def process_group_name(message: Message, state: FSMContext):
     teacher_id = message.from_user.id
     group_name = message.text.strip()
     data = await state.get_data()
-    students = data.get("student_df", [])
-    
-    cursor.execute("INSERT OR IGNORE INTO student_groups (teacher_id, group_name) VALUES (?, ?)", (teacher_id, group_name))
-    cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", (teacher_id, group_name))
-    group_id = cursor.fetchone()[0]
-    
-    added = 0
-    for student in students:
-        full_name = str(student.get("ФИО студента")).strip()
-        student_group = str(student.get("Группа", group_name)).strip()
-        if not full_name or pd.isna(full_name):
-            continue
-        
-        cursor.execute("SELECT student_id FROM students WHERE full_name = ? AND group_name = ?", (full_name, student_group))
-        existing_student = cursor.fetchone()
-        
-        if existing_student:
-            student_id = existing_student[0]
-        else:
-            cursor.execute("INSERT INTO students (full_name, group_name) VALUES (?, ?)", 
-                          (full_name, student_group))
-            student_id = cursor.lastrowid
-            cursor.execute("INSERT OR IGNORE INTO users (user_id, full_name, role, group_name) VALUES (?, ?, 'student', ?)", 
-                          (student_id, full_name, student_group))
-            cursor.execute("INSERT OR IGNORE INTO admin_student (admin_id, student_id) VALUES (?, ?)", 
-                          (ADMIN_ID, student_id))
-            added += 1
-        
-        cursor.execute("INSERT OR IGNORE INTO group_students (group_id, student_id) VALUES (?, ?)", (group_id, student_id))
-        if not is_student_linked(student_id, teacher_id):
-            cursor.execute("INSERT OR IGNORE INTO student_teacher (student_id, teacher_id, tokens) VALUES (?, ?, 0)", 
-                          (student_id, teacher_id))
     
-    conn.commit()
+    try:
+        with await download_upload(data["student_file_id"], data.get("student_file_size")) as source:
+            added, existing, skipped = await import_students(teacher_id, group_name, source)
+    except Exception as e:
+        logger.error(f"Error importing students: {e}")
+        await state.clear()
+        await message.answer("Ошибка при импорте студентов.")
+        return
     await state.clear()
-    await message.answer(f"Добавлено {added} новых студентов в группу '{group_name}'.")
+    response = f"Добавлено {added} новых студентов в группу '{group_name}'."
+    if existing:
+        response += f"\nУже были в базе: {existing}."
+    if skipped:
+        response += f"\nПропущено строк без ФИО: {skipped}."
+    await message.answer(response)
 
 @dp.message(F.text == "Добавить студента вручную")
-async def add_student_manually_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def add_student_manually_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателям.")
         return
     await state.set_state(TeacherForm.waiting_for_student_name)
@@ -1234,7 +1365,7 @@ async def add_student_manually_start(message: Message, state: FSMContext):
 async def process_student_name_manual(message: Message, state: FSMContext):
     await state.update_data(student_name=message.text.strip())
     teacher_id = message.from_user.id
-    groups = get_teacher_groups(teacher_id)
+    groups = await get_teacher_groups(teacher_id)
     
     if not groups:
         await message.answer("У вас нет групп. Сначала добавьте группу.")
@@ -1255,39 +1386,14 @@ async def process_student_group_manual(callback: types.CallbackQuery, state: FSM
     data = await state.get_data()
     full_name = data.get("student_name")
     
-    cursor.execute("SELECT student_id FROM students WHERE full_name = ? AND group_name = ?", (full_name, group_name))
-    existing_student = cursor.fetchone()
-    
-    if existing_student:
-        student_id = existing_student[0]
-    else:
-        cursor.execute("INSERT INTO students (full_name, group_name) VALUES (?, ?)", (full_name, group_name))
-        student_id = cursor.lastrowid
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, full_name, role, group_name) VALUES (?, ?, 'student', ?)", 
-                      (student_id, full_name, group_name))
-        cursor.execute("INSERT OR IGNORE INTO admin_student (admin_id, student_id) VALUES (?, ?)", 
-                      (ADMIN_ID, student_id))
-    
-    cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", 
-                  (teacher_id, group_name))
-    group = cursor.fetchone()
-    
-    if group:
-        group_id = group[0]
-        cursor.execute("INSERT OR IGNORE INTO group_students (group_id, student_id) VALUES (?, ?)", (group_id, student_id))
-    
-    if not is_student_linked(student_id, teacher_id):
-        cursor.execute("INSERT OR IGNORE INTO student_teacher (student_id, teacher_id, tokens) VALUES (?, ?, 0)", 
-                      (student_id, teacher_id))
-    
-    conn.commit()
+    await add_student_to_group(teacher_id, full_name, group_name)
     await state.clear()
     await callback.message.answer(f"Студент {full_name} добавлен в группу {group_name}.")
     await callback.answer()
 
 @dp.message(F.text == "Добавить дисциплину")
-async def add_discipline_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def add_discipline_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателям.")
         return
     await state.set_state(TeacherForm.waiting_for_discipline_name)
@@ -1296,7 +1402,7 @@ async def add_discipline_start(message: Message, state: FSMContext):
 @dp.message(TeacherForm.waiting_for_discipline_name)
 async def process_discipline_name(message: Message, state: FSMContext):
     teacher_id = message.from_user.id
-    groups = get_teacher_groups(teacher_id)
+    groups = await get_teacher_groups(teacher_id)
     
     if not groups:
         await message.answer("У вас нет групп. Сначала добавьте группу.")
@@ -1320,7 +1426,7 @@ async def process_required_practices(message: Message, state: FSMContext):
     
     await state.update_data(required_practices=required_practices)
     teacher_id = message.from_user.id
-    groups = get_teacher_groups(teacher_id)
+    groups = await get_teacher_groups(teacher_id)
     
     keyboard = InlineKeyboardBuilder()
     for group in groups:
@@ -1337,23 +1443,19 @@ async def process_discipline_group(callback: types.CallbackQuery, state: FSMCont
     discipline_name = data.get("discipline_name")
     required_practices = data.get("required_practices")
     
-    cursor.execute("""
-    INSERT INTO disciplines (teacher_id, name, group_name, required_practices)
-    VALUES (?, ?, ?, ?)
-    """, (teacher_id, discipline_name, group_name, required_practices))
-    conn.commit()
+    await add_discipline(teacher_id, discipline_name, group_name, required_practices)
     
     await state.clear()
     await callback.message.answer(f"Дисциплина '{discipline_name}' с {required_practices} практиками добавлена для группы '{group_name}'.")
     await callback.answer()
 
 @dp.message(F.text == "Создать КТП")
-async def create_ktp_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def create_ktp_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -1372,9 +1474,7 @@ async def create_ktp_start(message: Message, state: FSMContext):
 async def process_ktp_discipline(callback: types.CallbackQuery, state: FSMContext):
     discipline_id = int(callback.data.split("_")[2])
     teacher_id = callback.from_user.id
-    cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ? AND teacher_id = ?", 
-                  (discipline_id, teacher_id))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id, teacher_id)
     
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
@@ -1428,17 +1528,7 @@ async def process_lecture_homework(message: Message, state: FSMContext):
     ktp_type = data.get("ktp_type")
     description = data.get("description")
     
-    # Находим все группы, связанные с этой дисциплиной
-    cursor.execute("SELECT group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    groups = [row[0] for row in cursor.fetchall()]
-    
-    for group_name in groups:
-        cursor.execute("""
-        INSERT INTO ktp (teacher_id, discipline_id, group_name, type, description, practice_number, homework)
-        VALUES (?, ?, ?, ?, ?, NULL, ?)
-        """, (teacher_id, discipline_id, group_name, ktp_type, description, homework))
-    
-    conn.commit()
+    await add_ktp(teacher_id, discipline_id, ktp_type, description, None, homework)
     
     await state.clear()
     await message.answer(f"КТП для лекции создан.", reply_markup=ReplyKeyboardRemove())
@@ -1476,29 +1566,19 @@ async def process_practice_homework(message: Message, state: FSMContext):
     practice_number = data.get("practice_number")
     description = data.get("description")
     
-    # Находим все группы, связанные с этой дисциплиной
-    cursor.execute("SELECT group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    groups = [row[0] for row in cursor.fetchall()]
-    
-    for group_name in groups:
-        cursor.execute("""
-        INSERT INTO ktp (teacher_id, discipline_id, group_name, type, description, practice_number, homework)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (teacher_id, discipline_id, group_name, ktp_type, description, practice_number, homework))
-    
-    conn.commit()
+    await add_ktp(teacher_id, discipline_id, ktp_type, description, practice_number, homework)
     
     await state.clear()
     await message.answer(f"КТП для практики #{practice_number} создан.", reply_markup=ReplyKeyboardRemove())
     await show_teacher_menu(message)
 
 @dp.message(F.text == "Просмотреть/удалить КТП")
-async def view_delete_ktp_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def view_delete_ktp_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -1516,16 +1596,14 @@ async def view_delete_ktp_start(message: Message, state: FSMContext):
 async def view_ktp_by_discipline(callback: types.CallbackQuery, state: FSMContext):
     discipline_id = int(callback.data.split("_")[3])
     teacher_id = callback.from_user.id
-    cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ? AND teacher_id = ?", 
-                  (discipline_id, teacher_id))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id, teacher_id)
     
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
         await callback.answer()
         return
     
-    ktps = get_ktp_by_discipline_and_type(teacher_id, discipline_id, 'lecture') + get_ktp_by_discipline_and_type(teacher_id, discipline_id, 'practice')
+    ktps = await get_ktp_by_discipline_and_type(teacher_id, discipline_id, 'lecture') + await get_ktp_by_discipline_and_type(teacher_id, discipline_id, 'practice')
     
     if not ktps:
         await callback.message.answer(f"Нет КТП для дисциплины '{discipline[0]}'.")
@@ -1549,34 +1627,27 @@ async def view_ktp_by_discipline(callback: types.CallbackQuery, state: FSMContex
 @dp.callback_query(F.data.startswith("delete_ktp_"))
 async def delete_ktp(callback: types.CallbackQuery):
     ktp_id = int(callback.data.split("_")[2])
-    cursor.execute("SELECT discipline_id, group_name, type, description, practice_number FROM ktp WHERE ktp_id = ?", (ktp_id,))
-    ktp = cursor.fetchone()
+    ktp = await remove_ktp(ktp_id)
+    reference_cache.invalidate(KTP, ktp_id)
     
     if not ktp:
         await callback.message.answer("КТП не найден.")
         await callback.answer()
         return
     
-    discipline_id, group_name, ktp_type, description, practice_number = ktp
-    cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline_name = cursor.fetchone()[0]
-    
-    cursor.execute("DELETE FROM grades WHERE ktp_id = ?", (ktp_id,))
-    cursor.execute("DELETE FROM ktp WHERE ktp_id = ?", (ktp_id,))
-    conn.commit()
+    discipline_name, group_name, ktp_type, practice_number = ktp
     
     ktp_type_str = "Лекция" if ktp_type == "lecture" else f"Практика #{practice_number}"
     await callback.message.answer(f"КТП для '{discipline_name}' ({ktp_type_str}, {group_name}) удален.")
     await callback.answer()
 
 @dp.message(F.text == "Настроить жетончики за посещение")
-async def set_tokens_per_attendance_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def set_tokens_per_attendance_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    cursor.execute("SELECT tokens_per_attendance FROM teachers WHERE teacher_id = ?", (teacher_id,))
-    current_tokens = cursor.fetchone()[0]
+    current_tokens = await get_tokens_per_attendance(teacher_id)
     
     await state.set_state(TeacherForm.waiting_for_tokens_per_attendance)
     keyboard = ReplyKeyboardMarkup(
@@ -1597,20 +1668,20 @@ async def process_tokens_per_attendance(message: Message, state: FSMContext):
         return
     
     teacher_id = message.from_user.id
-    cursor.execute("UPDATE teachers SET tokens_per_attendance = ? WHERE teacher_id = ?", (tokens, teacher_id))
-    conn.commit()
+    await set_tokens_per_attendance(teacher_id, tokens)
+    reference_cache.invalidate(TEACHER, teacher_id)
     
     await state.clear()
     await message.answer(f"Количество жетончиков за посещение установлено: {tokens}.", reply_markup=ReplyKeyboardRemove())
     await show_teacher_menu(message)
 
 @dp.message(F.text == "Управление магазином наград")
-async def manage_rewards_start(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def manage_rewards_start(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин. Сначала добавьте дисциплину.")
@@ -1625,7 +1696,7 @@ async def manage_rewards_start(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "add_reward")
 async def add_reward_start(callback: types.CallbackQuery, state: FSMContext):
     teacher_id = callback.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await callback.message.answer("У вас нет дисциплин.")
@@ -1644,8 +1715,7 @@ async def add_reward_start(callback: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data.startswith("reward_dis_"))
 async def select_discipline_for_reward(callback: types.CallbackQuery, state: FSMContext):
     discipline_id = int(callback.data.split("_")[2])
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id)
     
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
@@ -1685,11 +1755,7 @@ async def process_reward_price(message: Message, state: FSMContext):
     reward_name = data.get("reward_name")
     reward_description = data.get("reward_description")
     
-    cursor.execute("""
-    INSERT INTO rewards (teacher_id, discipline_id, name, description, price, is_enabled)
-    VALUES (?, ?, ?, ?, ?, 1)
-    """, (teacher_id, discipline_id, reward_name, reward_description, price))
-    conn.commit()
+    await add_reward(teacher_id, discipline_id, reward_name, reward_description, price)
     
     await state.clear()
     await message.answer(f"Награда '{reward_name}' добавлена для дисциплины '{data.get('discipline_name')}'.")
@@ -1698,7 +1764,7 @@ async def process_reward_price(message: Message, state: FSMContext):
 @dp.callback_query(F.data == "view_rewards")
 async def view_teacher_rewards(callback: types.CallbackQuery):
     teacher_id = callback.from_user.id
-    rewards = get_teacher_rewards(teacher_id)
+    rewards = await get_teacher_rewards(teacher_id)
     
     if not rewards:
         await callback.message.answer("У вас нет наград.")
@@ -1721,8 +1787,7 @@ async def view_teacher_rewards(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("edit_reward_price_"))
 async def edit_reward_price_start(callback: types.CallbackQuery, state: FSMContext):
     reward_id = int(callback.data.split("_")[3])
-    cursor.execute("SELECT name, price, discipline_id FROM rewards WHERE reward_id = ?", (reward_id,))
-    reward = cursor.fetchone()
+    reward = await get_reward(reward_id)
     
     if not reward:
         await callback.message.answer("Награда не найдена.")
@@ -1752,8 +1817,7 @@ async def process_edit_reward_price(message: Message, state: FSMContext):
     reward_id = data.get("reward_id")
     reward_name = data.get("reward_name")
     
-    cursor.execute("UPDATE rewards SET price = ? WHERE reward_id = ?", (price, reward_id))
-    conn.commit()
+    await set_reward_price(reward_id, price)
     
     await state.clear()
     await message.answer(f"Цена награды '{reward_name}' обновлена до {price} токенов.",
@@ -1763,17 +1827,15 @@ async def process_edit_reward_price(message: Message, state: FSMContext):
 @dp.callback_query(F.data.startswith("toggle_reward_"))
 async def toggle_reward_status(callback: types.CallbackQuery):
     reward_id = int(callback.data.split("_")[2])
-    cursor.execute("SELECT name, is_enabled FROM rewards WHERE reward_id = ?", (reward_id,))
-    reward = cursor.fetchone()
+    reward = await get_reward(reward_id)
     
     if not reward:
         await callback.message.answer("Награда не найдена.")
         await callback.answer()
         return
     
-    new_status = 0 if reward[1] else 1
-    cursor.execute("UPDATE rewards SET is_enabled = ? WHERE reward_id = ?", (new_status, reward_id))
-    conn.commit()
+    new_status = 0 if reward[3] else 1
+    await set_reward_enabled(reward_id, new_status)
     
     status_text = "включена" if new_status else "отключена"
     await callback.message.answer(f"Награда '{reward[0]}' {status_text}.")
@@ -1782,17 +1844,14 @@ async def toggle_reward_status(callback: types.CallbackQuery):
 @dp.callback_query(F.data.startswith("delete_reward_"))
 async def delete_reward(callback: types.CallbackQuery):
     reward_id = int(callback.data.split("_")[2])
-    cursor.execute("SELECT name FROM rewards WHERE reward_id = ?", (reward_id,))
-    reward = cursor.fetchone()
+    reward = await get_reward(reward_id)
     
     if not reward:
         await callback.message.answer("Награда не найдена.")
         await callback.answer()
         return
     
-    cursor.execute("DELETE FROM purchased_rewards WHERE reward_id = ?", (reward_id,))
-    cursor.execute("DELETE FROM rewards WHERE reward_id = ?", (reward_id,))
-    conn.commit()
+    await remove_reward(reward_id)
     
     await callback.message.answer(f"Награда '{reward[0]}' удалена.")
     await callback.answer()
@@ -1800,7 +1859,7 @@ async def delete_reward(callback: types.CallbackQuery):
 @dp.message(F.text == "Мои дисциплины")
 async def show_teacher_disciplines(message: Message):
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -1822,15 +1881,11 @@ async def show_teacher_disciplines(message: Message):
 @dp.callback_query(F.data.startswith("del_dis_"))
 async def delete_discipline(callback: types.CallbackQuery):
     discipline_id = int(callback.data.split("_")[2])
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline = cursor.fetchone()
+    discipline = await remove_discipline(discipline_id)
+    # Вместе с дисциплиной удалены ее КТП
+    reference_cache.clear()
     
     if discipline:
-        cursor.execute("DELETE FROM grades WHERE discipline_id = ?", (discipline_id,))
-        cursor.execute("DELETE FROM rewards WHERE discipline_id = ?", (discipline_id,))
-        cursor.execute("DELETE FROM ktp WHERE discipline_id = ?", (discipline_id,))
-        cursor.execute("DELETE FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-        conn.commit()
         await callback.message.answer(f"Дисциплина '{discipline[0]}' ({discipline[1]}) удалена.")
     else:
         await callback.message.answer("Дисциплина не найдена.")
@@ -1840,7 +1895,7 @@ async def delete_discipline(callback: types.CallbackQuery):
 @dp.message(F.text == "Мои группы")
 async def show_teacher_groups(message: Message):
     teacher_id = message.from_user.id
-    groups = get_teacher_groups(teacher_id)
+    groups = await get_teacher_groups(teacher_id)
     
     if not groups:
         await message.answer("У вас нет групп.")
@@ -1861,21 +1916,9 @@ async def delete_group(callback: types.CallbackQuery):
     group_name = callback.data.split("_")[2]
     teacher_id = callback.from_user.id
     
-    cursor.execute("SELECT group_id FROM student_groups WHERE teacher_id = ? AND group_name = ?", 
-                  (teacher_id, group_name))
-    group = cursor.fetchone()
-    
-    if group:
-        group_id = group[0]
-        cursor.execute("DELETE FROM group_students WHERE group_id = ?", (group_id,))
-        cursor.execute("DELETE FROM student_groups WHERE group_id = ?", (group_id,))
-        cursor.execute("DELETE FROM disciplines WHERE teacher_id = ? AND group_name = ?", 
-                      (teacher_id, group_name))
-        cursor.execute("DELETE FROM ktp WHERE teacher_id = ? AND group_name = ?", 
-                      (teacher_id, group_name))
-        cursor.execute("DELETE FROM rewards WHERE teacher_id = ? AND discipline_id IN (SELECT discipline_id FROM disciplines WHERE group_name = ?)", 
-                      (teacher_id, group_name))
-        conn.commit()
+    if await remove_group(teacher_id, group_name):
+        # Удалены дисциплины и КТП группы
+        reference_cache.clear()
         await callback.message.answer(f"Группа '{group_name}' удалена.")
     else:
         await callback.message.answer("Группа не найдена.")
@@ -1883,12 +1926,12 @@ async def delete_group(callback: types.CallbackQuery):
     await callback.answer()
 
 @dp.message(F.text == "Выставить оценки")
-async def start_grading(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def start_grading(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -1907,9 +1950,7 @@ async def start_grading(message: Message, state: FSMContext):
 async def select_discipline_for_grading(callback: types.CallbackQuery, state: FSMContext):
     discipline_id = int(callback.data.split("_")[2])
     teacher_id = callback.from_user.id
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ? AND teacher_id = ?", 
-                  (discipline_id, teacher_id))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id, teacher_id)
     
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
@@ -1938,7 +1979,7 @@ async def process_ktp_type_for_grading(message: Message, state: FSMContext):
     discipline_name = data.get("discipline_name")
     group_name = data.get("group_name")
     
-    ktps = get_ktp_by_discipline_and_type(teacher_id, discipline_id, ktp_type)
+    ktps = await get_ktp_by_discipline_and_type(teacher_id, discipline_id, ktp_type)
     
     if not ktps:
         await message.answer(f"Нет КТП типа '{message.text}' для дисциплины '{discipline_name}'.")
@@ -1947,17 +1988,11 @@ async def process_ktp_type_for_grading(message: Message, state: FSMContext):
         return
     
     if ktp_type == "practice":
-        cursor.execute("SELECT required_practices FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-        required_practices = cursor.fetchone()[0]
+        required_practices = await get_required_practices(discipline_id)
         response = f"Необходимое количество практик для дисциплины '{discipline_name}': {required_practices}\n"
+        practice_stats = await get_practice_stats(discipline_id)
         for ktp_id, group_name, ktp_type, description, practice_number in ktps:
-            cursor.execute("""
-            SELECT COUNT(DISTINCT g.student_id)
-            FROM grades g
-            JOIN ktp k ON g.ktp_id = k.ktp_id
-            WHERE k.practice_number = ? AND g.discipline_id = ? AND g.grade >= 1 AND g.grade != -1
-            """, (practice_number, discipline_id))
-            completed_count = cursor.fetchone()[0]
+            completed_count = practice_stats.get(practice_number, 0)
             response += f"Практика #{practice_number} ({description}): Сдано студентами: {completed_count}\n"
         await message.answer(response)
     
@@ -1979,8 +2014,7 @@ async def select_ktp_for_grading(callback: types.CallbackQuery, state: FSMContex
     discipline_id = int(callback.data.split("_")[3])
     teacher_id = callback.from_user.id
     
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id)
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
         await state.clear()
@@ -1988,7 +2022,7 @@ async def select_ktp_for_grading(callback: types.CallbackQuery, state: FSMContex
         return
     
     discipline_name, group_name = discipline
-    students = get_group_students(group_name, teacher_id)
+    students = await get_group_students(group_name, teacher_id)
     
     if not students:
         await callback.message.answer("В этой группе нет студентов.")
@@ -2083,33 +2117,10 @@ async def process_grade(message: Message, state: FSMContext):
         student_id, full_name = students[current_student]
         grade = -1 if message.text == "н" else int(message.text)
         
-        cursor.execute("""
-        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
-        
-        cursor.execute("SELECT tokens_per_attendance FROM teachers WHERE teacher_id = ?", (teacher_id,))
-        tokens_per_attendance = cursor.fetchone()[0]
-        if grade != -1:
-            cursor.execute("""
-            UPDATE student_teacher 
-            SET tokens = tokens + ? 
-            WHERE student_id = ? AND teacher_id = ?
-            """, (tokens_per_attendance, student_id, teacher_id))
-        
-        # Получаем информацию для уведомления
-        cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-        discipline_name = cursor.fetchone()[0]
-        cursor.execute("SELECT description, homework FROM ktp WHERE ktp_id = ?", (ktp_id,))
-        ktp_data = cursor.fetchone()
-        ktp_description, homework = ktp_data
-        cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (teacher_id,))
-        teacher_name = cursor.fetchone()[0]
+        await add_grade(student_id, teacher_id, discipline_id, ktp_id, grade, date)
         
-        # Отправляем уведом Huntington уведомление студенту
-        await notify_student(student_id, discipline_name, grade, date, ktp_description, teacher_name, homework=homework)
-        
-        conn.commit()
+        # Уведомление студенту уже в outbox, отправится в фоне
+        notification_outbox.wake()
     
     current_student += 1
     if current_student >= len(students):
@@ -2179,45 +2190,10 @@ async def process_grade_single(message: Message, state: FSMContext):
     
     grade = -1 if message.text == "н" else int(message.text)
     
-    cursor.execute("SELECT grade_id FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
-                  (student_id, discipline_id, ktp_id))
-    existing_grade = cursor.fetchone()
-    
-    is_update = bool(existing_grade)
-    if not existing_grade:
-        cursor.execute("""
-        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
-        
-        if grade != -1:
-            cursor.execute("SELECT tokens_per_attendance FROM teachers WHERE teacher_id = ?", (teacher_id,))
-            tokens_per_attendance = cursor.fetchone()[0]
-            cursor.execute("""
-            UPDATE student_teacher 
-            SET tokens = tokens + ? 
-            WHERE student_id = ? AND teacher_id = ?
-            """, (tokens_per_attendance, student_id, teacher_id))
-    else:
-        cursor.execute("""
-        UPDATE grades 
-        SET grade = ?, date = ? 
-        WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?
-        """, (grade, date, student_id, discipline_id, ktp_id))
-    
-    # Получаем информацию для уведомления
-    cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline_name = cursor.fetchone()[0]
-    cursor.execute("SELECT description, homework FROM ktp WHERE ktp_id = ?", (ktp_id,))
-    ktp_data = cursor.fetchone()
-    ktp_description, homework = ktp_data
-    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (teacher_id,))
-    teacher_name = cursor.fetchone()[0]
-    
-    # Отправляем уведомление студенту
-    await notify_student(student_id, discipline_name, grade, date, ktp_description, teacher_name, homework=homework, is_update=is_update)
+    is_update = await save_grade(student_id, teacher_id, discipline_id, ktp_id, grade, date)
     
-    conn.commit()
+    # Уведомление студенту уже в outbox, отправится в фоне
+    notification_outbox.wake()
     
     await message.answer(f"Оценка {'изменена' if is_update else 'выставлена'} для {student_name}: {message.text}.")
     
@@ -2237,12 +2213,12 @@ async def finish_grading(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @dp.message(F.text == "Редактировать оценку")
-async def start_edit_grade(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def start_edit_grade(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -2261,9 +2237,7 @@ async def select_discipline_for_edit_grade(callback: types.CallbackQuery, state:
     discipline_id = int(callback.data.split("_")[2])
     teacher_id = callback.from_user.id
     
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ? AND teacher_id = ?", 
-                  (discipline_id, teacher_id))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id, teacher_id)
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
         await state.clear()
@@ -2292,13 +2266,7 @@ async def process_edit_grade_date(message: Message, state: FSMContext):
     data = await state.get_data()
     discipline_id = data.get("edit_discipline_id")
     
-    cursor.execute("""
-    SELECT DISTINCT k.ktp_id, k.discipline_id, k.group_name, k.description 
-    FROM ktp k
-    JOIN grades g ON k.ktp_id = g.ktp_id
-    WHERE k.teacher_id = ? AND g.date = ? AND k.discipline_id = ?
-    """, (teacher_id, date.strftime("%d-%m-%Y"), discipline_id))
-    ktps = cursor.fetchall()
+    ktps = await get_graded_ktps(teacher_id, date.strftime("%d-%m-%Y"), discipline_id)
     
     if not ktps:
         await message.answer(f"Нет КТП с оценками на {date.strftime('%d-%m-%Y')} для выбранной дисциплины.")
@@ -2307,9 +2275,7 @@ async def process_edit_grade_date(message: Message, state: FSMContext):
     
     await state.update_data(edit_date=date.strftime("%d-%m-%Y"))
     keyboard = InlineKeyboardBuilder()
-    for ktp_id, discipline_id, group_name, description in ktps:
-        cursor.execute("SELECT name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-        discipline_name = cursor.fetchone()[0]
+    for ktp_id, discipline_id, group_name, description, discipline_name in ktps:
         keyboard.add(InlineKeyboardButton(
             text=f"{discipline_name} ({group_name}, {description})",
             callback_data=f"edit_grade_ktp_{ktp_id}_{discipline_id}"
@@ -2324,8 +2290,7 @@ async def select_ktp_for_edit_grade(callback: types.CallbackQuery, state: FSMCon
     discipline_id = int(callback.data.split("_")[4])
     teacher_id = callback.from_user.id
     
-    cursor.execute("SELECT name, group_name FROM disciplines WHERE discipline_id = ?", (discipline_id,))
-    discipline = cursor.fetchone()
+    discipline = await get_discipline(discipline_id)
     if not discipline:
         await callback.message.answer("Дисциплина не найдена.")
         await state.clear()
@@ -2333,7 +2298,7 @@ async def select_ktp_for_edit_grade(callback: types.CallbackQuery, state: FSMCon
         return
     
     discipline_name, group_name = discipline
-    students = get_group_students(group_name, teacher_id)
+    students = await get_group_students(group_name, teacher_id)
     
     if not students:
         await callback.message.answer("В этой группе нет студентов.")
@@ -2349,21 +2314,24 @@ async def select_ktp_for_edit_grade(callback: types.CallbackQuery, state: FSMCon
         edit_students=students
     )
     
+    keyboard = edit_grade_students_keyboard(students, await get_ktp_grades(discipline_id, ktp_id))
+    await state.set_state(GradeForm.selecting_student_edit)
+    await callback.message.answer("Выберите студента для редактирования оценки:", reply_markup=keyboard.as_markup())
+    await callback.answer()
+
+# Клавиатура выбора студента с текущими оценками по КТП
+def edit_grade_students_keyboard(students, grades):
     keyboard = InlineKeyboardBuilder()
-    for student_id, full_name in students:
-        cursor.execute("SELECT grade FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
-                     (student_id, discipline_id, ktp_id))
-        grade = cursor.fetchone()
-        grade_str = "н" if grade and grade[0] == -1 else str(grade[0]) if grade else "нет оценки"
+    for s_id, full_name in students:
+        grade = grades.get(s_id)
+        grade_str = "н" if grade == -1 else str(grade) if grade is not None else "нет оценки"
         keyboard.add(InlineKeyboardButton(
             text=f"{full_name} ({grade_str})",
-            callback_data=f"edit_grade_student_{student_id}"
+            callback_data=f"edit_grade_student_{s_id}"
         ))
     keyboard.add(InlineKeyboardButton(text="Отменить", callback_data="cancel_edit_grade"))
     keyboard.adjust(1)
-    await state.set_state(GradeForm.selecting_student_edit)
-    await callback.message.answer("Выберите студента для редактирования оценки:", reply_markup=keyboard.as_markup())
-    await callback.answer()
+    return keyboard
 
 @dp.callback_query(F.data.startswith("edit_grade_student_"))
 async def select_student_for_edit_grade(callback: types.CallbackQuery, state: FSMContext):
@@ -2394,7 +2362,6 @@ async def process_edit_grade(message: Message, state: FSMContext):
     data = await state.get_data()
     ktp_id = data.get("edit_ktp_id")
     discipline_id = data.get("edit_discipline_id")
-    discipline_name = data.get("edit_discipline_name")
     teacher_id = message.from_user.id
     date = data.get("edit_date")
     student_id = data.get("edit_student_id")
@@ -2409,94 +2376,28 @@ async def process_edit_grade(message: Message, state: FSMContext):
     
     if message.text == "Назад":
         await state.set_state(GradeForm.selecting_student_edit)
-        keyboard = InlineKeyboardBuilder()
-        for s_id, full_name in students:
-            cursor.execute("SELECT grade FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
-                         (s_id, discipline_id, ktp_id))
-            grade = cursor.fetchone()
-            grade_str = "н" if grade and grade[0] == -1 else str(grade[0]) if grade else "нет оценки"
-            keyboard.add(InlineKeyboardButton(
-                text=f"{full_name} ({grade_str})",
-                callback_data=f"edit_grade_student_{s_id}"
-            ))
-        keyboard.add(InlineKeyboardButton(text="Отменить", callback_data="cancel_edit_grade"))
-        keyboard.adjust(1)
+        keyboard = edit_grade_students_keyboard(students, await get_ktp_grades(discipline_id, ktp_id))
         await message.answer("Выберите студента для редактирования оценки:", reply_markup=keyboard.as_markup())
         return
     
     grade = -1 if message.text == "н" else int(message.text)
     
-    cursor.execute("SELECT grade_id, grade FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
-                  (student_id, discipline_id, ktp_id))
-    existing_grade = cursor.fetchone()
-    
-    is_update = bool(existing_grade)
-    old_grade = existing_grade[1] if existing_grade else None
-    
-    if is_update:
-        cursor.execute("""
-        UPDATE grades 
-        SET grade = ?, date = ? 
-        WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?
-        """, (grade, date, student_id, discipline_id, ktp_id))
-    else:
-        cursor.execute("""
-        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """, (student_id, teacher_id, discipline_id, ktp_id, grade, date))
-    
-    # Обновляем токены, если нужно
-    if grade != -1 and (not is_update or (is_update and old_grade == -1)):
-        cursor.execute("SELECT tokens_per_attendance FROM teachers WHERE teacher_id = ?", (teacher_id,))
-        tokens_per_attendance = cursor.fetchone()[0]
-        cursor.execute("""
-        UPDATE student_teacher 
-        SET tokens = tokens + ? 
-        WHERE student_id = ? AND teacher_id = ?
-        """, (tokens_per_attendance, student_id, teacher_id))
-    elif grade == -1 and is_update and old_grade != -1:
-        cursor.execute("SELECT tokens_per_attendance FROM teachers WHERE teacher_id = ?", (teacher_id,))
-        tokens_per_attendance = cursor.fetchone()[0]
-        cursor.execute("""
-        UPDATE student_teacher 
-        SET tokens = tokens - ? 
-        WHERE student_id = ? AND teacher_id = ?
-        """, (tokens_per_attendance, student_id, teacher_id))
-    
-    # Получаем информацию для уведомления
-    cursor.execute("SELECT description, homework FROM ktp WHERE ktp_id = ?", (ktp_id,))
-    ktp_data = cursor.fetchone()
-    ktp_description, homework = ktp_data
-    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (teacher_id,))
-    teacher_name = cursor.fetchone()[0]
-    
-    # Отправляем уведомление студенту
-    await notify_student(student_id, discipline_name, grade, date, ktp_description, teacher_name, homework=homework, is_update=is_update)
+    is_update = await edit_grade(student_id, teacher_id, discipline_id, ktp_id, grade, date)
     
-    conn.commit()
+    # Уведомление студенту уже в outbox, отправится в фоне
+    notification_outbox.wake()
     
     await message.answer(f"Оценка {'изменена' if is_update else 'выставлена'} для {student_name}: {message.text}.")
     
     # Возвращаем к выбору студента
     await state.set_state(GradeForm.selecting_student_edit)
-    keyboard = InlineKeyboardBuilder()
-    for s_id, full_name in students:
-        cursor.execute("SELECT grade FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?",
-                     (s_id, discipline_id, ktp_id))
-        grade = cursor.fetchone()
-        grade_str = "н" if grade and grade[0] == -1 else str(grade[0]) if grade else "нет оценки"
-        keyboard.add(InlineKeyboardButton(
-            text=f"{full_name} ({grade_str})",
-            callback_data=f"edit_grade_student_{s_id}"
-        ))
-    keyboard.add(InlineKeyboardButton(text="Отменить", callback_data="cancel_edit_grade"))
-    keyboard.adjust(1)
+    keyboard = edit_grade_students_keyboard(students, await get_ktp_grades(discipline_id, ktp_id))
     await message.answer("Выберите студента для редактирования оценки:", reply_markup=keyboard.as_markup())
 
 @dp.message(F.text == "Мои студенты")
 async def show_teacher_students(message: Message):
     teacher_id = message.from_user.id
-    groups = get_teacher_groups(teacher_id)
+    groups = await get_teacher_groups(teacher_id)
     
     if not groups:
         await message.answer("У вас нет групп.")
@@ -2512,7 +2413,7 @@ async def show_teacher_students(message: Message):
 async def view_group_students(callback: types.CallbackQuery):
     group_name = callback.data.split("_")[2]
     teacher_id = callback.from_user.id
-    students = get_group_students(group_name, teacher_id)
+    students = await get_group_students(group_name, teacher_id)
     
     if not students:
         await callback.message.answer(f"В группе {group_name} нет студентов.")
@@ -2521,19 +2422,19 @@ async def view_group_students(callback: types.CallbackQuery):
     
     response = f"Студенты группы {group_name}:\n"
     for student_id, full_name in students:
-        tokens = get_student_token_balance(student_id, teacher_id)
+        tokens = await get_student_token_balance(student_id, teacher_id)
         response += f"- {full_name} ({tokens} жетончиков)\n"
     
     await callback.message.answer(response)
     await callback.answer()
 
 @dp.message(F.text == "Создать ведомость")
-async def create_gradebook_start(message: Message):
-    if not is_teacher(message.from_user.id):
+async def create_gradebook_start(message: Message, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателями.")
         return
     teacher_id = message.from_user.id
-    disciplines = get_teacher_disciplines(teacher_id)
+    disciplines = await get_teacher_disciplines(teacher_id)
     
     if not disciplines:
         await message.answer("У вас нет дисциплин.")
@@ -2551,13 +2452,19 @@ async def generate_gradebook(callback: types.CallbackQuery):
     discipline_id = int(callback.data.split("_")[2])
     teacher_id = callback.from_user.id
     
+    key = ("gradebook", teacher_id, discipline_id)
     try:
-        filename = create_gradebook(teacher_id, discipline_id)
+        if report_workers.is_busy(key):
+            await callback.message.answer(REPORT_WAIT_MESSAGE)
+        filename, data = await report_workers.run(teacher_id, key, partial(create_gradebook, teacher_id, discipline_id))
         await callback.message.answer_document(
-            document=FSInputFile(path=filename),
+            document=BufferedInputFile(data, filename=filename),
             caption="Ведомость создана."
         )
-        os.remove(filename)
+    except ReportQueueFull:
+        await callback.message.answer(REPORT_QUEUE_FULL_MESSAGE)
+    except ReportLimitExceeded:
+        await callback.message.answer(REPORT_LIMIT_MESSAGE)
     except Exception as e:
         logger.error(f"Error creating gradebook: {e}")
         await callback.message.answer("Ошибка при создания ведомости.")
@@ -2567,7 +2474,7 @@ async def generate_gradebook(callback: types.CallbackQuery):
 @dp.message(F.text == "Мои оценки")
 async def show_student_grades(message: Message):
     student_id = message.from_user.id
-    grades = get_student_grades(student_id)
+    grades = await get_student_grades(student_id)
     
     if not grades:
         await message.answer("У вас нет оценок за последние 30 дней.")
@@ -2585,12 +2492,18 @@ async def show_student_grades(message: Message):
 @dp.message(F.text == "Экспорт оценок")
 async def export_student_grades(message: Message):
     student_id = message.from_user.id
+    key = ("grades", student_id)
     try:
-        filename = create_grades_excel(student_id)
-        document = FSInputFile(filename)
+        if report_workers.is_busy(key):
+            await message.answer(REPORT_WAIT_MESSAGE)
+        filename, data = await report_workers.run(student_id, key, partial(create_grades_excel, student_id))
+        document = BufferedInputFile(data, filename=filename)
         await message.answer_document(document=document, 
                                     caption="Ваши оценки за последние 30 дней.")
-        os.remove(filename)
+    except ReportQueueFull:
+        await message.answer(REPORT_QUEUE_FULL_MESSAGE)
+    except ReportLimitExceeded:
+        await message.answer(REPORT_LIMIT_MESSAGE)
     except Exception as e:
         logger.error(f"Error exporting grades: {e}")
         await message.answer("Ошибка при экспорте оценок.")
@@ -2598,7 +2511,7 @@ async def export_student_grades(message: Message):
 @dp.message(F.text == "Мои преподаватели")
 async def show_student_teachers(message: Message):
     student_id = message.from_user.id
-    teachers = get_student_teachers(student_id)
+    teachers = await get_student_teachers(student_id)
     
     if not teachers:
         await message.answer("У вас нет преподавателей.")
@@ -2613,7 +2526,7 @@ async def show_student_teachers(message: Message):
 @dp.message(F.text == "Мои жетончики")
 async def show_student_tokens(message: Message):
     student_id = message.from_user.id
-    teachers = get_student_teachers(student_id)
+    teachers = await get_student_teachers(student_id)
     
     if not teachers:
         await message.answer("У вас нет жетончиков.")
@@ -2628,7 +2541,7 @@ async def show_student_tokens(message: Message):
 @dp.message(F.text == "Магазин наград")
 async def show_rewards_shop(message: Message):
     student_id = message.from_user.id
-    rewards = get_student_rewards(student_id)
+    rewards = await get_student_rewards(student_id)
     
     if not rewards:
         await message.answer("В магазине нет наград.")
@@ -2637,7 +2550,7 @@ async def show_rewards_shop(message: Message):
     response = "Магазин наград:\n"
     keyboard = InlineKeyboardBuilder()
     for reward_id, name, description, price, teacher_name, discipline_name, teacher_id in rewards:
-        tokens = get_student_token_balance(student_id, teacher_id)
+        tokens = await get_student_token_balance(student_id, teacher_id)
         status = " (доступно)" if tokens >= price else " (недостаточно жетончиков)"
         response += f"- {name} ({discipline_name}): {description}, {price} жетончиков{status} (Преп.: {teacher_name})\n"
         if tokens >= price:
@@ -2650,13 +2563,7 @@ async def buy_reward(callback: types.CallbackQuery):
     reward_id = int(callback.data.split("_")[2])
     student_id = callback.from_user.id
     
-    cursor.execute("""
-    SELECT r.price, r.name, r.teacher_id, d.name
-    FROM rewards r
-    JOIN disciplines d ON r.discipline_id = d.discipline_id
-    WHERE r.reward_id = ?
-    """, (reward_id,))
-    reward = cursor.fetchone()
+    reward = await get_reward_for_purchase(reward_id)
     
     if not reward:
         await callback.message.answer("Награда не найдена.")
@@ -2664,71 +2571,39 @@ async def buy_reward(callback: types.CallbackQuery):
         return
     
     price, reward_name, teacher_id, discipline_name = reward
-    tokens = get_student_token_balance(student_id, teacher_id)
+    tokens = await get_student_token_balance(student_id, teacher_id)
     
     if tokens < price:
         await callback.message.answer("Недостаточно жетончиков для покупки.")
         await callback.answer()
         return
     
-    cursor.execute("""
-    UPDATE student_teacher 
-    SET tokens = tokens - ? 
-    WHERE student_id = ? AND teacher_id = ?
-    """, (price, student_id, teacher_id))
-    
-    cursor.execute("""
-    INSERT INTO purchased_rewards (student_id, reward_id, teacher_id, purchase_date)
-    VALUES (?, ?, ?, ?)
-    """, (student_id, reward_id, teacher_id, datetime.now().strftime("%d-%m-%Y")))
-    
-    conn.commit()
-    
-    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (teacher_id,))
-    teacher_name = cursor.fetchone()[0]
-    cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (student_id,))
-    student_name = cursor.fetchone()[0]
+    teacher_name, student_name = await purchase_reward(student_id, reward_id, teacher_id, price)
     
     await callback.message.answer(f"Вы купили награду '{reward_name}' за {price} жетончиков!")
-    await bot.send_message(
-        chat_id=teacher_id,
-        text=f"Студент {student_name} купил награду '{reward_name}' ({discipline_name}) за {price} жетончиков."
-    )
+    with bulk_sends():
+        await bot.send_message(
+            chat_id=teacher_id,
+            text=f"Студент {student_name} купил награду '{reward_name}' ({discipline_name}) за {price} жетончиков."
+        )
     await callback.answer()
 
 @dp.message(F.text == "Мои практики")
-async def check_student_practices(message: Message, state: FSMContext):
-    if not is_student(message.from_user.id):
+async def check_student_practices(message: Message, state: FSMContext, role: str):
+    if role != "student":
         await message.answer("Команда доступна только студентам.")
         return
     
     student_id = message.from_user.id
     try:
-        # Получаем дисциплины, связанные со студентом через группу
-        cursor.execute("""
-        SELECT d.discipline_id, d.name, d.required_practices
-        FROM disciplines d
-        JOIN student_teacher st ON d.teacher_id = st.teacher_id
-        WHERE st.student_id = ? AND d.group_name = (SELECT group_name FROM students WHERE student_id = ?)
-        """, (student_id, student_id))
-        disciplines = cursor.fetchall()
+        disciplines = await get_student_practices(student_id)
         
         if not disciplines:
             await message.answer("У вас нет дисциплин.")
             return
         
         response = "Ваши практики:\n\n"
-        for discipline_id, name, required_practices in disciplines:
-            # Подсчитываем сданные практики
-            cursor.execute("""
-            SELECT COUNT(DISTINCT k.practice_number)
-            FROM grades g
-            JOIN ktp k ON g.ktp_id = k.ktp_id
-            WHERE g.student_id = ? AND g.discipline_id = ? AND k.type = 'practice'
-            AND g.grade >= 1 AND g.grade != -1
-            """, (student_id, discipline_id))
-            completed = cursor.fetchone()[0]
-            
+        for name, required_practices, completed in disciplines:
             required = required_practices if required_practices is not None else 0
             response += f"Дисциплина: {name}\n"
             response += f"Сдано практик: {completed} из {required}\n"
@@ -2742,53 +2617,56 @@ async def check_student_practices(message: Message, state: FSMContext):
         logger.error(f"Неизвестная ошибка при проверке практик: {e}")
         await message.answer("Произошла ошибка. Попробуйте позже.")
 
+@dp.message(F.text == "Моя посещаемость")
+async def check_student_attendance(message: Message, role: str):
+    if role != "student":
+        await message.answer("Команда доступна только студентам.")
+        return
+    
+    student_id = message.from_user.id
+    disciplines = await get_student_attendance(student_id)
+    if not disciplines:
+        await message.answer("У вас пока нет отметок о посещении.")
+        return
+    
+    response = "Ваша посещаемость:\n\n"
+    for _, name, attended, total in disciplines:
+        response += f"{name}: {attended} из {total} ({percentage(attended, total):.0f}%)\n"
+    await message.answer(response)
+
 @dp.message(F.text == "Загрузить список преподавателей")
-async def upload_teachers_start(message: Message):
-    if not is_admin(message.from_user.id):
+async def upload_teachers_start(message: Message, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администраторам.")
         return
     await message.answer("Загрузите Excel файл со списком преподавателей (колонка: ФИО преподавателя).")
 
 @dp.message(F.text == "Сгенерировать токены преподавателей")
-async def generate_teacher_tokens(message: Message):
-    if not is_admin(message.from_user.id):
+async def generate_teacher_tokens(message: Message, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администраторам.")
         return
     
-    cursor.execute("SELECT teacher_id, full_name FROM teachers")
-    teachers = cursor.fetchall()
+    tokens = await ensure_teacher_tokens()
     
-    if not teachers:
+    if not tokens:
         await message.answer("Нет преподавателей.")
         return
     
-    tokens = []
-    for teacher_id, full_name in teachers:
-        cursor.execute("SELECT token FROM teachers WHERE teacher_id = ?", (teacher_id,))
-        token = cursor.fetchone()[0]
-        if not token:
-            token = generate_token()
-            cursor.execute("UPDATE teachers SET token = ? WHERE teacher_id = ?", (token, teacher_id))
-        tokens.append((full_name, token))
-    
-    conn.commit()
-    
-    df = pd.DataFrame(tokens, columns=["ФИО преподавателя", "Токен"])
     filename = f"teacher_tokens_{datetime.now().strftime('%Y%m%d')}.xlsx"
-    df.to_excel(filename, index=False)
+    data = build_xlsx("Токены", ["ФИО преподавателя", "Токен"], tokens)
     
     await message.answer_document(
-        document=FSInputFile(path=filename),
+        document=BufferedInputFile(data, filename=filename),
         caption="Токены сгенерированы."
     )
-    os.remove(filename)
 
 @dp.message(F.text == "Сгенерировать токены преподавателей")
-async def generate_teacher_tokens(message: Message):
-    if not is_admin(message.from_user.id):
+async def generate_teacher_tokens(message: Message, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администратору.")
         return
-    teachers = get_admin_teachers(message.from_user.id)
+    teachers = await get_admin_teachers(message.from_user.id)
     
     if not teachers:
         await message.answer("Нет преподавателей для генерации токенов.")
@@ -2796,24 +2674,17 @@ async def generate_teacher_tokens(message: Message):
     
     response = "Токены преподавателей:\n"
     for teacher_id, full_name in teachers:
-        cursor.execute("SELECT token FROM teachers WHERE teacher_id = ?", (teacher_id,))
-        token = cursor.fetchone()
-        if not token:
-            new_token = generate_token()
-            cursor.execute("UPDATE teachers SET token = ? WHERE teacher_id = ?", (new_token, teacher_id))
-            conn.commit()
-            response += f"- {full_name}: {new_token}\n"
-        else:
-            response += f"- {full_name}: {token[0]}\n"
+        token = await ensure_teacher_token(teacher_id)
+        response += f"- {full_name}: {token}\n"
     
     await message.answer(response)
 
 @dp.message(F.text == "Просмотреть список преподавателей")
-async def list_teachers(message: Message):
-    if not is_admin(message.from_user.id):
+async def list_teachers(message: Message, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администратору.")
         return
-    teachers = get_admin_teachers(message.from_user.id)
+    teachers = await get_admin_teachers(message.from_user.id)
     
     if not teachers:
         await message.answer("Нет преподавателей.")
@@ -2826,11 +2697,11 @@ async def list_teachers(message: Message):
     await message.answer(response)
 
 @dp.message(F.text == "Просмотреть список студентов")
-async def list_students(message: Message):
-    if not is_admin(message.from_user.id):
+async def list_students(message: Message, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администратору.")
         return
-    students = get_admin_students(message.from_user.id)
+    students = await get_admin_students(message.from_user.id)
     
     if not students:
         await message.answer("Нет студентов.")
@@ -2843,8 +2714,8 @@ async def list_students(message: Message):
     await message.answer(response)
 
 @dp.message(F.text == "Шаблон преподавателей")
-async def send_teachers_template(message: Message):
-    if not is_admin(message.from_user.id):
+async def send_teachers_template(message: Message, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администратору.")
         return
     filename = create_teachers_template()
@@ -2853,8 +2724,8 @@ async def send_teachers_template(message: Message):
     os.remove(filename)
 
 @dp.message(F.text == "Шаблон студентов")
-async def send_students_template(message: Message):
-    if not is_teacher(message.from_user.id):
+async def send_students_template(message: Message, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателям.")
         return
     
@@ -2866,8 +2737,8 @@ async def send_students_template(message: Message):
     os.remove(filename)
 
 @dp.message(F.text == "Отправить новость")
-async def admin_start_news(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def admin_start_news(message: Message, state: FSMContext, role: str):
+    if role != "admin":
         await message.answer("Команда доступна только администраторам.")
         return
     
@@ -2902,25 +2773,17 @@ async def admin_send_news(message: Message, state: FSMContext):
         # Жёстко прописываем имя администратора
         admin_name = "администратора"
         
-        cursor.execute("SELECT user_id FROM users WHERE role = ? OR ? = 'all'", 
-                      ('student' if recipient == 'students' else 'teacher' if recipient == 'teachers' else '', recipient))
-        users = cursor.fetchall()
+        users = await get_news_recipients(recipient)
         
         if not users:
             await message.answer("Нет пользователей для отправки новости.")
             await state.clear()
             return
         
-        sent_count = 0
-        for user_id, in users:
-            try:
-                await bot.send_message(user_id, f"📢 Новость от {admin_name}: {news_message}")
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Ошибка отправки новости пользователю {user_id}: {e}")
-        
-        await message.answer(f"Новость отправлена {sent_count} пользователям.")
+        # Рассылка идет в фоне, итог придет отдельным сообщением
         await state.clear()
+        await broadcaster.start(message.from_user.id, f"📢 Новость от {admin_name}: {news_message}",
+                                "пользователям", [user_id for user_id, in users])
     except sqlite3.OperationalError as e:
         logger.error(f"Ошибка при отправке новости: {e}")
         await message.answer("Ошибка при отправке новости.")
@@ -2931,13 +2794,13 @@ async def admin_send_news(message: Message, state: FSMContext):
         await state.clear()
 
 @dp.message(F.text == "Отправить новость группе")
-async def teacher_start_news(message: Message, state: FSMContext):
-    if not is_teacher(message.from_user.id):
+async def teacher_start_news(message: Message, state: FSMContext, role: str):
+    if role != "teacher":
         await message.answer("Команда доступна только преподавателям.")
         return
     
     teacher_id = message.from_user.id
-    groups = get_teacher_groups(teacher_id)
+    groups = await get_teacher_groups(teacher_id)
     
     if not groups:
         await message.answer("У вас нет групп.")
@@ -2972,28 +2835,20 @@ async def teacher_send_news(message: Message, state: FSMContext):
             return
         
         # Получаем имя преподавателя
-        cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (message.from_user.id,))
-        teacher_name = cursor.fetchone()
-        teacher_name = teacher_name[0] if teacher_name else "Преподаватель"
+        user_info = await get_user_info(message.from_user.id)
+        teacher_name = user_info[2] if user_info else "Преподаватель"
         
-        cursor.execute("SELECT student_id FROM students WHERE group_name = ?", (group_name,))
-        students = cursor.fetchall()
+        students = await get_group_student_ids(group_name)
         
         if not students:
-            await message.answer("В этой группе нет студентов.")
+            await message.answer("В этой группе нет студентов, зарегистрированных в боте.")
             await state.clear()
             return
         
-        sent_count = 0
-        for student_id, in students:
-            try:
-                await bot.send_message(student_id, f"📢 Новость от {teacher_name}: {news_message}")
-                sent_count += 1
-            except Exception as e:
-                logger.error(f"Ошибка отправки новости студенту {student_id}: {e}")
-        
-        await message.answer(f"Новость отправлена {sent_count} студентам группы '{group_name}'.")
+        # Рассылка идет в фоне, итог придет отдельным сообщением
         await state.clear()
+        await broadcaster.start(message.from_user.id, f"📢 Новость от {teacher_name}: {news_message}",
+                                f"студентам группы '{group_name}'", [student_id for student_id, in students])
     except sqlite3.OperationalError as e:
         logger.error(f"Ошибка при отправке новости группе {group_name}: {e}")
         await message.answer("Ошибка при отправке новости.")
@@ -3003,11 +2858,27 @@ async def teacher_send_news(message: Message, state: FSMContext):
         await message.answer("Произошла ошибка. Попробуйте позже.")
         await state.clear()
 
+@dp.startup()
+async def on_startup(bot: Bot):
+    await run_db(init_db)
+    await broadcaster.resume()
+    notification_outbox.start()
+    practice_reconciler.start()
+    token_rules_runner.start()
+
+@dp.shutdown()
+async def on_shutdown(bot: Bot):
+    await broadcaster.stop()
+    await notification_outbox.stop()
+    await practice_reconciler.stop()
+    await token_rules_runner.stop()
+
 async def main():
     try:
         await dp.start_polling(bot)
     finally:
-        conn.close()
+        report_workers.shutdown()
+        close_db()
 
 if __name__ == "__main__":
     import asyncio
@@ -0,0 +1,207 @@
+"""
+Фоновые рассылки новостей
+Сообщения отправляются параллельно; скорость ограничивает общий планировщик
+отправок (send_governor), рассылки идут с приоритетом массовых сообщений.
+Прогресс хранится в БД: после перезапуска бота незавершенные рассылки продолжаются.
+Получатели из реестра недоступных (delivery_status) не пробуются, а заблокировавшие
+бота во время рассылки попадают в реестр
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from db import db_task
+from delivery_status import mark_unreachable, reachable, unreachable_reason
+from send_governor import BULK, send_priority
+
+# Сколько сообщений рассылки отправляется одновременно
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 8))
+
+# Получателей за один проход; результаты прохода сохраняются в БД одной транзакцией
+BROADCAST_BATCH_SIZE = 200
+
+# Повторы при сетевых ошибках; RetryAfter повторяется всегда
+BROADCAST_MAX_RETRIES = 3
+
+# Как часто обновлять сообщение с прогрессом, сек
+BROADCAST_PROGRESS_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+@db_task
+def create_broadcast(cursor, sender_id: int, text: str, audience: str, recipient_ids: list):
+    cursor.execute("INSERT INTO broadcasts (sender_id, text, audience, created_at) VALUES (?, ?, ?, ?)",
+                  (sender_id, text, audience, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    broadcast_id = cursor.lastrowid
+    cursor.executemany("INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)",
+                       ((broadcast_id, user_id) for user_id in recipient_ids))
+    return broadcast_id
+
+@db_task
+def set_progress_message(cursor, broadcast_id: int, message_id: int):
+    cursor.execute("UPDATE broadcasts SET progress_message_id = ? WHERE broadcast_id = ?", (message_id, broadcast_id))
+
+@db_task
+def get_running_broadcasts(cursor):
+    cursor.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running' ORDER BY broadcast_id")
+    return [broadcast_id for broadcast_id, in cursor.fetchall()]
+
+@db_task
+def get_broadcast(cursor, broadcast_id: int):
+    cursor.execute("SELECT sender_id, text, audience, progress_message_id FROM broadcasts WHERE broadcast_id = ?",
+                  (broadcast_id,))
+    return cursor.fetchone()
+
+@db_task
+def get_pending_recipients(cursor, broadcast_id: int, limit: int):
+    # Стали недоступны после создания рассылки (например, отказ в outbox) - не пробуем
+    cursor.execute(f"""
+    UPDATE broadcast_recipients SET status = 'failed'
+    WHERE broadcast_id = ? AND status = 'pending' AND NOT {reachable('user_id')}
+    """, (broadcast_id,))
+    cursor.execute("""
+    SELECT user_id FROM broadcast_recipients
+    WHERE broadcast_id = ? AND status = 'pending'
+    LIMIT ?
+    """, (broadcast_id, limit))
+    return [user_id for user_id, in cursor.fetchall()]
+
+@db_task
+def save_results(cursor, broadcast_id: int, results: list, unreachable: list = ()):
+    """results: [(user_id, статус)], unreachable: [(user_id, причина, ошибка)]"""
+    cursor.executemany("UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?",
+                       ((status, broadcast_id, user_id) for user_id, status in results))
+    mark_unreachable(cursor, unreachable)
+
+@db_task
+def get_broadcast_stats(cursor, broadcast_id: int):
+    """Количество получателей по статусам: {'pending': .., 'sent': .., 'failed': ..}"""
+    cursor.execute("SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+                  (broadcast_id,))
+    stats = {'pending': 0, 'sent': 0, 'failed': 0}
+    stats.update(cursor.fetchall())
+    return stats
+
+@db_task
+def finish_broadcast(cursor, broadcast_id: int):
+    cursor.execute("UPDATE broadcasts SET status = 'done' WHERE broadcast_id = ?", (broadcast_id,))
+
+class Broadcaster:
+    """Запускает рассылки в фоне и сообщает отправителю о прогрессе"""
+
+    def __init__(self, bot, concurrency=BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.concurrency = concurrency
+        self._tasks = {}  # broadcast_id -> задача
+
+    async def start(self, sender_id: int, text: str, audience: str, recipient_ids: list):
+        """Сохраняет рассылку и запускает ее в фоне; возвращает broadcast_id"""
+        broadcast_id = await create_broadcast(sender_id, text, audience, recipient_ids)
+        message = await self.bot.send_message(sender_id, f"Рассылка начата: 0 из {len(recipient_ids)}.")
+        await set_progress_message(broadcast_id, message.message_id)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные остановкой бота"""
+        for broadcast_id in await get_running_broadcasts():
+            logger.info(f"Продолжаем рассылку {broadcast_id}")
+            self._spawn(broadcast_id)
+
+    async def stop(self):
+        """Прерывает рассылки; неотправленные сообщения останутся в БД до следующего запуска"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id):
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id):
+        send_priority.set(BULK)
+        try:
+            sender_id, text, audience, progress_message_id = await get_broadcast(broadcast_id)
+            loop = asyncio.get_running_loop()
+            reported_at = loop.time()
+            while True:
+                recipients = await get_pending_recipients(broadcast_id, BROADCAST_BATCH_SIZE)
+                if not recipients:
+                    break
+                results, unreachable = await self._send_batch(recipients, text)
+                await save_results(broadcast_id, results, unreachable)
+                if loop.time() - reported_at >= BROADCAST_PROGRESS_INTERVAL:
+                    reported_at = loop.time()
+                    stats = await get_broadcast_stats(broadcast_id)
+                    await self._report(sender_id, progress_message_id, self._progress_text(stats))
+
+            stats = await get_broadcast_stats(broadcast_id)
+            await finish_broadcast(broadcast_id)
+            await self._report(sender_id, progress_message_id, self._progress_text(stats))
+            response = f"Новость отправлена {stats['sent']} {audience}."
+            if stats['failed']:
+                response += f"\nНе доставлено: {stats['failed']}."
+            await self.bot.send_message(sender_id, response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка рассылки {broadcast_id}: {e}")
+
+    async def _send_batch(self, recipients, text):
+        """Отправляет сообщение получателям.
+
+        Возвращает [(user_id, статус)] и недоступных получателей [(user_id, причина, ошибка)].
+        """
+        queue = list(reversed(recipients))
+        results, unreachable = [], []
+
+        async def worker():
+            while queue:
+                user_id = queue.pop()
+                results.append((user_id, await self._send(user_id, text, unreachable)))
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(recipients)))))
+        return results, unreachable
+
+    async def _send(self, user_id, text, unreachable):
+        attempt = 0
+        while True:
+            try:
+                await self.bot.send_message(user_id, text)
+                return 'sent'
+            except TelegramRetryAfter as e:
+                # Планировщик уже повторял запрос; ждем и пробуем снова
+                logger.warning(f"Рассылка: RetryAfter {e.retry_after} с")
+                await asyncio.sleep(e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                logger.error(f"Ошибка отправки новости пользователю {user_id}: {e}")
+                reason = unreachable_reason(e)
+                if reason:
+                    unreachable.append((user_id, reason, str(e)))
+                return 'failed'
+            except Exception as e:
+                attempt += 1
+                if attempt > BROADCAST_MAX_RETRIES:
+                    logger.error(f"Ошибка отправки новости пользователю {user_id}: {e}")
+                    return 'failed'
+                await asyncio.sleep(attempt)
+
+    def _progress_text(self, stats):
+        total = sum(stats.values())
+        done = stats['sent'] + stats['failed']
+        if done == total:
+            return f"Рассылка завершена: доставлено {stats['sent']} из {total}."
+        return f"Рассылка: обработано {done} из {total}, доставлено {stats['sent']}."
+
+    async def _report(self, chat_id, message_id, text):
+        try:
+            await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
@@ -0,0 +1,123 @@
+"""
+Проверка счетчиков сданных практик (practice_progress) и посещаемости (attendance)
+против полного пересчета по оценкам
+Запуск: python check_practice_progress.py [путь к students.db]
+Проверка идет на копии БД в памяти: сначала на данных из файла, затем на случайной
+последовательности изменений оценок и КТП. Завершается с кодом 1 при расхождении
+"""
+import random
+import sqlite3
+import sys
+
+import attendance
+import db
+from migrations import migrate
+from practice_progress import completed_practices, find_mismatches
+
+# Запрос, который счетчики заменили
+RECOUNT_QUERY = """
+SELECT COUNT(DISTINCT k.practice_number)
+FROM grades g
+JOIN ktp k ON g.ktp_id = k.ktp_id
+WHERE g.student_id = ? AND g.discipline_id = ? AND k.type = 'practice'
+AND g.grade >= 1 AND g.grade != -1
+"""
+
+STEPS = 3000
+
+def compare(cursor):
+    """Расхождения: счетчики против пересчета и против прежнего запроса по каждой паре"""
+    problems = [f"practice_passes/progress: {mismatch}" for mismatch in find_mismatches(cursor)]
+    problems += [f"attendance: {mismatch}" for mismatch in attendance.find_mismatches(cursor)]
+    cursor.execute("""
+    SELECT student_id, discipline_id FROM grades
+    UNION SELECT student_id, discipline_id FROM practice_progress
+    """)
+    for student_id, discipline_id in cursor.fetchall():
+        cursor.execute(RECOUNT_QUERY, (student_id, discipline_id))
+        expected = cursor.fetchone()[0]
+        actual = completed_practices(cursor, student_id, discipline_id)
+        if actual != expected:
+            problems.append(f"студент {student_id}, дисциплина {discipline_id}: {actual} вместо {expected}")
+    return problems
+
+def random_step(cursor, rng):
+    """Одно случайное изменение оценок или КТП, как их делают бот и API"""
+    cursor.execute("SELECT grade_id FROM grades")
+    grade_ids = [grade_id for grade_id, in cursor.fetchall()]
+    cursor.execute("SELECT ktp_id FROM ktp")
+    ktp_ids = [ktp_id for ktp_id, in cursor.fetchall()]
+    students = range(1, 8)
+    disciplines = range(1, 4)
+    action = rng.choices(
+        ["insert", "update_grade", "update_student", "delete", "add_ktp", "remove_ktp", "drop_ktp", "update_ktp"],
+        weights=[40, 20, 5, 10, 5, 3, 2, 2])[0]
+
+    if action == "add_ktp" or not ktp_ids:
+        ktp_type = rng.choice(["practice", "practice", "lecture"])
+        number = rng.choice([1, 2, 3, None]) if ktp_type == "practice" else None
+        # Явный ktp_id: бывает, что номер удаленного КТП занимает новый
+        ktp_id = rng.choice([max(ktp_ids, default=0) + 1] + [i for i in range(1, 15) if i not in ktp_ids])
+        cursor.execute("""
+        INSERT INTO ktp (ktp_id, teacher_id, discipline_id, group_name, type, description, practice_number)
+        VALUES (?, 1, ?, ?, ?, 'КТП', ?)
+        """, (ktp_id, rng.choice(disciplines), rng.choice(["А", "Б"]), ktp_type, number))
+    elif action == "insert" or not grade_ids:
+        cursor.execute("""
+        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date)
+        VALUES (?, 1, ?, ?, ?, '01-09-2025')
+        """, (rng.choice(students), rng.choice(disciplines), rng.choice(ktp_ids + [999]), rng.choice([-1, 0, 1, 3, 5])))
+    elif action == "update_grade":
+        cursor.execute("UPDATE grades SET grade = ? WHERE grade_id = ?", (rng.choice([-1, 0, 2, 5]), rng.choice(grade_ids)))
+    elif action == "update_student":
+        # Перенос оценок при регистрации студента
+        old, new = rng.sample(students, 2)
+        cursor.execute("UPDATE grades SET student_id = ? WHERE student_id = ?", (new, old))
+    elif action == "delete":
+        cursor.execute("DELETE FROM grades WHERE grade_id = ?", (rng.choice(grade_ids),))
+    elif action == "remove_ktp":
+        # remove_ktp: сначала оценки, затем КТП
+        ktp_id = rng.choice(ktp_ids)
+        cursor.execute("DELETE FROM grades WHERE ktp_id = ?", (ktp_id,))
+        cursor.execute("DELETE FROM ktp WHERE ktp_id = ?", (ktp_id,))
+    elif action == "drop_ktp":
+        # remove_group: КТП удаляются, оценки остаются
+        cursor.execute("DELETE FROM ktp WHERE ktp_id = ?", (rng.choice(ktp_ids),))
+    else:
+        cursor.execute("UPDATE ktp SET practice_number = ?, type = ? WHERE ktp_id = ?",
+                      (rng.choice([1, 2, 4]), rng.choice(["practice", "lecture"]), rng.choice(ktp_ids)))
+    return action
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else db.DB_PATH
+    # Только чтение: исходный файл не меняется
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn = sqlite3.connect(":memory:")
+    source.backup(conn)
+    source.close()
+    migrate(conn)
+    cursor = conn.cursor()
+
+    problems = compare(cursor)
+    if problems:
+        print(f"✗ данные {path}:\n  " + "\n  ".join(problems[:20]))
+        sys.exit(1)
+    print(f"✓ данные {path}: счетчики совпадают с пересчетом")
+
+    # Случайные изменения на пустых таблицах оценок и КТП
+    cursor.execute("DELETE FROM grades")
+    cursor.execute("DELETE FROM ktp")
+    rng = random.Random(20251017)
+    for step in range(1, STEPS + 1):
+        action = random_step(cursor, rng)
+        problems = compare(cursor)
+        if problems:
+            print(f"✗ шаг {step} ({action}):\n  " + "\n  ".join(problems[:20]))
+            sys.exit(1)
+    cursor.execute("SELECT COUNT(*) FROM grades")
+    print(f"✓ {STEPS} случайных изменений оценок и КТП: счетчики совпадают с пересчетом "
+          f"(оценок в конце: {cursor.fetchone()[0]})")
+    conn.close()
+
+if __name__ == '__main__':
+    main()
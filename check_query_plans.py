@@ -0,0 +1,165 @@
+"""
+Проверка планов частых запросов бота и API
+Запуск: python check_query_plans.py [путь к students.db]
+Завершается с кодом 1, если какой-либо запрос читает таблицу целиком
+"""
+import sqlite3
+import sys
+
+import db
+from migrations import migrate
+
+# Частые запросы (из bot_main.py и bot_api_server.py) с примерными параметрами
+HOT_QUERIES = {
+    "get_student_grades": ("""
+        SELECT g.grade, g.date, d.name, u.full_name, k.description, k.homework
+        FROM grades g
+        JOIN disciplines d ON g.discipline_id = d.discipline_id
+        JOIN users u ON g.teacher_id = u.user_id
+        LEFT JOIN ktp k ON g.ktp_id = k.ktp_id
+        WHERE g.student_id = ?
+        ORDER BY g.date DESC
+    """, (1,)),
+    "get_student_practices": ("""
+        SELECT d.name, d.required_practices, COALESCE(p.completed, 0)
+        FROM disciplines d
+        JOIN student_teacher st ON d.teacher_id = st.teacher_id
+        LEFT JOIN practice_progress p ON p.student_id = st.student_id AND p.discipline_id = d.discipline_id
+        WHERE st.student_id = ? AND d.group_name = (SELECT group_name FROM students WHERE student_id = ?)
+    """, (1, 1)),
+    "create_gradebook": ("""
+        SELECT g.student_id, g.teacher_id, g.date, g.ktp_id, g.grade, k.type, k.practice_number, k.ktp_id IS NOT NULL
+        FROM grades g
+        LEFT JOIN ktp k ON g.ktp_id = k.ktp_id
+        WHERE g.discipline_id = ?
+        ORDER BY g.grade_id
+    """, (1,)),
+    "discipline_attendance": ("""
+        SELECT student_id, attended, total FROM attendance WHERE discipline_id = ?
+    """, (1,)),
+    "student_attendance": ("""
+        SELECT a.discipline_id, d.name, a.attended, a.total
+        FROM attendance a
+        JOIN disciplines d ON d.discipline_id = a.discipline_id
+        WHERE a.student_id = ?
+        ORDER BY d.name
+    """, (1,)),
+    "check_all_practices_completed": ("""
+        SELECT COUNT(DISTINCT k.practice_number)
+        FROM grades g
+        JOIN ktp k ON g.ktp_id = k.ktp_id
+        WHERE g.student_id = ? AND g.discipline_id = ? AND k.type = 'practice'
+        AND g.grade >= 1 AND g.grade != -1
+    """, (1, 1)),
+    "record_practice_completion: дата практики": ("""
+        SELECT date FROM grades
+        WHERE discipline_id = ? AND ktp_id IN (
+            SELECT ktp_id FROM ktp WHERE discipline_id = ? AND practice_number = ? AND type = 'practice'
+        )
+        LIMIT 1
+    """, (1, 1, 1)),
+    "token_rules: состояние правила": ("""
+        SELECT value FROM token_rule_state WHERE rule = ? AND student_id = ? AND discipline_id = ? AND item = ?
+    """, ("first_finisher", 1, 1, "completed")),
+    "token_rules: новые события": ("""
+        SELECT MAX(event_id) FROM (SELECT event_id FROM grade_events WHERE event_id > ? ORDER BY event_id LIMIT ?)
+    """, (0, 500)),
+    "token_rules: перенос на новый student_id": ("""
+        UPDATE token_rule_state SET student_id = ? WHERE student_id = ?
+    """, (2, 1)),
+    "get_practice_stats": ("""
+        SELECT practice_number, COUNT(*) FROM practice_passes
+        WHERE discipline_id = ?
+        GROUP BY practice_number
+    """, (1,)),
+    "save_grade / edit_grade": ("""
+        SELECT grade_id, grade FROM grades WHERE student_id = ? AND discipline_id = ? AND ktp_id = ?
+    """, (1, 1, 1)),
+    "get_ktp_grades": ("""
+        SELECT student_id, grade FROM grades WHERE discipline_id = ? AND ktp_id = ? ORDER BY grade_id
+    """, (1, 1)),
+    "get_graded_ktps": ("""
+        SELECT DISTINCT k.ktp_id, k.discipline_id, k.group_name, k.description, d.name
+        FROM ktp k
+        JOIN grades g ON k.ktp_id = g.ktp_id
+        JOIN disciplines d ON k.discipline_id = d.discipline_id
+        WHERE k.teacher_id = ? AND g.date = ? AND k.discipline_id = ?
+    """, (1, "01-01-2025", 1)),
+    "get_ktp_by_discipline_and_type": ("""
+        SELECT k.ktp_id, k.group_name, k.type, k.description, k.practice_number
+        FROM ktp k
+        WHERE k.teacher_id = ? AND k.discipline_id = ? AND k.type = ?
+        ORDER BY k.description
+    """, (1, 1, "practice")),
+    "get_group_students": ("""
+        SELECT s.student_id, u.full_name
+        FROM group_students gs
+        JOIN students s ON gs.student_id = s.student_id
+        JOIN users u ON s.student_id = u.user_id
+        JOIN student_groups sg ON gs.group_id = sg.group_id
+        WHERE sg.group_name = ? AND sg.teacher_id = ?
+        ORDER BY u.full_name
+    """, ("ИС-1", 1)),
+    "get_teacher_groups": ("""
+        SELECT DISTINCT group_name FROM student_groups WHERE teacher_id = ? ORDER BY group_name
+    """, (1,)),
+    "get_teacher_disciplines": ("""
+        SELECT discipline_id, name, group_name FROM disciplines WHERE teacher_id = ? ORDER BY name
+    """, (1,)),
+    "get_teacher_students": ("""
+        SELECT DISTINCT s.student_id, u.full_name, s.group_name
+        FROM students s
+        JOIN users u ON s.student_id = u.user_id
+        JOIN student_teacher st ON s.student_id = st.student_id
+        WHERE st.teacher_id = ?
+        ORDER BY u.full_name
+    """, (1,)),
+    "register_student": ("""
+        SELECT student_id FROM students WHERE full_name = ? AND group_name = ?
+    """, ("Иванов", "ИС-1")),
+    "get_group_student_ids": ("""
+        SELECT student_id FROM students WHERE group_name = ?
+    """, ("ИС-1",)),
+    "get_teacher_rewards": ("""
+        SELECT r.reward_id, r.name, r.description, r.price, r.is_enabled, d.name
+        FROM rewards r
+        JOIN disciplines d ON r.discipline_id = d.discipline_id
+        WHERE r.teacher_id = ?
+        ORDER BY d.name, r.name
+    """, (1,)),
+}
+
+def full_scans(cursor, sql, params):
+    """Строки плана, в которых таблица читается целиком"""
+    cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[3] for row in cursor.fetchall()
+            if row[3].startswith("SCAN ") and "USING" not in row[3]]
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else db.DB_PATH
+    source = sqlite3.connect(path)
+    conn = sqlite3.connect(":memory:")
+    # Проверяем на копии схемы, рабочая БД не меняется
+    for (sql,) in source.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name != 'sqlite_sequence'"):
+        conn.execute(sql)
+    source.close()
+    migrate(conn)
+    cursor = conn.cursor()
+
+    failed = 0
+    for name, (sql, params) in HOT_QUERIES.items():
+        scans = full_scans(cursor, sql, params)
+        if scans:
+            failed += 1
+            print(f"✗ {name}: {'; '.join(scans)}")
+        else:
+            print(f"✓ {name}")
+
+    conn.close()
+    if failed:
+        print(f"\nЗапросов с полным чтением таблицы: {failed}")
+        sys.exit(1)
+    print("\nВсе запросы используют индексы")
+
+if __name__ == '__main__':
+    main()
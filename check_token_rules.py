@@ -0,0 +1,132 @@
+"""
+Проверка правил начисления жетонов: начисления по ходу против replay журнала
+Запуск: python check_token_rules.py
+На пустой БД в памяти выполняется случайная последовательность выставлений и
+изменений оценок; события обрабатываются по ходу (как в боте) пачками разного
+размера. Затем журнал grade_events прогоняется заново с пустым состоянием
+(token_rules.replay): начисления, состояние правил и балансы должны совпасть.
+Завершается с кодом 1 при расхождении
+"""
+import random
+import sqlite3
+import sys
+
+from migrations import migrate
+from token_engine import load_events, process_pending, rekey_student
+from token_rules import RULES, replay
+
+STEPS = 3000
+DATES = ["01-09-2025", "08-09-2025", "15-09-2025"]
+
+def setup(cursor):
+    """Преподаватель, 3 дисциплины с практиками и лекциями, 6 студентов"""
+    cursor.execute("INSERT INTO teachers (teacher_id, full_name, token, tokens_per_attendance) VALUES (1, 'Т', 't', 2)")
+    cursor.execute("INSERT INTO users (user_id, full_name, role) VALUES (1, 'Т', 'teacher')")
+    for discipline_id, required in ((1, 2), (2, 3), (3, 1)):
+        cursor.execute("""
+        INSERT INTO disciplines (discipline_id, teacher_id, name, group_name, required_practices)
+        VALUES (?, 1, ?, 'А', ?)
+        """, (discipline_id, f"Дисциплина {discipline_id}", required))
+        for number in (1, 2, 3):
+            cursor.execute("""
+            INSERT INTO ktp (teacher_id, discipline_id, group_name, type, description, practice_number)
+            VALUES (1, ?, 'А', 'practice', 'Практика', ?)
+            """, (discipline_id, number))
+        cursor.execute("""
+        INSERT INTO ktp (teacher_id, discipline_id, group_name, type, description) VALUES (1, ?, 'А', 'lecture', 'Лекция')
+        """, (discipline_id,))
+    for student_id in range(101, 107):
+        cursor.execute("INSERT INTO users (user_id, full_name, role) VALUES (?, ?, 'student')",
+                      (student_id, f"Студент {student_id}"))
+        cursor.execute("INSERT INTO students (student_id, full_name, group_name) VALUES (?, ?, 'А')",
+                      (student_id, f"Студент {student_id}"))
+        cursor.execute("INSERT INTO student_teacher (student_id, teacher_id, tokens) VALUES (?, 1, 0)", (student_id,))
+
+def random_step(cursor, rng):
+    """Одно случайное изменение, как их делают бот и API"""
+    cursor.execute("SELECT grade_id FROM grades")
+    grade_ids = [grade_id for grade_id, in cursor.fetchall()]
+    cursor.execute("SELECT student_id FROM students")
+    students = [student_id for student_id, in cursor.fetchall()]
+    action = rng.choices(["insert", "update", "rekey", "tokens"], weights=[60, 30, 1, 2])[0]
+
+    if action == "insert" or not grade_ids:
+        cursor.execute("SELECT ktp_id, discipline_id FROM ktp ORDER BY ktp_id")
+        ktp_id, discipline_id = rng.choice(cursor.fetchall())
+        cursor.execute("""
+        INSERT INTO grades (student_id, teacher_id, discipline_id, ktp_id, grade, date) VALUES (?, 1, ?, ?, ?, ?)
+        """, (rng.choice(students), discipline_id, ktp_id, rng.choice([-1, 0, 1, 3, 5, 5]), rng.choice(DATES)))
+    elif action == "update":
+        cursor.execute("UPDATE grades SET grade = ? WHERE grade_id = ?", (rng.choice([-1, 0, 2, 5]), rng.choice(grade_ids)))
+    elif action == "rekey":
+        # Регистрация: студент получает новый id, как в register_student
+        old = rng.choice(students)
+        new = max(students) + 1
+        for table in ("students", "student_teacher", "grades"):
+            cursor.execute(f"UPDATE {table} SET student_id = ? WHERE student_id = ?", (new, old))
+        cursor.execute("UPDATE users SET user_id = ? WHERE user_id = ?", (new, old))
+        rekey_student(cursor, old, new)
+    else:
+        cursor.execute("UPDATE teachers SET tokens_per_attendance = ? WHERE teacher_id = 1", (rng.choice([0, 1, 2]),))
+    return action
+
+def compare(cursor):
+    """Расхождения начислений, состояния правил и балансов с replay журнала"""
+    problems = []
+    awards, states = replay(load_events(cursor), RULES)
+    expected = sorted((event_id, *award) for event_id, award in awards)
+    cursor.execute("""
+    SELECT event_id, rule, student_id, teacher_id, discipline_id, tokens, detail FROM token_awards ORDER BY award_id
+    """)
+    actual = sorted(cursor.fetchall())
+    if actual != expected:
+        diff = sorted(set(actual) ^ set(expected))
+        problems.append(f"начисления: {len(actual)} по ходу, {len(expected)} при replay; различия: {diff[:10]}")
+
+    expected_state = {(rule, *key): value for rule, state in states.items() for key, value in state.values.items()}
+    cursor.execute("SELECT rule, student_id, discipline_id, item, value FROM token_rule_state WHERE rule != 'engine'")
+    actual_state = {row[:4]: row[4] for row in cursor.fetchall()}
+    if actual_state != expected_state:
+        keys = sorted(set(actual_state) ^ set(expected_state)
+                      | {key for key in actual_state if actual_state[key] != expected_state.get(key)})
+        problems.append(f"состояние правил: {[(key, actual_state.get(key), expected_state.get(key)) for key in keys[:10]]}")
+
+    # Балансы начинаются с 0 и меняются только правилами
+    cursor.execute("""
+    SELECT st.student_id, st.tokens, COALESCE(SUM(a.tokens), 0)
+    FROM student_teacher st
+    LEFT JOIN token_awards a ON a.student_id = st.student_id AND a.teacher_id = st.teacher_id
+    GROUP BY st.student_id, st.teacher_id
+    HAVING st.tokens != COALESCE(SUM(a.tokens), 0)
+    """)
+    problems += [f"баланс студента {student_id}: {tokens}, по журналу {total}" for student_id, tokens, total in cursor.fetchall()]
+    return problems
+
+def main():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    cursor = conn.cursor()
+    setup(cursor)
+
+    rng = random.Random(20251017)
+    for step in range(1, STEPS + 1):
+        random_step(cursor, rng)
+        # Как правило события обрабатываются сразу, иногда копятся (оценки из API)
+        if rng.random() < 0.7:
+            process_pending(cursor, limit=rng.choice([1, 3, 500]))
+    while process_pending(cursor):
+        pass
+
+    problems = compare(cursor)
+    if problems:
+        print("✗ " + "\n✗ ".join(problems))
+        sys.exit(1)
+    cursor.execute("SELECT rule, COUNT(*), SUM(tokens) FROM token_awards GROUP BY rule ORDER BY rule")
+    summary = ", ".join(f"{rule}: {count} ({tokens} жетонов)" for rule, count, tokens in cursor.fetchall())
+    cursor.execute("SELECT COUNT(*) FROM grade_events")
+    print(f"✓ {STEPS} случайных изменений, событий: {cursor.fetchone()[0]}; "
+          f"начисления по ходу совпадают с replay журнала ({summary})")
+    conn.close()
+
+if __name__ == '__main__':
+    main()
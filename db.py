@@ -0,0 +1,138 @@
+"""
+Доступ к SQLite БД бота без блокировки event loop
+Все запросы выполняются в потоках БД, handlers только ожидают результат
+"""
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial, wraps
+
+# Путь к БД бота
+DB_PATH = 'students.db'
+
+# Количество потоков БД; у каждого потока свое соединение
+DB_WORKERS = 4
+
+# Профиль хранилища: PRAGMA для каждого нового соединения бота и API.
+# WAL позволяет читать из API, пока бот пишет, и наоборот
+STORAGE_PROFILE = {
+    'journal_mode': os.environ.get('DB_JOURNAL_MODE', 'WAL'),
+    'busy_timeout': int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000)),
+    'synchronous': os.environ.get('DB_SYNCHRONOUS', 'NORMAL'),
+    'cache_size': int(os.environ.get('DB_CACHE_SIZE', -16000)),  # отрицательное значение - в КБ
+    'mmap_size': int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024)),
+    'temp_store': os.environ.get('DB_TEMP_STORE', 'MEMORY'),
+}
+
+# Повторы при SQLITE_BUSY, которые не покрыл busy_timeout
+DB_BUSY_RETRIES = 3
+DB_BUSY_BACKOFF = 0.05  # сек, удваивается с каждой попыткой
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+def apply_storage_profile(conn, profile=STORAGE_PROFILE):
+    """Применяет PRAGMA профиля хранилища к соединению"""
+    for name, value in profile.items():
+        if not str(value).lstrip('-').isalnum():
+            raise ValueError(f"Недопустимое значение PRAGMA {name}: {value}")
+        conn.execute(f"PRAGMA {name} = {value}")
+
+def is_busy_error(e):
+    """Ошибка блокировки БД другим соединением"""
+    if not isinstance(e, sqlite3.OperationalError):
+        return False
+    code = getattr(e, 'sqlite_errorcode', None)
+    if code is not None:
+        return (code & 0xff) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(e)
+    return 'database is locked' in message or 'database is busy' in message
+
+def retry_on_busy(func):
+    """Повторяет функцию при SQLITE_BUSY с экспоненциальной задержкой.
+
+    Функция должна откатывать свою транзакцию при ошибке, чтобы повтор
+    начинался с чистого состояния.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(DB_BUSY_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if attempt == DB_BUSY_RETRIES or not is_busy_error(e):
+                    raise
+                delay = DB_BUSY_BACKOFF * 2 ** attempt * (1 + random.random())
+                logger.warning(f"БД занята ({e}), повтор через {delay:.2f} с")
+                time.sleep(delay)
+    return wrapper
+
+def get_connection():
+    """Соединение текущего потока, создается при первом обращении"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        apply_storage_profile(conn)
+        _local.conn = conn
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+@contextmanager
+def unit_of_work():
+    """Собственный курсор и транзакция на одну единицу работы.
+
+    При успешном выходе транзакция фиксируется, при исключении откатывается.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        yield cursor
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет синхронную функцию работы с БД в потоке БД"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+def db_task(func):
+    """Делает функцию работы с БД awaitable.
+
+    Функция выполняется в потоке БД внутри unit_of_work и получает курсор
+    первым аргументом; при SQLITE_BUSY транзакция повторяется целиком.
+    Из другой задачи БД синхронную версию вызывают как
+    func.__wrapped__(cursor, ...) - в той же транзакции.
+    """
+    @retry_on_busy
+    def run(*args, **kwargs):
+        with unit_of_work() as cursor:
+            return func(cursor, *args, **kwargs)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(run, *args, **kwargs)
+    return wrapper
+
+def close_db():
+    """Останавливает потоки БД и закрывает соединения"""
+    db_executor.shutdown(wait=True)
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
@@ -0,0 +1,58 @@
+"""
+Реестр недоступных получателей
+Сюда попадают пользователи, которым писать бесполезно: заблокировали бота или чат
+не найден, а также импортированные студенты, еще не зарегистрированные в боте (их
+user_id - номер из таблицы students, а не id Telegram). Рассылки и уведомления таких
+получателей пропускают; запись снимается, когда пользователь регистрируется или
+пишет боту /start
+"""
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from db import db_task
+
+# Причины недоступности
+BLOCKED = 'blocked'  # бот заблокирован или аккаунт удален
+NOT_FOUND = 'not_found'  # чат не найден
+PLACEHOLDER = 'placeholder'  # студент импортирован, но не регистрировался
+
+def unreachable_reason(error):
+    """Причина недоступности по ошибке Telegram; None - ошибка не связана с получателем"""
+    if isinstance(error, TelegramForbiddenError):
+        return BLOCKED
+    if isinstance(error, TelegramBadRequest) and 'chat not found' in str(error).lower():
+        return NOT_FOUND
+    return None
+
+def reachable(column: str) -> str:
+    """Условие SQL: получатель из column не в реестре"""
+    return f"{column} NOT IN (SELECT user_id FROM unreachable_recipients)"
+
+def mark_unreachable(cursor, failures):
+    """failures: [(user_id, причина, текст ошибки)]; вызывается внутри задачи БД"""
+    now = time.time()
+    cursor.executemany("""
+    INSERT OR IGNORE INTO unreachable_recipients (user_id, reason, error, marked_at)
+    VALUES (?, ?, ?, ?)
+    """, ((user_id, reason, error, now) for user_id, reason, error in failures))
+
+def reset_unreachable(cursor, *user_ids: int):
+    """Снимает отметку с получателей (пользователь зарегистрировался или снова пишет боту)"""
+    cursor.executemany("DELETE FROM unreachable_recipients WHERE user_id = ?", ((user_id,) for user_id in user_ids))
+
+@db_task
+def record_unreachable(cursor, failures: list):
+    mark_unreachable(cursor, failures)
+
+@db_task
+def reset_recipient(cursor, user_id: int):
+    reset_unreachable(cursor, user_id)
+
+@db_task
+def get_unreachable_stats(cursor):
+    """Количество недоступных получателей по причинам"""
+    cursor.execute("SELECT reason, COUNT(*) FROM unreachable_recipients GROUP BY reason")
+    stats = {BLOCKED: 0, NOT_FOUND: 0, PLACEHOLDER: 0}
+    stats.update(cursor.fetchall())
+    return stats
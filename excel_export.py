@@ -0,0 +1,136 @@
+"""
+Выгрузка таблиц бота в Excel (.xlsx) в памяти
+Лист пишется в потоковом режиме openpyxl (write_only), файлы на диск не сохраняются.
+Функции не обращаются к БД и выполняются в процессах отчетов (reports.py)
+"""
+import io
+
+import openpyxl
+import pandas as pd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment
+from openpyxl.utils import get_column_letter
+
+from attendance import percentage
+
+BOLD = Font(bold=True)
+CENTER = Alignment(horizontal='center')
+
+def column_width(value):
+    """Ширина столбца по длине значения ячейки"""
+    return len(str(value or "")) + 2
+
+def build_xlsx(title, headers, rows, preamble=()):
+    """Собирает книгу с одним листом и возвращает содержимое .xlsx в байтах.
+
+    preamble - строки над таблицей (через пустую строку), headers - шапка,
+    rows - строки данных. В потоковом режиме ширины столбцов записываются
+    до строк, поэтому они считаются в том же проходе, где готовятся строки.
+    """
+    widths = []
+    styled_rows = []
+
+    def add(values, font=None):
+        for col_num, value in enumerate(values):
+            width = column_width(value)
+            if col_num == len(widths):
+                widths.append(width)
+            elif width > widths[col_num]:
+                widths[col_num] = width
+        styled_rows.append((values, font))
+
+    for values in preamble:
+        add(list(values), BOLD)
+    if preamble:
+        add([])
+    add(list(headers), BOLD)
+    for values in rows:
+        add(list(values))
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    for col_num, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(col_num)].width = width
+
+    for values, font in styled_rows:
+        row = []
+        for value in values:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.alignment = CENTER
+            if font:
+                cell.font = font
+            row.append(cell)
+        ws.append(row)
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+def grades_xlsx(grades):
+    """Оценки студента: строки get_student_grades"""
+    headers = ["Оценка", "Дата", "Дисциплина", "Преподаватель", "Описание КТП", "Домашнее задание"]
+    rows = (["н" if value == -1 else value for value in row_data] for row_data in grades)
+    return build_xlsx("Оценки", headers, rows)
+
+def gradebook_xlsx(teacher_id, discipline_name, group_name, students, grades, attendance):
+    """Ведомость группы по дисциплине.
+
+    grades - все оценки дисциплины: (student_id, teacher_id, date, ktp_id, grade,
+    type, practice_number, has_ktp) в порядке выставления; attendance - счетчики
+    посещаемости {student_id: (посещено, всего)}.
+    """
+    grades_df = pd.DataFrame(grades, columns=[
+        "student_id", "teacher_id", "date", "ktp_id", "grade", "type", "practice_number", "has_ktp"
+    ])
+    
+    # Уникальные комбинации date и ktp_id, где есть оценки преподавателя
+    columns_df = grades_df[
+        (grades_df["teacher_id"] == teacher_id) & grades_df["grade"].notna()
+        & (grades_df["grade"] != -1) & (grades_df["has_ktp"] == 1)
+    ]
+    date_ktp_pairs = [
+        (date, int(ktp_id), ktp_type, None if pd.isna(practice_number) else int(practice_number))
+        for date, ktp_id, ktp_type, practice_number in columns_df[["date", "ktp_id", "type", "practice_number"]]
+        .drop_duplicates(["date", "ktp_id"])
+        .sort_values(["date", "ktp_id"])
+        .itertuples(index=False, name=None)
+    ]
+    
+    student_ids = [student_id for student_id, _ in students]
+    # Ячейка ведомости - первая оценка студента за КТП в этот день
+    cells = (
+        grades_df.drop_duplicates(["student_id", "date", "ktp_id"])
+        .pivot(index="student_id", columns=["date", "ktp_id"], values="grade")
+        .reindex(index=student_ids, columns=pd.MultiIndex.from_tuples(
+            [(date, ktp_id) for date, ktp_id, _, _ in date_ktp_pairs], names=["date", "ktp_id"]))
+    )
+    present = cells.where(cells != -1)
+    averages = present.mean(axis=1).fillna(0)
+    # Посещаемость по всем оценкам дисциплины: доля оценок, кроме "н"
+    attendance = [percentage(*attendance.get(student_id, (0, 0))) for student_id in student_ids]
+    
+    # Формируем заголовки: номер, ФИО, даты с номерами КТП, средний балл, посещаемость
+    headers = ["№", "ФИО студента"]
+    ktp_counters = {"lecture": {}, "practice": {}}  # Счетчики для лекций и практик по датам
+    for date, ktp_id, ktp_type, practice_number in date_ktp_pairs:
+        if ktp_type == "lecture":
+            if date not in ktp_counters["lecture"]:
+                ktp_counters["lecture"][date] = 1
+            else:
+                ktp_counters["lecture"][date] += 1
+            header = f"{date} Лекция #{ktp_counters['lecture'][date]}"
+        else:  # practice
+            header = f"{date} Практика #{practice_number or 'N/A'}"
+        headers.append(header)
+    headers += ["Средний балл", "Посещаемость (%)"]
+    
+    rows = (
+        [row_num, full_name]
+        + ["" if pd.isna(grade) else str(int(grade)) for grade in row_grades]
+        + [round(float(avg), 2), round(float(student_attendance), 2)]
+        for row_num, ((student_id, full_name), row_grades, avg, student_attendance)
+        in enumerate(zip(students, present.to_numpy().tolist(), averages, attendance), 1)
+    )
+    preamble = [[f"Ведомость по дисциплине: {discipline_name}"], [f"Группа: {group_name}"]]
+    
+    return build_xlsx("Ведомость", headers, rows, preamble)
@@ -0,0 +1,45 @@
+"""
+Чтение загруженных Excel (.xlsx) файлов построчно
+Лист читается в режиме openpyxl read_only, файл целиком в память не загружается
+"""
+import openpyxl
+
+def _header(ws):
+    first_row = next(ws.iter_rows(max_row=1, values_only=True), ())
+    return [str(value).strip() if value is not None else None for value in first_row]
+
+def missing_columns(source, columns):
+    """Колонки из columns, которых нет в первой строке листа"""
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        header = _header(wb.active)
+    finally:
+        wb.close()
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return [column for column in columns if column not in header]
+
+def clean_value(value):
+    """Значение ячейки как строка без пробелов по краям; пустая ячейка - None"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def iter_rows(source, columns):
+    """Строки листа (без заголовка) как кортежи значений колонок columns.
+
+    Колонки ищутся по заголовку в первой строке; значения очищены clean_value.
+    """
+    wb = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        header = _header(ws)
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"В файле нет колонок: {', '.join(missing)}")
+        indexes = [header.index(column) for column in columns]
+        for row in ws.iter_rows(min_row=2, values_only=True):
+            yield tuple(clean_value(row[i]) if i < len(row) else None for i in indexes)
+    finally:
+        wb.close()
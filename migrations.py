@@ -0,0 +1,622 @@
+"""
+Версионные миграции схемы БД бота
+Версия схемы хранится в PRAGMA user_version: при актуальной схеме DDL не выполняется,
+новые миграции применяются одной транзакцией.
+Проверка на копии БД: python migrations.py [путь к students.db] - исходный файл не меняется
+"""
+import logging
+import sqlite3
+import sys
+
+logger = logging.getLogger(__name__)
+
+def add_column(cursor, table: str, column: str, definition: str):
+    """Добавляет столбец, если его еще нет"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column in {row[1] for row in cursor.fetchall()}:
+        return
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    logger.info(f"Столбец '{column}' добавлен в таблицу {table}.")
+
+def migration_1(cursor):
+    """Базовая схема"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS first_practice_completions (
+        discipline_id INTEGER,
+        student_id INTEGER,
+        tokens INTEGER,
+        awarded_date TEXT,
+        PRIMARY KEY (discipline_id),
+        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id),
+        FOREIGN KEY (student_id) REFERENCES students(student_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS reserved_tokens (
+        student_id INTEGER,
+        teacher_id INTEGER,
+        discipline_id INTEGER,
+        tokens INTEGER DEFAULT 0,
+        notification_message TEXT NOT NULL,
+        PRIMARY KEY (student_id, teacher_id, discipline_id),
+        FOREIGN KEY (student_id) REFERENCES students(student_id),
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
+        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        role TEXT CHECK(role IN ('student', 'teacher', 'admin')),
+        group_name TEXT,
+        token TEXT UNIQUE
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS teachers (
+        teacher_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        token TEXT UNIQUE,
+        tokens_per_attendance INTEGER DEFAULT 1,
+        FOREIGN KEY (teacher_id) REFERENCES users(user_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS students (
+        student_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        group_name TEXT,
+        FOREIGN KEY (student_id) REFERENCES users(user_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS student_teacher (
+        student_id INTEGER,
+        teacher_id INTEGER,
+        tokens INTEGER DEFAULT 0,
+        PRIMARY KEY (student_id, teacher_id),
+        FOREIGN KEY (student_id) REFERENCES students(student_id),
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS admin_teacher (
+        admin_id INTEGER,
+        teacher_id INTEGER,
+        PRIMARY KEY (admin_id, teacher_id),
+        FOREIGN KEY (admin_id) REFERENCES users(user_id),
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS admin_student (
+        admin_id INTEGER,
+        student_id INTEGER,
+        PRIMARY KEY (admin_id, student_id),
+        FOREIGN KEY (admin_id) REFERENCES users(user_id),
+        FOREIGN KEY (student_id) REFERENCES students(student_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS disciplines (
+        discipline_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        teacher_id INTEGER,
+        name TEXT,
+        group_name TEXT,
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS ktp (
+        ktp_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        teacher_id INTEGER,
+        discipline_id INTEGER,
+        group_name TEXT,
+        type TEXT CHECK(type IN ('lecture', 'practice')),
+        description TEXT,
+        practice_number INTEGER,
+        homework TEXT,
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
+        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grades (
+        grade_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        teacher_id INTEGER,
+        discipline_id INTEGER,
+        ktp_id INTEGER,
+        grade INTEGER CHECK(grade IN (0, 1, 2, 3, 4, 5, -1)),
+        date TEXT,
+        FOREIGN KEY (student_id) REFERENCES students(student_id),
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
+        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id),
+        FOREIGN KEY (ktp_id) REFERENCES ktp(ktp_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS student_groups (
+        group_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        teacher_id INTEGER,
+        group_name TEXT,
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS group_students (
+        group_id INTEGER,
+        student_id INTEGER,
+        PRIMARY KEY (group_id, student_id),
+        FOREIGN KEY (group_id) REFERENCES student_groups(group_id),
+        FOREIGN KEY (student_id) REFERENCES students(student_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS rewards (
+        reward_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        teacher_id INTEGER,
+        discipline_id INTEGER,
+        name TEXT,
+        description TEXT,
+        price INTEGER,
+        is_enabled INTEGER DEFAULT 1,
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id),
+        FOREIGN KEY (discipline_id) REFERENCES disciplines(discipline_id)
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS purchased_rewards (
+        purchase_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER,
+        reward_id INTEGER,
+        teacher_id INTEGER,
+        purchase_date TEXT,
+        FOREIGN KEY (student_id) REFERENCES students(student_id),
+        FOREIGN KEY (reward_id) REFERENCES rewards(reward_id),
+        FOREIGN KEY (teacher_id) REFERENCES teachers(teacher_id)
+    )
+    """)
+    add_column(cursor, "disciplines", "required_practices", "INTEGER")
+    add_column(cursor, "ktp", "homework", "TEXT")
+    add_column(cursor, "ktp", "type", "TEXT CHECK(type IN ('lecture', 'practice'))")
+    add_column(cursor, "ktp", "practice_number", "INTEGER")
+
+def migration_2(cursor):
+    """Индексы под частые запросы"""
+    # Оценки студента, ячейки ведомости, проверка практик
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_student ON grades (student_id, discipline_id, ktp_id, date)")
+    # Оценки по КТП
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_ktp ON grades (ktp_id, student_id)")
+    # Столбцы ведомости, удаление дисциплины
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grades_discipline ON grades (discipline_id, teacher_id, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ktp_discipline ON ktp (discipline_id, type, practice_number)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_groups_teacher ON student_groups (teacher_id, group_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_name ON students (full_name, group_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_group ON students (group_name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_disciplines_teacher ON disciplines (teacher_id, name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_teacher_teacher ON student_teacher (teacher_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rewards_teacher ON rewards (teacher_id)")
+
+def migration_3(cursor):
+    """Рассылки новостей с сохранением прогресса"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        text TEXT NOT NULL,
+        audience TEXT,
+        status TEXT DEFAULT 'running' CHECK(status IN ('running', 'done')),
+        progress_message_id INTEGER,
+        created_at TEXT
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER,
+        user_id INTEGER,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'sent', 'failed')),
+        PRIMARY KEY (broadcast_id, user_id),
+        FOREIGN KEY (broadcast_id) REFERENCES broadcasts(broadcast_id)
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status ON broadcast_recipients (broadcast_id, status)")
+
+def migration_4(cursor):
+    """Очередь исходящих уведомлений"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        kind TEXT,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'sent', 'dead')),
+        attempts INTEGER DEFAULT 0,
+        created_at REAL,
+        next_attempt_at REAL,
+        sent_at REAL,
+        last_error TEXT
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+
+def migration_5(cursor):
+    """Сводки уведомлений"""
+    add_column(cursor, "outbox", "digest", "INTEGER DEFAULT 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox (chat_id, status)")
+
+def migration_6(cursor):
+    """Реестр недоступных получателей"""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS unreachable_recipients (
+        user_id INTEGER PRIMARY KEY,
+        reason TEXT NOT NULL CHECK(reason IN ('blocked', 'not_found', 'placeholder')),
+        error TEXT,
+        marked_at REAL
+    )
+    """)
+
+# Таблицы, изменения которых считаются в change_versions: таблица -> столбец
+# для счетчика по записям (None - только общий счетчик таблицы)
+VERSIONED_TABLES = {
+    'grades': 'student_id',
+    'ktp': 'teacher_id',
+    'student_teacher': 'teacher_id',
+    'students': None,
+    'users': None,
+    'teachers': None,
+    'disciplines': None,
+}
+
+def create_version_triggers(cursor, table: str, column: str = None):
+    """Триггеры, которые ведут счетчики изменений таблицы в change_versions"""
+    bump = """
+        INSERT INTO change_versions (resource, key, version) VALUES ('{resource}', {key}, 1)
+        ON CONFLICT (resource, key) DO UPDATE SET version = version + 1;"""
+    for event, rows in (("INSERT", ("NEW",)), ("UPDATE", ("OLD", "NEW")), ("DELETE", ("OLD",))):
+        body = bump.format(resource=table, key=0)
+        if column:
+            for row in rows:
+                body += bump.format(resource=f"{table}.{column}", key=f"COALESCE({row}.{column}, 0)")
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version AFTER {event} ON {table}
+        BEGIN{body}
+        END
+        """)
+
+def migration_7(cursor):
+    """Счетчики изменений для кэширования ответов API"""
+    # resource - имя таблицы (key = 0) или 'таблица.столбец' (key - значение столбца)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS change_versions (
+        resource TEXT NOT NULL,
+        key INTEGER NOT NULL DEFAULT 0,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (resource, key)
+    ) WITHOUT ROWID
+    """)
+    # Счетчики ведут триггеры: изменения и бота, и API учитываются без правок в коде
+    for table, column in VERSIONED_TABLES.items():
+        create_version_triggers(cursor, table, column)
+
+def migration_8(cursor):
+    """Счетчики сданных практик"""
+    # Сколько зачтенных оценок (grade >= 1) у студента по номеру практики дисциплины
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS practice_passes (
+        student_id INTEGER NOT NULL,
+        discipline_id INTEGER NOT NULL,
+        practice_number INTEGER NOT NULL,
+        passes INTEGER NOT NULL,
+        PRIMARY KEY (student_id, discipline_id, practice_number)
+    ) WITHOUT ROWID
+    """)
+    # Сколько разных практик студент сдал по дисциплине
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS practice_progress (
+        student_id INTEGER NOT NULL,
+        discipline_id INTEGER NOT NULL,
+        completed INTEGER NOT NULL,
+        PRIMARY KEY (student_id, discipline_id)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("DELETE FROM practice_passes")
+    cursor.execute("""
+    INSERT INTO practice_passes (student_id, discipline_id, practice_number, passes)
+    SELECT g.student_id, g.discipline_id, k.practice_number, COUNT(*)
+    FROM grades g
+    JOIN ktp k ON g.ktp_id = k.ktp_id
+    WHERE k.type = 'practice' AND k.practice_number IS NOT NULL AND g.grade >= 1
+    GROUP BY g.student_id, g.discipline_id, k.practice_number
+    """)
+    cursor.execute("DELETE FROM practice_progress")
+    cursor.execute("""
+    INSERT INTO practice_progress (student_id, discipline_id, completed)
+    SELECT student_id, discipline_id, COUNT(*) FROM practice_passes GROUP BY student_id, discipline_id
+    """)
+
+    # Счетчики ведут триггеры на grades и ktp: оценки меняют и бот, и API
+    grade_added = """
+        INSERT INTO practice_passes (student_id, discipline_id, practice_number, passes)
+        SELECT {row}.student_id, {row}.discipline_id, k.practice_number, 1 FROM ktp k
+        WHERE k.ktp_id = {row}.ktp_id AND k.type = 'practice' AND k.practice_number IS NOT NULL AND {row}.grade >= 1
+        ON CONFLICT (student_id, discipline_id, practice_number) DO UPDATE SET passes = passes + 1;"""
+    grade_removed = """
+        UPDATE practice_passes SET passes = passes - 1
+        WHERE student_id = {row}.student_id AND discipline_id = {row}.discipline_id AND {row}.grade >= 1
+        AND practice_number = (SELECT practice_number FROM ktp WHERE ktp_id = {row}.ktp_id AND type = 'practice');
+        DELETE FROM practice_passes
+        WHERE student_id = {row}.student_id AND discipline_id = {row}.discipline_id AND passes <= 0;"""
+    # Оценки, оставшиеся без КТП (удаление группы), перестают считаться и наоборот
+    ktp_added = """
+        INSERT INTO practice_passes (student_id, discipline_id, practice_number, passes)
+        SELECT g.student_id, g.discipline_id, {row}.practice_number, COUNT(*) FROM grades g
+        WHERE g.ktp_id = {row}.ktp_id AND g.grade >= 1 AND {row}.type = 'practice' AND {row}.practice_number IS NOT NULL
+        GROUP BY g.student_id, g.discipline_id
+        ON CONFLICT (student_id, discipline_id, practice_number) DO UPDATE SET passes = passes + excluded.passes;"""
+    ktp_removed = """
+        UPDATE practice_passes SET passes = passes - (
+            SELECT COUNT(*) FROM grades g
+            WHERE g.ktp_id = {row}.ktp_id AND g.grade >= 1
+            AND g.student_id = practice_passes.student_id AND g.discipline_id = practice_passes.discipline_id
+        )
+        WHERE {row}.type = 'practice' AND practice_number = {row}.practice_number;
+        DELETE FROM practice_passes WHERE practice_number = {row}.practice_number AND passes <= 0;"""
+    triggers = {
+        "trg_grades_insert_progress": ("AFTER INSERT ON grades", grade_added.format(row="NEW")),
+        "trg_grades_update_progress": ("AFTER UPDATE OF student_id, discipline_id, ktp_id, grade ON grades",
+                                       grade_removed.format(row="OLD") + grade_added.format(row="NEW")),
+        "trg_grades_delete_progress": ("AFTER DELETE ON grades", grade_removed.format(row="OLD")),
+        "trg_ktp_insert_progress": ("AFTER INSERT ON ktp", ktp_added.format(row="NEW")),
+        "trg_ktp_update_progress": ("AFTER UPDATE OF ktp_id, type, practice_number ON ktp",
+                                    ktp_removed.format(row="OLD") + ktp_added.format(row="NEW")),
+        "trg_ktp_delete_progress": ("AFTER DELETE ON ktp", ktp_removed.format(row="OLD")),
+        # Номер практики впервые сдан / больше не сдан
+        "trg_practice_passes_insert": ("AFTER INSERT ON practice_passes", """
+        INSERT INTO practice_progress (student_id, discipline_id, completed)
+        VALUES (NEW.student_id, NEW.discipline_id, 1)
+        ON CONFLICT (student_id, discipline_id) DO UPDATE SET completed = completed + 1;"""),
+        "trg_practice_passes_delete": ("AFTER DELETE ON practice_passes", """
+        UPDATE practice_progress SET completed = completed - 1
+        WHERE student_id = OLD.student_id AND discipline_id = OLD.discipline_id;
+        DELETE FROM practice_progress
+        WHERE student_id = OLD.student_id AND discipline_id = OLD.discipline_id AND completed <= 0;"""),
+    }
+    for name, (event, body) in triggers.items():
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {name} {event}
+        BEGIN{body}
+        END
+        """)
+
+def migration_9(cursor):
+    """Статистика сдачи практик по дисциплине"""
+    # Сколько студентов сдали каждую практику - выборка по дисциплине
+    cursor.execute("""
+    CREATE INDEX IF NOT EXISTS idx_practice_passes_discipline ON practice_passes (discipline_id, practice_number)
+    """)
+    # Версия ('practice_passes.discipline_id', дисциплина) меняется при любом изменении
+    # сданных практик дисциплины; по ней сбрасывается кэш статистики
+    create_version_triggers(cursor, 'practice_passes', 'discipline_id')
+
+def migration_10(cursor):
+    """Счетчики посещаемости"""
+    # Оценок у студента по дисциплине всего и сколько из них не "н" (-1)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS attendance (
+        student_id INTEGER NOT NULL,
+        discipline_id INTEGER NOT NULL,
+        attended INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (student_id, discipline_id)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_discipline ON attendance (discipline_id)")
+    cursor.execute("DELETE FROM attendance")
+    cursor.execute("""
+    INSERT INTO attendance (student_id, discipline_id, attended, total)
+    SELECT student_id, discipline_id, SUM(CASE WHEN grade != -1 THEN 1 ELSE 0 END), COUNT(*)
+    FROM grades
+    WHERE student_id IS NOT NULL AND discipline_id IS NOT NULL
+    GROUP BY student_id, discipline_id
+    """)
+
+    grade_added = """
+        INSERT INTO attendance (student_id, discipline_id, attended, total)
+        SELECT {row}.student_id, {row}.discipline_id, CASE WHEN {row}.grade != -1 THEN 1 ELSE 0 END, 1
+        WHERE {row}.student_id IS NOT NULL AND {row}.discipline_id IS NOT NULL
+        ON CONFLICT (student_id, discipline_id) DO UPDATE
+        SET attended = attended + excluded.attended, total = total + 1;"""
+    grade_removed = """
+        UPDATE attendance
+        SET attended = attended - CASE WHEN {row}.grade != -1 THEN 1 ELSE 0 END, total = total - 1
+        WHERE student_id = {row}.student_id AND discipline_id = {row}.discipline_id;
+        DELETE FROM attendance
+        WHERE student_id = {row}.student_id AND discipline_id = {row}.discipline_id AND total <= 0;"""
+    triggers = {
+        "trg_grades_insert_attendance": ("AFTER INSERT ON grades", grade_added.format(row="NEW")),
+        "trg_grades_update_attendance": ("AFTER UPDATE OF student_id, discipline_id, grade ON grades",
+                                         grade_removed.format(row="OLD") + grade_added.format(row="NEW")),
+        "trg_grades_delete_attendance": ("AFTER DELETE ON grades", grade_removed.format(row="OLD")),
+    }
+    for name, (event, body) in triggers.items():
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {name} {event}
+        BEGIN{body}
+        END
+        """)
+
+def migration_11(cursor):
+    """Журнал событий оценок и правила начисления жетонов"""
+    # Выставление и изменение оценок; данные КТП, дисциплины и преподавателя - на момент события
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS grade_events (
+        event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        grade_id INTEGER NOT NULL,
+        student_id INTEGER NOT NULL,
+        teacher_id INTEGER,
+        discipline_id INTEGER NOT NULL,
+        ktp_id INTEGER,
+        ktp_type TEXT,
+        practice_number INTEGER,
+        old_grade INTEGER,
+        new_grade INTEGER,
+        is_new INTEGER NOT NULL,
+        date TEXT,
+        tokens_per_attendance INTEGER,
+        required_practices INTEGER
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_grade_events_student ON grade_events (student_id)")
+    # Состояние правил: элемент по студенту и дисциплине (student_id = 0 - по дисциплине);
+    # позиция обработчика в журнале - rule = 'engine'
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS token_rule_state (
+        rule TEXT NOT NULL,
+        student_id INTEGER NOT NULL,
+        discipline_id INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        value,
+        PRIMARY KEY (rule, student_id, discipline_id, item)
+    ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_rule_state_student ON token_rule_state (student_id)")
+    # Журнал начислений по правилам
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS token_awards (
+        award_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_id INTEGER,
+        rule TEXT NOT NULL,
+        student_id INTEGER NOT NULL,
+        teacher_id INTEGER,
+        discipline_id INTEGER NOT NULL,
+        tokens INTEGER NOT NULL,
+        detail INTEGER,
+        created_at REAL NOT NULL
+    )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_token_awards_student ON token_awards (student_id)")
+
+    event = """
+        INSERT INTO grade_events (grade_id, student_id, teacher_id, discipline_id, ktp_id, ktp_type, practice_number,
+                                  old_grade, new_grade, is_new, date, tokens_per_attendance, required_practices)
+        VALUES (NEW.grade_id, NEW.student_id, NEW.teacher_id, NEW.discipline_id, NEW.ktp_id,
+                (SELECT type FROM ktp WHERE ktp_id = NEW.ktp_id),
+                (SELECT practice_number FROM ktp WHERE ktp_id = NEW.ktp_id),
+                {old_grade}, NEW.grade, {is_new}, NEW.date,
+                (SELECT tokens_per_attendance FROM teachers WHERE teacher_id = NEW.teacher_id),
+                (SELECT required_practices FROM disciplines WHERE discipline_id = NEW.discipline_id));"""
+    # Перенос оценок на другой student_id (регистрация) - не событие
+    triggers = {
+        "trg_grades_insert_event": ("AFTER INSERT ON grades "
+                                    "WHEN NEW.student_id IS NOT NULL AND NEW.discipline_id IS NOT NULL",
+                                    event.format(old_grade="NULL", is_new=1)),
+        "trg_grades_update_event": ("AFTER UPDATE OF grade ON grades "
+                                    "WHEN OLD.grade IS NOT NEW.grade AND NEW.student_id IS NOT NULL "
+                                    "AND NEW.discipline_id IS NOT NULL",
+                                    event.format(old_grade="OLD.grade", is_new=0)),
+    }
+    for name, (trigger_event, body) in triggers.items():
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {name} {trigger_event}
+        BEGIN{body}
+        END
+        """)
+
+    # Начальное состояние правил по уже выставленным оценкам; серии посещений
+    # считаются с момента миграции
+    cursor.execute("DELETE FROM token_rule_state")
+    cursor.execute("INSERT INTO token_rule_state VALUES ('engine', 0, 0, 'position', 0)")
+    cursor.execute("""
+    INSERT INTO token_rule_state (rule, student_id, discipline_id, item, value)
+    SELECT 'first_finisher', student_id, discipline_id, 'passes:' || practice_number, passes FROM practice_passes
+    UNION ALL
+    SELECT 'first_finisher', student_id, discipline_id, 'completed', completed FROM practice_progress
+    UNION ALL
+    SELECT 'first_finisher', 0, discipline_id, 'winner', 1 FROM first_practice_completions
+    WHERE discipline_id IS NOT NULL
+    """)
+    cursor.execute("""
+    INSERT INTO token_rule_state (rule, student_id, discipline_id, item, value)
+    SELECT 'first_finisher', 0, discipline_id, 'date:' || practice_number, date
+    FROM (
+        SELECT g.discipline_id, k.practice_number, g.date,
+               ROW_NUMBER() OVER (PARTITION BY g.discipline_id, k.practice_number ORDER BY g.grade_id) AS n
+        FROM grades g
+        JOIN ktp k ON k.ktp_id = g.ktp_id
+        WHERE k.type = 'practice' AND k.practice_number IS NOT NULL AND g.discipline_id IS NOT NULL
+    )
+    WHERE n = 1
+    """)
+    cursor.execute("""
+    INSERT INTO token_rule_state (rule, student_id, discipline_id, item, value)
+    SELECT DISTINCT 'perfect_practice', g.student_id, g.discipline_id, 'attempted:' || k.practice_number, 1
+    FROM grades g
+    JOIN ktp k ON k.ktp_id = g.ktp_id
+    WHERE k.type = 'practice' AND k.practice_number IS NOT NULL
+    AND g.student_id IS NOT NULL AND g.discipline_id IS NOT NULL
+    """)
+
+# Порядок менять нельзя: номер миграции - ее позиция в списке
+MIGRATIONS = [
+    migration_1,
+    migration_2,
+    migration_3,
+    migration_4,
+    migration_5,
+    migration_6,
+    migration_7,
+    migration_8,
+    migration_9,
+    migration_10,
+    migration_11,
+]
+
+def get_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn) -> int:
+    """Доводит схему до последней версии; возвращает итоговую версию"""
+    target = len(MIGRATIONS)
+    if get_version(conn) >= target:
+        return get_version(conn)
+
+    cursor = conn.cursor()
+    # IMMEDIATE: второй процесс дождется окончания миграции и не начнет ее повторно
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # Версию перечитываем под блокировкой: схему мог обновить другой процесс
+        for number in range(get_version(conn) + 1, target + 1):
+            migration = MIGRATIONS[number - 1]
+            logger.info(f"Миграция схемы {number}: {migration.__doc__}")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return get_version(conn)
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 else 'students.db'
+    # Только чтение: исходный файл не меняется и не создается
+    source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    copy = sqlite3.connect(":memory:")
+    source.backup(copy)
+    source.close()
+
+    before = get_version(copy)
+    after = migrate(copy)
+    print(f"Версия схемы {path}: {before} -> {after} (проверено на копии)")
+    for (name,) in copy.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%' ORDER BY name"):
+        print(f"  индекс {name}")
+    copy.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""
+Очередь исходящих уведомлений (outbox) в БД
+Уведомление записывается в той же транзакции, что и изменение данных (например,
+оценка), а отправляется фоновыми обработчиками после фиксации транзакции.
+Временные ошибки повторяются с задержкой; заблокировавшие бота получатели
+попадают в реестр недоступных (delivery_status), их сообщения переводятся в 'dead',
+а новые им не ставятся.
+Сообщения, поставленные с digest=True, копятся OUTBOX_DIGEST_WINDOW секунд с первого
+и уходят получателю одним сообщением-сводкой
+"""
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from db import db_task
+from delivery_status import mark_unreachable, reachable, unreachable_reason
+from send_governor import BULK, send_priority
+
+# Сколько уведомлений отправляется одновременно
+OUTBOX_WORKERS = int(os.environ.get('OUTBOX_WORKERS', 4))
+
+# Уведомлений за один проход очереди
+OUTBOX_BATCH_SIZE = 50
+
+# Попыток отправки до перевода в 'dead'; задержка между попытками удваивается
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_DELAY = 2  # сек
+
+# Как часто проверять очередь без сигнала wake(), сек
+OUTBOX_POLL_INTERVAL = 5
+
+# Окно сводки, сек: 0 - сводки выключены, каждое сообщение уходит сразу
+OUTBOX_DIGEST_WINDOW = int(os.environ.get('OUTBOX_DIGEST_WINDOW', 0))
+
+# Заголовки сводок по виду сообщений
+DIGEST_TITLES = {
+    'grade': "Новые и измененные оценки",
+}
+
+# Ограничение Telegram на длину сообщения
+MESSAGE_MAX_LENGTH = 4096
+
+logger = logging.getLogger(__name__)
+
+def enqueue(cursor, chat_id: int, text: str, kind: str = None, digest: bool = False):
+    """Ставит сообщение в очередь; вызывается внутри задачи БД, в ее транзакции.
+
+    digest=True - сообщение может уйти в сводке с другими сообщениями того же
+    вида для этого получателя (если сводки включены).
+    Недоступным получателям сообщение не ставится.
+    """
+    now = time.time()
+    digest = digest and OUTBOX_DIGEST_WINDOW > 0
+    if digest:
+        # Окно сводки отсчитывается от первого ожидающего сообщения получателю
+        cursor.execute("""
+        SELECT MIN(next_attempt_at) FROM outbox
+        WHERE chat_id = ? AND status = 'pending' AND digest = 1 AND kind IS ?
+        """, (chat_id, kind))
+        next_attempt_at = cursor.fetchone()[0] or now + OUTBOX_DIGEST_WINDOW
+    else:
+        next_attempt_at = now
+    # Проверка реестра - в том же запросе, без отдельного чтения
+    cursor.execute(f"""
+    INSERT INTO outbox (chat_id, text, kind, digest, created_at, next_attempt_at)
+    SELECT ?, ?, ?, ?, ?, ? WHERE {reachable('?')}
+    """, (chat_id, text, kind, int(digest), now, next_attempt_at, chat_id))
+
+def digest_text(kind, texts):
+    title = DIGEST_TITLES.get(kind, "Уведомления")
+    return f"{title} ({len(texts)}):\n\n" + "\n\n".join(texts)
+
+@db_task
+def get_due_messages(cursor, limit: int):
+    """Сообщения к отправке: [(message_ids, chat_id, text, attempts, created_at)].
+
+    Сообщения одной сводки объединяются в одно, пока текст укладывается
+    в ограничение Telegram; остаток уйдет следующим проходом.
+    """
+    cursor.execute("""
+    SELECT message_id, chat_id, text, kind, digest, attempts, created_at FROM outbox
+    WHERE status = 'pending' AND next_attempt_at <= ?
+    ORDER BY next_attempt_at, message_id
+    LIMIT ?
+    """, (time.time(), limit))
+    deliveries = []
+    digests = {}  # (chat_id, kind) -> attempts
+    for message_id, chat_id, text, kind, digest, attempts, created_at in cursor.fetchall():
+        if digest:
+            digests[(chat_id, kind)] = max(attempts, digests.get((chat_id, kind), 0))
+        else:
+            deliveries.append(([message_id], chat_id, text, attempts, created_at))
+
+    for (chat_id, kind), attempts in digests.items():
+        # В сводку идут и сообщения, окно которых еще не вышло
+        cursor.execute("""
+        SELECT message_id, text, created_at FROM outbox
+        WHERE chat_id = ? AND status = 'pending' AND digest = 1 AND kind IS ?
+        ORDER BY message_id
+        """, (chat_id, kind))
+        message_ids, texts, created_at = [], [], None
+        for message_id, text, message_created_at in cursor.fetchall():
+            if texts and len(digest_text(kind, texts + [text])) > MESSAGE_MAX_LENGTH:
+                break
+            message_ids.append(message_id)
+            texts.append(text)
+            created_at = min(created_at or message_created_at, message_created_at)
+        text = texts[0] if len(texts) == 1 else digest_text(kind, texts)
+        deliveries.append((message_ids, chat_id, text, attempts, created_at))
+    return deliveries
+
+@db_task
+def get_next_attempt_time(cursor):
+    cursor.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'")
+    return cursor.fetchone()[0]
+
+@db_task
+def save_results(cursor, sent: list, retry: list, dead: list, unreachable: list = ()):
+    """sent: [(sent_at, message_id)], retry: [(next_attempt_at, attempts, error, message_id)],
+    dead: [(attempts, error, message_id)], unreachable: [(chat_id, причина, error)]"""
+    cursor.executemany("UPDATE outbox SET status = 'sent', sent_at = ? WHERE message_id = ?", sent)
+    cursor.executemany("UPDATE outbox SET next_attempt_at = ?, attempts = ?, last_error = ? WHERE message_id = ?", retry)
+    cursor.executemany("UPDATE outbox SET status = 'dead', attempts = ?, last_error = ? WHERE message_id = ?", dead)
+    mark_unreachable(cursor, unreachable)
+    # Остальные сообщения недоступному получателю тоже не уйдут
+    cursor.executemany("UPDATE outbox SET status = 'dead', last_error = ? WHERE chat_id = ? AND status = 'pending'",
+                       ((error, chat_id) for chat_id, _, error in unreachable))
+
+@db_task
+def get_outbox_stats(cursor):
+    """Количество сообщений по статусам и возраст самого старого неотправленного, сек"""
+    cursor.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+    stats = {'pending': 0, 'sent': 0, 'dead': 0}
+    stats.update(cursor.fetchall())
+    cursor.execute("SELECT MIN(created_at) FROM outbox WHERE status = 'pending'")
+    oldest = cursor.fetchone()[0]
+    stats['oldest_pending_age'] = round(time.time() - oldest, 1) if oldest else 0
+    return stats
+
+class Outbox:
+    """Фоновая отправка сообщений из таблицы outbox"""
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS):
+        self.bot = bot
+        self.workers = workers
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Задержка доставки: от записи в outbox до успешной отправки, сек
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wake(self):
+        """Сигнал, что в очереди появились сообщения (после фиксации транзакции)"""
+        self._wakeup.set()
+
+    async def metrics(self):
+        stats = await get_outbox_stats()
+        stats['last_lag'] = round(self.last_lag, 3)
+        stats['max_lag'] = round(self.max_lag, 3)
+        return stats
+
+    async def _run(self):
+        send_priority.set(BULK)
+        while True:
+            self._wakeup.clear()
+            try:
+                messages = await get_due_messages(OUTBOX_BATCH_SIZE)
+                if messages:
+                    await self._deliver(messages)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обработки outbox: {e}")
+            timeout = OUTBOX_POLL_INTERVAL
+            try:
+                # Ближайшее отложенное сообщение (повтор, окно сводки) будит раньше
+                next_attempt_at = await get_next_attempt_time()
+                if next_attempt_at is not None:
+                    timeout = min(timeout, max(next_attempt_at - time.time(), 0.05))
+            except Exception as e:
+                logger.error(f"Ошибка обработки outbox: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, messages):
+        semaphore = asyncio.Semaphore(self.workers)
+        sent, retry, dead, unreachable = [], [], [], []
+
+        async def deliver(message_ids, chat_id, text, attempts, created_at):
+            async with semaphore:
+                try:
+                    await self.bot.send_message(chat_id, text)
+                except TelegramRetryAfter as e:
+                    retry.extend((time.time() + e.retry_after, attempts, str(e), message_id) for message_id in message_ids)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    # Бот заблокирован или чат не найден - повтор не поможет
+                    logger.warning(f"Уведомление {message_ids} для {chat_id} не доставлено: {e}")
+                    dead.extend((attempts + 1, str(e), message_id) for message_id in message_ids)
+                    reason = unreachable_reason(e)
+                    if reason:
+                        unreachable.append((chat_id, reason, str(e)))
+                except Exception as e:
+                    attempts += 1
+                    if attempts >= OUTBOX_MAX_ATTEMPTS:
+                        logger.error(f"Уведомление {message_ids} для {chat_id} не доставлено после {attempts} попыток: {e}")
+                        dead.extend((attempts, str(e), message_id) for message_id in message_ids)
+                    else:
+                        delay = OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+                        retry.extend((time.time() + delay, attempts, str(e), message_id) for message_id in message_ids)
+                else:
+                    now = time.time()
+                    self.last_lag = now - created_at
+                    self.max_lag = max(self.max_lag, self.last_lag)
+                    sent.extend((now, message_id) for message_id in message_ids)
+
+        await asyncio.gather(*(deliver(*message) for message in messages))
+        await save_results(sent, retry, dead, unreachable)
+        logger.info(f"outbox: отправлено {len(sent)}, отложено {len(retry)}, dead {len(dead)}, "
+                    f"недоступных получателей {len(unreachable)}; "
+                    f"задержка доставки {self.last_lag:.2f} с (макс. {self.max_lag:.2f} с)")
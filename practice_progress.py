@@ -0,0 +1,115 @@
+"""
+Сданные практики студентов
+practice_progress хранит, сколько разных практик студент сдал по дисциплине; таблицу
+ведут триггеры на grades и ktp (миграция 8), поэтому "сдано N из M" читается одной
+строкой по ключу. Сверка пересчитывает счетчики по оценкам и исправляет расхождения
+"""
+import asyncio
+import logging
+import os
+
+from db import db_task
+
+# Как часто сверять счетчики с пересчетом по оценкам, сек
+PRACTICE_RECONCILE_INTERVAL = int(os.environ.get('PRACTICE_RECONCILE_INTERVAL', 6 * 3600))
+
+# Полный пересчет: сданные номера практик по оценкам (зачет - оценка от 1)
+RECOUNT_PASSES = """
+SELECT g.student_id, g.discipline_id, k.practice_number, COUNT(*)
+FROM grades g
+JOIN ktp k ON g.ktp_id = k.ktp_id
+WHERE k.type = 'practice' AND k.practice_number IS NOT NULL AND g.grade >= 1
+GROUP BY g.student_id, g.discipline_id, k.practice_number
+"""
+
+logger = logging.getLogger(__name__)
+
+def completed_practices(cursor, student_id: int, discipline_id: int) -> int:
+    """Сколько разных практик студент сдал по дисциплине"""
+    cursor.execute("SELECT completed FROM practice_progress WHERE student_id = ? AND discipline_id = ?",
+                  (student_id, discipline_id))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def find_mismatches(cursor):
+    """Расхождения счетчиков с пересчетом: [(student_id, discipline_id, practice_number, в таблице, по оценкам)]"""
+    cursor.execute(f"""
+    WITH recount (student_id, discipline_id, practice_number, passes) AS ({RECOUNT_PASSES})
+    SELECT r.student_id, r.discipline_id, r.practice_number, COALESCE(p.passes, 0), r.passes
+    FROM recount r
+    LEFT JOIN practice_passes p USING (student_id, discipline_id, practice_number)
+    WHERE p.passes IS NOT r.passes
+    UNION ALL
+    SELECT p.student_id, p.discipline_id, p.practice_number, p.passes, 0
+    FROM practice_passes p
+    WHERE NOT EXISTS (
+        SELECT 1 FROM recount r
+        WHERE r.student_id = p.student_id AND r.discipline_id = p.discipline_id AND r.practice_number = p.practice_number
+    )
+    """)
+    mismatches = cursor.fetchall()
+    # Итоговые счетчики сверяются с practice_passes
+    cursor.execute("""
+    WITH expected (student_id, discipline_id, completed) AS (
+        SELECT student_id, discipline_id, COUNT(*) FROM practice_passes GROUP BY student_id, discipline_id
+    )
+    SELECT e.student_id, e.discipline_id, NULL, COALESCE(p.completed, 0), e.completed
+    FROM expected e
+    LEFT JOIN practice_progress p USING (student_id, discipline_id)
+    WHERE p.completed IS NOT e.completed
+    UNION ALL
+    SELECT p.student_id, p.discipline_id, NULL, p.completed, 0
+    FROM practice_progress p
+    WHERE NOT EXISTS (
+        SELECT 1 FROM expected e WHERE e.student_id = p.student_id AND e.discipline_id = p.discipline_id
+    )
+    """)
+    return mismatches + cursor.fetchall()
+
+def rebuild(cursor):
+    """Заполняет счетчики заново по оценкам"""
+    # Триггеры practice_passes при этом тоже меняют practice_progress, но итоговая
+    # таблица пересобирается целиком: расходиться могла и она
+    cursor.execute("DELETE FROM practice_passes")
+    cursor.execute(f"INSERT INTO practice_passes (student_id, discipline_id, practice_number, passes) {RECOUNT_PASSES}")
+    cursor.execute("DELETE FROM practice_progress")
+    cursor.execute("""
+    INSERT INTO practice_progress (student_id, discipline_id, completed)
+    SELECT student_id, discipline_id, COUNT(*) FROM practice_passes GROUP BY student_id, discipline_id
+    """)
+
+@db_task
+def reconcile(cursor):
+    """Сверяет счетчики с пересчетом и при расхождениях пересобирает их; возвращает число расхождений"""
+    mismatches = find_mismatches(cursor)
+    if mismatches:
+        logger.warning(f"Счетчики практик расходятся с оценками ({len(mismatches)}), пересобираем: {mismatches[:10]}")
+        rebuild(cursor)
+    return len(mismatches)
+
+class PracticeProgressReconciler:
+    """Периодическая сверка счетчиков практик в фоне"""
+
+    def __init__(self, interval=PRACTICE_RECONCILE_INTERVAL):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка сверки счетчиков практик: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,68 @@
+"""
+Статистика сдачи практик по дисциплине
+Сколько студентов сдали каждую практику - одним сгруппированным запросом по
+practice_passes (счетчики ведут триггеры, миграция 8). Результат кэшируется по
+дисциплине вместе с версией ('practice_passes.discipline_id', дисциплина) из
+change_versions: триггеры меняют ее при любом изменении сданных практик дисциплины,
+из бота и из API, поэтому после выставления оценки кэш перечитывается сам
+"""
+import threading
+
+from db import db_task
+
+# Максимум дисциплин в кэше
+PRACTICE_STATS_CACHE_SIZE = 1000
+
+RESOURCE = 'practice_passes.discipline_id'
+
+def discipline_version(cursor, discipline_id: int) -> int:
+    cursor.execute("SELECT version FROM change_versions WHERE resource = ? AND key = ?", (RESOURCE, discipline_id))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+def practice_counts(cursor, discipline_id: int) -> dict:
+    """{номер практики: сколько студентов ее сдали} по дисциплине"""
+    cursor.execute("""
+    SELECT practice_number, COUNT(*) FROM practice_passes
+    WHERE discipline_id = ?
+    GROUP BY practice_number
+    """, (discipline_id,))
+    return {practice_number: students for practice_number, students in cursor.fetchall()}
+
+class PracticeStatsCache:
+    """Кэш статистики практик по дисциплинам; обращения идут из потоков БД"""
+
+    def __init__(self, max_size=PRACTICE_STATS_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._values = {}  # discipline_id -> (версия, статистика)
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, cursor, discipline_id: int) -> dict:
+        # Версия читается раньше статистики: если между чтениями оценки изменятся,
+        # свежая статистика сохранится со старой версией и при следующем обращении
+        # перечитается, но устаревшая статистика с новой версией не сохранится никогда
+        version = discipline_version(cursor, discipline_id)
+        with self._lock:
+            cached = self._values.get(discipline_id)
+            if cached is not None and cached[0] == version:
+                self.stats['hits'] += 1
+                return cached[1]
+            self.stats['misses'] += 1
+        counts = practice_counts(cursor, discipline_id)
+        with self._lock:
+            if len(self._values) >= self.max_size:
+                self._values.clear()
+            self._values[discipline_id] = (version, counts)
+        return counts
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+practice_stats_cache = PracticeStatsCache()
+
+@db_task
+def get_practice_stats(cursor, discipline_id: int) -> dict:
+    """{номер практики: сколько студентов ее сдали} по дисциплине, из кэша"""
+    return practice_stats_cache.get(cursor, discipline_id)
@@ -0,0 +1,87 @@
+"""
+Кэш справочных данных: дисциплины, КТП, преподаватели
+Значение читается из БД при первом обращении (внутри задачи БД, ее курсором) и
+дальше берется из памяти. Справочники меняет только бот: handlers, которые их
+меняют, сбрасывают кэш после фиксации транзакции (invalidate, clear)
+"""
+import threading
+from collections import namedtuple
+
+Discipline = namedtuple('Discipline', 'teacher_id name group_name required_practices')
+Ktp = namedtuple('Ktp', 'discipline_id type description practice_number homework')
+Teacher = namedtuple('Teacher', 'full_name tokens_per_attendance')
+
+DISCIPLINE = 'discipline'
+KTP = 'ktp'
+TEACHER = 'teacher'
+
+class ReferenceCache:
+    """Read-through кэш справочников; обращения идут из потоков БД"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {DISCIPLINE: {}, KTP: {}, TEACHER: {}}
+        # Меняется при каждом сбросе: значение, прочитанное до сброса, в кэш не попадает
+        self._generation = 0
+        self.stats = {kind: {'hits': 0, 'misses': 0} for kind in self._values}
+
+    def discipline(self, cursor, discipline_id: int) -> Discipline:
+        def load():
+            cursor.execute("""
+            SELECT teacher_id, name, group_name, required_practices FROM disciplines WHERE discipline_id = ?
+            """, (discipline_id,))
+            row = cursor.fetchone()
+            return Discipline(*row) if row else None
+        return self._get(DISCIPLINE, discipline_id, load)
+
+    def ktp(self, cursor, ktp_id: int) -> Ktp:
+        def load():
+            cursor.execute("SELECT discipline_id, type, description, practice_number, homework FROM ktp WHERE ktp_id = ?",
+                          (ktp_id,))
+            row = cursor.fetchone()
+            return Ktp(*row) if row else None
+        return self._get(KTP, ktp_id, load)
+
+    def teacher(self, cursor, teacher_id: int) -> Teacher:
+        """ФИО (из users, None - преподаватель не зарегистрирован) и жетоны за посещение"""
+        def load():
+            cursor.execute("""
+            SELECT u.full_name, t.tokens_per_attendance
+            FROM teachers t
+            LEFT JOIN users u ON u.user_id = t.teacher_id
+            WHERE t.teacher_id = ?
+            """, (teacher_id,))
+            row = cursor.fetchone()
+            return Teacher(*row) if row else None
+        return self._get(TEACHER, teacher_id, load)
+
+    def _get(self, kind, key, load):
+        with self._lock:
+            value = self._values[kind].get(key)
+            if value is not None:
+                self.stats[kind]['hits'] += 1
+                return value
+            self.stats[kind]['misses'] += 1
+            generation = self._generation
+        # Отсутствующие записи не кэшируются
+        value = load()
+        if value is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._values[kind][key] = value
+        return value
+
+    def invalidate(self, kind: str, *keys: int):
+        """Сбрасывает записи; вызывать после фиксации изменений в БД"""
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._values[kind].pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            for values in self._values.values():
+                values.clear()
+
+reference_cache = ReferenceCache()
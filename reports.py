@@ -0,0 +1,101 @@
+"""
+Формирование отчетов (ведомости, выгрузки оценок) в отдельных процессах
+pandas и openpyxl не занимают event loop и GIL бота; очередь отчетов ограничена
+"""
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+# Количество процессов отчетов
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 2))
+
+# Сколько отчетов может формироваться и ждать одновременно
+REPORT_QUEUE_SIZE = int(os.environ.get('REPORT_QUEUE_SIZE', 20))
+
+# Сколько разных отчетов один пользователь может заказать одновременно
+REPORT_USER_LIMIT = int(os.environ.get('REPORT_USER_LIMIT', 2))
+
+logger = logging.getLogger(__name__)
+
+class ReportQueueFull(Exception):
+    """Очередь отчетов заполнена"""
+
+class ReportLimitExceeded(Exception):
+    """У пользователя уже формируется максимум отчетов"""
+
+class ReportWorkers:
+    """Очередь отчетов поверх пула процессов.
+
+    Одинаковые отчеты (с одним ключом), заказанные повторно, пока первый
+    еще формируется, не запускаются заново - все ждут один результат.
+    """
+
+    def __init__(self, workers=REPORT_WORKERS, queue_size=REPORT_QUEUE_SIZE, user_limit=REPORT_USER_LIMIT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.user_limit = user_limit
+        self._executor = None
+        self._jobs = {}  # ключ отчета -> задача
+        self._user_jobs = defaultdict(int)
+
+    @property
+    def depth(self):
+        """Количество отчетов в работе и в очереди"""
+        return len(self._jobs)
+
+    def is_busy(self, key=None):
+        """Новому отчету придется ждать свободный процесс"""
+        return key not in self._jobs and self.depth >= self.workers
+
+    async def build(self, func, *args):
+        """Выполняет func(*args) в процессе отчетов.
+
+        func и аргументы передаются в процесс через pickle, поэтому func
+        должна быть функцией уровня модуля без обращений к БД.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, partial(func, *args))
+        except BrokenProcessPool:
+            # Процесс отчетов упал; следующий отчет создаст новый пул
+            logger.error("Пул процессов отчетов сломан, пересоздаем")
+            self._executor = None
+            raise
+
+    async def run(self, user_id, key, job):
+        """Запускает job() как отчет пользователя или присоединяется к такому же в работе.
+
+        job - асинхронная функция без аргументов (загрузка данных + build).
+        """
+        task = self._jobs.get(key)
+        if task is None:
+            if self.depth >= self.queue_size:
+                raise ReportQueueFull()
+            if self._user_jobs[user_id] >= self.user_limit:
+                raise ReportLimitExceeded()
+            self._user_jobs[user_id] += 1
+            task = asyncio.create_task(job())
+            self._jobs[key] = task
+            task.add_done_callback(partial(self._finish, user_id, key))
+        # Отмена одного ожидающего не отменяет отчет для остальных
+        return await asyncio.shield(task)
+
+    def _finish(self, user_id, key, task):
+        del self._jobs[key]
+        self._user_jobs[user_id] -= 1
+        if not self._user_jobs[user_id]:
+            del self._user_jobs[user_id]
+
+    def shutdown(self):
+        """Останавливает процессы отчетов"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+report_workers = ReportWorkers()
@@ -0,0 +1,79 @@
+"""
+Роли пользователей с кэшем в памяти процесса
+RoleMiddleware определяет роль автора каждого апдейта (сообщения, нажатия кнопки)
+и передает ее в фильтры и handlers аргументом role. Роль берется из кэша, в БД
+запрос идет только при промахе или после ROLE_CACHE_TTL. После регистрации и смены
+роли запись сбрасывается явно (role_cache.invalidate)
+"""
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+from db import db_task
+
+# Сколько секунд роль хранится в кэше; ограничивает устаревание, если роль
+# изменили не через бота (другой процесс, ручная правка БД)
+ROLE_CACHE_TTL = float(os.environ.get('ROLE_CACHE_TTL', 300))
+
+# Максимум пользователей в кэше
+ROLE_CACHE_SIZE = 10000
+
+@db_task
+def get_role(cursor, user_id: int):
+    """Роль пользователя; None - пользователь не зарегистрирован"""
+    cursor.execute("SELECT role FROM users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+class RoleCache:
+    """Кэш user_id -> роль с TTL и явным сбросом"""
+
+    def __init__(self, ttl=ROLE_CACHE_TTL, max_size=ROLE_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._roles = {}  # user_id -> (роль, когда устареет)
+        # Меняется при каждом сбросе: роль, прочитанная до сброса, в кэш не попадает
+        self._generation = 0
+        self.stats = {'hits': 0, 'misses': 0}
+
+    async def resolve(self, user_id: int):
+        now = time.monotonic()
+        cached = self._roles.get(user_id)
+        if cached is not None and cached[1] > now:
+            self.stats['hits'] += 1
+            return cached[0]
+
+        self.stats['misses'] += 1
+        generation = self._generation
+        role = await get_role(user_id)
+        if generation == self._generation:
+            if len(self._roles) >= self.max_size:
+                self._roles = {key: value for key, value in self._roles.items() if value[1] > now}
+                if len(self._roles) >= self.max_size:
+                    self._roles.clear()
+            self._roles[user_id] = (role, now + self.ttl)
+        return role
+
+    def invalidate(self, *user_ids: int):
+        """Сбрасывает роли пользователей; вызывать после фиксации изменений в БД"""
+        self._generation += 1
+        for user_id in user_ids:
+            self._roles.pop(user_id, None)
+
+    def clear(self):
+        self._generation += 1
+        self._roles.clear()
+
+role_cache = RoleCache()
+
+class RoleMiddleware(BaseMiddleware):
+    """Добавляет в данные апдейта role - роль автора (или None)"""
+
+    def __init__(self, cache: RoleCache = role_cache):
+        self.cache = cache
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        data['role'] = await self.cache.resolve(user.id) if user else None
+        return await handler(event, data)
@@ -0,0 +1,174 @@
+"""
+Общий планировщик исходящих запросов к Telegram
+Подключается как middleware сессии бота, поэтому через него проходят все отправки:
+ответы в handlers, уведомления, рассылки. Ограничивает общую скорость и скорость
+массовых сообщений в один чат, пропускает ответы пользователям вперед массовых
+отправок и повторяет запрос после RetryAfter
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage, EditMessageText, ForwardMessage, SendDocument, SendMessage, SendPhoto,
+)
+
+# Сообщений в секунду на весь бот (лимит Telegram - около 30)
+TELEGRAM_RATE = float(os.environ.get('TELEGRAM_RATE', 25))
+
+# Массовых сообщений в секунду в один чат и допустимый всплеск
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+
+# Сколько раз повторять запрос после RetryAfter
+TELEGRAM_RETRY_AFTER_LIMIT = 3
+
+# Ограничиваются только отправки сообщений; остальные методы идут без очереди
+THROTTLED_METHODS = (SendMessage, SendDocument, SendPhoto, EditMessageText, CopyMessage, ForwardMessage)
+
+# Классы приоритета: меньше - раньше
+INTERACTIVE = 0  # ответы пользователю в handlers
+BULK = 1  # уведомления и рассылки
+
+send_priority = ContextVar('send_priority', default=INTERACTIVE)
+
+logger = logging.getLogger(__name__)
+
+@contextmanager
+def bulk_sends():
+    """Отправки внутри блока идут с приоритетом BULK"""
+    token = send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+class TokenBucket:
+    """Ограничение скорости: не больше rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def is_full(self, now):
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+    def take(self, now):
+        """Берет токен, если он есть; иначе возвращает, сколько ждать, сек"""
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while (delay := self.take(loop.time())) > 0:
+                await asyncio.sleep(delay)
+
+class SendGovernor(BaseRequestMiddleware):
+    """Очередь отправок с приоритетами под общим ограничением скорости и ограничением на чат"""
+
+    def __init__(self, rate=TELEGRAM_RATE, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets = {}
+        self._waiters = []  # куча (приоритет, порядковый номер, future)
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0
+        self.stats = {'sent': 0, 'throttled': 0, 'retry_after': 0}
+
+    def metrics(self):
+        """Глубина очереди по приоритетам и счетчики отправок"""
+        depth = {INTERACTIVE: 0, BULK: 0}
+        for priority, _, future in self._waiters:
+            if not future.done():
+                depth[priority] += 1
+        return {'queue_interactive': depth[INTERACTIVE], 'queue_bulk': depth[BULK], **self.stats}
+
+    def pause(self, seconds):
+        """Останавливает все отправки на seconds (ответ RetryAfter)"""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, THROTTLED_METHODS):
+            return await make_request(bot, method)
+
+        priority = send_priority.get()
+        for attempt in range(TELEGRAM_RETRY_AFTER_LIMIT + 1):
+            if priority == BULK and method.chat_id is not None:
+                await self._chat_bucket(method.chat_id).acquire()
+            await self._acquire(priority)
+            try:
+                response = await make_request(bot, method)
+                self.stats['sent'] += 1
+                return response
+            except TelegramRetryAfter as e:
+                self.stats['retry_after'] += 1
+                logger.warning(f"RetryAfter {e.retry_after} с для чата {method.chat_id}, отправки приостановлены")
+                self.pause(e.retry_after)
+                if attempt == TELEGRAM_RETRY_AFTER_LIMIT:
+                    raise
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= 10000:
+                # Забываем чаты, которые давно ничего не получали
+                now = asyncio.get_running_loop().time()
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items() if not value.is_full(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _acquire(self, priority):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await future
+
+    async def _dispatch(self):
+        """Выдает разрешения на отправку по одному, в порядке приоритета"""
+        loop = asyncio.get_running_loop()
+        while True:
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)  # ожидающий отменен
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = loop.time()
+            delay = max(self._paused_until - now, self.bucket.take(now) if now >= self._paused_until else 0)
+            if delay > 0:
+                self.stats['throttled'] += 1
+                await asyncio.sleep(delay)
+                continue
+            # Приоритет проверяется после ожидания: за это время мог прийти ответ пользователю
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if not future.done():
+                    future.set_result(None)
+                    break
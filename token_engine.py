@@ -0,0 +1,161 @@
+"""
+Обработка журнала событий оценок правилами начисления жетонов (token_rules)
+События пишут триггеры на grades, поэтому учитываются оценки и бота, и API. Бот
+обрабатывает новые события в транзакции выставления оценки (process_pending), а
+оценки из API подхватывает фоновый TokenRulesRunner. Позиция в журнале и состояние
+правил хранятся в token_rule_state, начисления - в token_awards
+"""
+import asyncio
+import logging
+import os
+import time
+
+from db import db_task
+from outbox import enqueue
+from reference_cache import reference_cache
+from token_rules import RULES, GradeEvent
+
+# Как часто проверять журнал на события из API, сек
+TOKEN_RULES_POLL_INTERVAL = int(os.environ.get('TOKEN_RULES_POLL_INTERVAL', 5))
+
+# Событий за одну транзакцию
+TOKEN_RULES_BATCH_SIZE = 500
+
+ENGINE = 'engine'
+
+logger = logging.getLogger(__name__)
+
+class DbState:
+    """Состояние правила в token_rule_state; работает в транзакции вызывающего"""
+
+    def __init__(self, cursor, rule: str):
+        self.cursor = cursor
+        self.rule = rule
+
+    def get(self, student_id: int, discipline_id: int, item: str, default=None):
+        self.cursor.execute("""
+        SELECT value FROM token_rule_state WHERE rule = ? AND student_id = ? AND discipline_id = ? AND item = ?
+        """, (self.rule, student_id, discipline_id, item))
+        row = self.cursor.fetchone()
+        return row[0] if row else default
+
+    def set(self, student_id: int, discipline_id: int, item: str, value):
+        """value = None удаляет элемент"""
+        if value is None:
+            self.cursor.execute("""
+            DELETE FROM token_rule_state WHERE rule = ? AND student_id = ? AND discipline_id = ? AND item = ?
+            """, (self.rule, student_id, discipline_id, item))
+        else:
+            self.cursor.execute("""
+            INSERT INTO token_rule_state (rule, student_id, discipline_id, item, value) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (rule, student_id, discipline_id, item) DO UPDATE SET value = excluded.value
+            """, (self.rule, student_id, discipline_id, item, value))
+
+def load_events(cursor, after: int = 0, until: int = None):
+    """События журнала с event_id в (after, until] по порядку; until = None - до конца"""
+    cursor.execute(f"""
+    SELECT {', '.join(GradeEvent._fields)} FROM grade_events
+    WHERE event_id > ? AND (? IS NULL OR event_id <= ?)
+    ORDER BY event_id
+    """, (after, until, until))
+    return [GradeEvent(*row) for row in cursor.fetchall()]
+
+def grant(cursor, rule, award, event):
+    """Начисляет жетоны: журнал, баланс, запись правила и уведомления"""
+    cursor.execute("""
+    INSERT INTO token_awards (event_id, rule, student_id, teacher_id, discipline_id, tokens, detail, created_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, (event.event_id, award.rule, award.student_id, award.teacher_id, award.discipline_id, award.tokens,
+          award.detail, time.time()))
+    cursor.execute("""
+    UPDATE student_teacher 
+    SET tokens = tokens + ? 
+    WHERE student_id = ? AND teacher_id = ?
+    """, (award.tokens, award.student_id, award.teacher_id))
+    rule.record(cursor, award, event)
+
+    if not rule.student_message and not rule.teacher_message:
+        return
+    discipline = reference_cache.discipline(cursor, award.discipline_id)
+    fields = dict(tokens=award.tokens, detail=award.detail,
+                  discipline=discipline.name if discipline else award.discipline_id)
+    if rule.student_message:
+        enqueue(cursor, award.student_id, rule.student_message.format(**fields), kind=rule.kind)
+    if rule.teacher_message and award.teacher_id:
+        cursor.execute("SELECT full_name FROM users WHERE user_id = ?", (award.student_id,))
+        student = cursor.fetchone()
+        fields['student'] = student[0] if student else f"ID {award.student_id}"
+        enqueue(cursor, award.teacher_id, rule.teacher_message.format(**fields), kind=rule.kind)
+
+def process_pending(cursor, rules=RULES, limit=TOKEN_RULES_BATCH_SIZE) -> int:
+    """Обрабатывает до limit новых событий; вызывается внутри задачи БД. Возвращает число событий"""
+    engine = DbState(cursor, ENGINE)
+    position = engine.get(0, 0, 'position', 0)
+    cursor.execute("SELECT MAX(event_id) FROM (SELECT event_id FROM grade_events WHERE event_id > ? ORDER BY event_id LIMIT ?)",
+                  (position, limit))
+    last = cursor.fetchone()[0]
+    if last is None:
+        return 0
+    # Позиция сдвигается с проверкой: если события уже взяла другая транзакция, выходим
+    cursor.execute("""
+    UPDATE token_rule_state SET value = ?
+    WHERE rule = ? AND student_id = 0 AND discipline_id = 0 AND item = 'position' AND value = ?
+    """, (last, ENGINE, position))
+    if cursor.rowcount == 0:
+        return 0
+
+    events = load_events(cursor, position, last)
+    states = {rule.name: DbState(cursor, rule.name) for rule in rules}
+    for event in events:
+        for rule in rules:
+            for award in rule.evaluate(event, states[rule.name]):
+                grant(cursor, rule, award, event)
+    return len(events)
+
+def rekey_student(cursor, old_student_id: int, student_id: int):
+    """Переносит события, состояние правил и начисления на новый student_id (регистрация)"""
+    cursor.execute("UPDATE grade_events SET student_id = ? WHERE student_id = ?", (student_id, old_student_id))
+    cursor.execute("UPDATE token_rule_state SET student_id = ? WHERE student_id = ?", (student_id, old_student_id))
+    cursor.execute("UPDATE token_awards SET student_id = ? WHERE student_id = ?", (student_id, old_student_id))
+
+def mark_first_finisher(cursor, discipline_id: int):
+    """Победитель, выбранный проверкой сдачи практик вручную: правило его больше не ищет"""
+    DbState(cursor, 'first_finisher').set(0, discipline_id, 'winner', 1)
+
+@db_task
+def process_grade_events(cursor):
+    return process_pending(cursor)
+
+class TokenRulesRunner:
+    """Фоновая обработка журнала: события из API и все, что не обработано в транзакции оценки"""
+
+    def __init__(self, interval=TOKEN_RULES_POLL_INTERVAL, on_processed=None):
+        self.interval = interval
+        # Вызывается после обработки событий (например, чтобы разбудить outbox)
+        self.on_processed = on_processed
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                processed = total = await process_grade_events()
+                while processed >= TOKEN_RULES_BATCH_SIZE:
+                    processed = await process_grade_events()
+                    total += processed
+                if total and self.on_processed:
+                    self.on_processed()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка обработки событий оценок: {e}")
+            await asyncio.sleep(self.interval)
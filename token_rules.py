@@ -0,0 +1,201 @@
+"""
+Правила начисления жетонов по событиям оценок
+Каждое изменение оценки попадает в журнал grade_events (триггеры, миграция 11).
+Правило получает событие и свое состояние и возвращает начисления; состояние -
+счетчики по ключу (студент, дисциплина, элемент), поэтому событие обрабатывается
+за O(1), без перебора истории. Правила не обращаются к БД: все нужное для расчета
+записано в событии, и журнал можно прогнать заново (replay) с пустым состоянием в
+памяти - результат должен совпасть с начислениями, сделанными по ходу
+"""
+import os
+from collections import namedtuple
+
+# Бонус первому, кто сдал все практики дисциплины в срок
+FIRST_FINISHER_TOKENS = 15
+
+# Бонус за каждые STREAK_LENGTH посещений подряд (0 - правило выключено)
+STREAK_LENGTH = int(os.environ.get('STREAK_LENGTH', 5))
+STREAK_BONUS = int(os.environ.get('STREAK_BONUS', 2))
+
+# Бонус за практику, сданную на 5 с первой попытки (0 - правило выключено)
+PERFECT_PRACTICE_BONUS = int(os.environ.get('PERFECT_PRACTICE_BONUS', 1))
+
+# Строка grade_events. is_new - оценка выставлена (old_grade не задана), иначе изменена;
+# ktp_type, practice_number, tokens_per_attendance, required_practices - на момент события
+GradeEvent = namedtuple('GradeEvent', 'event_id grade_id student_id teacher_id discipline_id ktp_id ktp_type '
+                                      'practice_number old_grade new_grade is_new date tokens_per_attendance '
+                                      'required_practices')
+
+# detail - подробность для текста уведомления (номер практики, длина серии)
+Award = namedtuple('Award', 'rule student_id teacher_id discipline_id tokens detail')
+
+# Элементы состояния уровня дисциплины хранятся с student_id = 0
+DISCIPLINE_LEVEL = 0
+
+def present(grade) -> bool:
+    """Студент был на занятии: оценка есть и это не "н" (-1)"""
+    return grade is not None and grade != -1
+
+def passed(grade) -> bool:
+    """Зачтено: оценка от 1"""
+    return grade is not None and grade >= 1
+
+class MemoryState:
+    """Состояние правила в памяти: для replay и проверок"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, student_id: int, discipline_id: int, item: str, default=None):
+        return self.values.get((student_id, discipline_id, item), default)
+
+    def set(self, student_id: int, discipline_id: int, item: str, value):
+        """value = None удаляет элемент"""
+        if value is None:
+            self.values.pop((student_id, discipline_id, item), None)
+        else:
+            self.values[(student_id, discipline_id, item)] = value
+
+class TokenRule:
+    """Правило начисления жетонов.
+
+    evaluate(event, state) -> [Award]; шаблоны уведомлений получают {tokens},
+    {discipline}, {detail}, преподавателю - еще {student}. Без шаблона уведомления нет.
+    """
+    name = None
+    kind = "tokens"
+    student_message = None
+    teacher_message = None
+
+    def evaluate(self, event: GradeEvent, state) -> list:
+        raise NotImplementedError
+
+    def record(self, cursor, award: Award, event: GradeEvent):
+        """Дополнительная запись о начислении в БД (кроме журнала и баланса)"""
+
+    def award(self, event: GradeEvent, tokens: int, detail=None) -> Award:
+        return Award(self.name, event.student_id, event.teacher_id, event.discipline_id, tokens, detail)
+
+class AttendanceRule(TokenRule):
+    """Жетоны за посещение: начисляются за оценку не "н" и списываются, если ее заменили на "н" """
+    name = 'attendance'
+
+    def evaluate(self, event, state):
+        tokens = event.tokens_per_attendance or 0
+        delta = present(event.new_grade) - (not event.is_new and present(event.old_grade))
+        if not delta or not tokens:
+            return []
+        return [self.award(event, delta * tokens)]
+
+class FirstFinisherRule(TokenRule):
+    """Бонус первому, кто сдал все практики дисциплины, сдав последнюю в день ее проведения.
+
+    Состояние: дата практики (первая оценка за нее) и есть ли победитель (кто он -
+    в first_practice_completions) - по дисциплине;
+    зачтенные оценки по каждой практике и число сданных практик - по студенту.
+    """
+    name = 'first_finisher'
+    kind = "practice"
+    student_message = ("Поздравляем! Вы сдали все практики по дисциплине '{discipline}' первыми и вовремя. "
+                       "Вам начислено {tokens} жетончиков.")
+    teacher_message = "Студент {student} сдал все практики по '{discipline}' первым и вовремя, получил {tokens} жетончиков."
+
+    def __init__(self, tokens=FIRST_FINISHER_TOKENS):
+        self.tokens = tokens
+
+    def evaluate(self, event, state):
+        if event.ktp_type != 'practice' or event.practice_number is None:
+            return []
+        number = event.practice_number
+        practice_date = state.get(DISCIPLINE_LEVEL, event.discipline_id, f"date:{number}")
+        if practice_date is None:
+            practice_date = event.date
+            state.set(DISCIPLINE_LEVEL, event.discipline_id, f"date:{number}", practice_date)
+
+        before = state.get(event.student_id, event.discipline_id, f"passes:{number}", 0)
+        after = before - (not event.is_new and passed(event.old_grade)) + passed(event.new_grade)
+        if after == before:
+            return []
+        state.set(event.student_id, event.discipline_id, f"passes:{number}", after or None)
+        if before and after:
+            return []
+        # Практика стала сданной или перестала быть сданной
+        completed = state.get(event.student_id, event.discipline_id, 'completed', 0) + (1 if after else -1)
+        state.set(event.student_id, event.discipline_id, 'completed', completed or None)
+
+        if (after and event.required_practices and completed == event.required_practices
+                and event.date == practice_date
+                and state.get(DISCIPLINE_LEVEL, event.discipline_id, 'winner') is None):
+            state.set(DISCIPLINE_LEVEL, event.discipline_id, 'winner', 1)
+            return [self.award(event, self.tokens)]
+        return []
+
+    def record(self, cursor, award, event):
+        cursor.execute("""
+        INSERT OR IGNORE INTO first_practice_completions (discipline_id, student_id, tokens, awarded_date)
+        VALUES (?, ?, ?, ?)
+        """, (award.discipline_id, award.student_id, award.tokens, event.date))
+
+class StreakRule(TokenRule):
+    """Бонус за каждые length посещений дисциплины подряд; "н" обнуляет серию. Учитываются новые оценки"""
+    name = 'streak'
+    student_message = "Вы посетили {detail} занятий подряд по дисциплине '{discipline}'. Бонус: {tokens} жетончиков."
+
+    def __init__(self, length=STREAK_LENGTH, tokens=STREAK_BONUS):
+        self.length = length
+        self.tokens = tokens
+
+    def evaluate(self, event, state):
+        if not event.is_new:
+            return []
+        if not present(event.new_grade):
+            state.set(event.student_id, event.discipline_id, 'streak', None)
+            return []
+        streak = state.get(event.student_id, event.discipline_id, 'streak', 0) + 1
+        state.set(event.student_id, event.discipline_id, 'streak', streak)
+        if streak % self.length:
+            return []
+        return [self.award(event, self.tokens, streak)]
+
+class PerfectPracticeRule(TokenRule):
+    """Бонус за практику, сданную на 5 с первой попытки"""
+    name = 'perfect_practice'
+    student_message = "Практика #{detail} по дисциплине '{discipline}' сдана на 5 с первой попытки. Бонус: {tokens} жетончиков."
+
+    def __init__(self, tokens=PERFECT_PRACTICE_BONUS):
+        self.tokens = tokens
+
+    def evaluate(self, event, state):
+        if event.ktp_type != 'practice' or event.practice_number is None:
+            return []
+        item = f"attempted:{event.practice_number}"
+        if state.get(event.student_id, event.discipline_id, item):
+            return []
+        state.set(event.student_id, event.discipline_id, item, 1)
+        if not event.is_new or event.new_grade != 5:
+            return []
+        return [self.award(event, self.tokens, event.practice_number)]
+
+def default_rules():
+    """Правила по настройкам окружения; порядок - порядок уведомлений"""
+    rules = [AttendanceRule(), FirstFinisherRule()]
+    if STREAK_LENGTH > 0 and STREAK_BONUS > 0:
+        rules.append(StreakRule())
+    if PERFECT_PRACTICE_BONUS > 0:
+        rules.append(PerfectPracticeRule())
+    return rules
+
+RULES = default_rules()
+
+def evaluate(event: GradeEvent, rules, states) -> list:
+    """Начисления по событию; states - {имя правила: состояние}"""
+    return [award for rule in rules for award in rule.evaluate(event, states[rule.name])]
+
+def replay(events, rules=RULES):
+    """Прогоняет журнал событий через правила с пустым состоянием.
+
+    Возвращает ([(event_id, Award)], {имя правила: MemoryState}).
+    """
+    states = {rule.name: MemoryState() for rule in rules}
+    awards = [(event.event_id, award) for event in events for award in evaluate(event, rules, states)]
+    return awards, states